@@ -2,7 +2,7 @@ import asyncio
 import logging
 import sys
 
-from helpers import handle_request
+from helpers import LineFramer, handle_line
 
 logging.basicConfig(
     format=(
@@ -18,7 +18,7 @@ IP, PORT = "10.154.0.3", 9090
 
 class PrimeServerProtocol(asyncio.Protocol):
     def __init__(self) -> None:
-        self.requests: bytearray = bytearray()
+        self.framer = LineFramer()
         super().__init__()
 
     def connection_made(self, transport: asyncio.BaseTransport):
@@ -28,14 +28,12 @@ class PrimeServerProtocol(asyncio.Protocol):
 
     def data_received(self, data: bytes):
         logging.info(f"Received: {len(data)} bytes of data from {self.peer}.")
-        self.requests.extend(data)
-        if data.decode().endswith("\n"):
-            response = handle_request(self.requests)
+        # Every complete line is answered now, whatever chunk its start came in.
+        response = b"".join(handle_line(line) for line in self.framer.feed(data))
+        if response:
             self.transport.write(response)  # type: ignore
-            logging.debug(self.requests)
             logging.debug(response)
-            self.requests = bytearray()
-        logging.info(f"Sent : {len(data)} bytes of data to {self.peer}.")
+        logging.info(f"Sent : {len(response)} bytes of data to {self.peer}.")
 
     def eof_received(self):
         logging.info(f"Closed connection to client @ {self.peer}")
@@ -22,6 +22,44 @@ def handle_request(request: bytearray) -> bytes:
     return ("\n".join(responses) + "\n").encode()
 
 
+def handle_line(line: bytes) -> bytes:
+    # One request, without its newline, to its response, b"" for one that isn't JSON.
+    try:
+        r = json.loads(line.decode())
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return b""
+    # Valid JSON that isn't an object, 1 or [], is as malformed as a missing field.
+    if isinstance(r, dict) and valid(r):
+        response = generate_response(is_prime(r["number"]))
+    else:
+        response = generate_response(None)
+    return (response + "\n").encode()
+
+
+class LineFramer(object):
+    """
+    Splits a stream into lines as it arrives, each byte is scanned for a newline once,
+    a partial line waits in the buffer for the rest of it.
+    """
+
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+        self.scanned = 0  # Bytes of the buffer known to hold no newline.
+
+    def feed(self, data: bytes) -> list[bytes]:
+        buffer = self.buffer
+        buffer += data
+        lines: list[bytes] = []
+        start = 0
+        while (end := buffer.find(b"\n", self.scanned)) != -1:
+            lines.append(bytes(buffer[start:end]))
+            start = self.scanned = end + 1
+        # Dropped from the front in place, the buffer keeps its allocation.
+        del buffer[:start]
+        self.scanned = len(buffer)
+        return lines
+
+
 def generate_response(prime: Optional[bool]) -> str:
     # Conforming response : {"method":"isPrime","prime":false}
     # For non-conforming response return prime : None
@@ -0,0 +1,39 @@
+import json
+
+from helpers import LineFramer, handle_line
+
+
+class TestLineFramer:
+    def test_pipelined_lines(self):
+        framer = LineFramer()
+        assert framer.feed(b"a\nbc\n\nd") == [b"a", b"bc", b""]
+        assert framer.buffer == b"d"
+
+    def test_line_split_across_chunks(self):
+        framer = LineFramer()
+        assert framer.feed(b'{"method":') == []
+        assert framer.feed(b'"isPrime",') == []
+        assert framer.scanned == len(framer.buffer)
+        assert framer.feed(b'"number":7}\n{"met') == [b'{"method":"isPrime","number":7}']
+        assert framer.feed(b'hod"}\n') == [b'{"method"}']
+        assert framer.buffer == b"" and framer.scanned == 0
+
+    def test_multibyte_split(self):
+        framer = LineFramer()
+        data = "é\n".encode()
+        assert framer.feed(data[:1]) == []
+        assert framer.feed(data[1:]) == ["é".encode()]
+
+
+class TestHandleLine:
+    def test_prime(self):
+        response = handle_line(b'{"method":"isPrime","number":7}')
+        assert response.endswith(b"\n")
+        assert json.loads(response) == {"method": "isPrime", "prime": True}
+
+    def test_malformed(self):
+        assert json.loads(handle_line(b'{"method":"isPrime"}'))["prime"] is None
+        assert json.loads(handle_line(b"1"))["prime"] is None
+        assert json.loads(handle_line(b"[]"))["prime"] is None
+        assert handle_line(b"{") == b""
+        assert handle_line(b"\xff") == b""
@@ -1,9 +1,22 @@
+import argparse
 import asyncio
 import logging
+import multiprocessing
+import signal
 import sys
 from asyncio import StreamReader, StreamWriter
 
-from async_helpers import ProtocolError, Reader, ValidationError, Writer, get, list, put
+from async_helpers import (
+    ProtocolError,
+    Reader,
+    ValidationError,
+    Writer,
+    get,
+    list,
+    open_repository,
+    put,
+    refresh_repository,
+)
 
 logging.basicConfig(
     format=(
@@ -28,6 +41,7 @@ async def handler(stream_reader: StreamReader, stream_writer: StreamWriter):
             msg = await reader.readline()
             msg_parts = msg.split(" ")
             msg_type = msg_parts[0].upper()
+            refresh_repository()
 
             match msg_type:
                 case "HELP":
@@ -60,16 +74,53 @@ async def handler(stream_reader: StreamReader, stream_writer: StreamWriter):
     return
 
 
-async def main():
-    server = await asyncio.start_server(handler, IP, PORT)
-    logging.info(f"Started VCS Server @ {IP}:{PORT}")
+async def main(port: int = PORT, reuse_port: bool = False):
+    server = await asyncio.start_server(handler, IP, port, reuse_port=reuse_port)
+    logging.info(f"Started VCS Server @ {IP}:{port}")
 
     async with server:
         await server.serve_forever()
 
 
-if __name__ == "__main__":
+def serve(repo: str | None, port: int = PORT, reuse_port: bool = False):
+    # Every worker opens the repository itself, after the fork.
+    if repo:
+        open_repository(repo)
     try:
-        asyncio.run(main())
+        asyncio.run(main(port, reuse_port))
     except KeyboardInterrupt:
         logging.critical("Interrupted, shutting down.")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Voracious Code Storage server")
+    arg_parser.add_argument(
+        "--repo", help="Directory of an on-disk repository, files are kept in memory if unset"
+    )
+    arg_parser.add_argument(
+        "--workers", type=int, default=1, help="Processes accepting on the same port"
+    )
+    arg_parser.add_argument("--port", type=int, default=PORT)
+    arg_parser.add_argument("--log-level", default="INFO")
+    args = arg_parser.parse_args()
+    logging.getLogger().setLevel(args.log_level)
+    if args.workers > 1 and not args.repo:
+        arg_parser.error("--workers needs a shared --repo")
+
+    if args.workers == 1:
+        serve(args.repo, args.port)
+    else:
+        # Prefork, every worker binds with SO_REUSEPORT and the kernel spreads connections.
+        # Exit cleanly on SIGTERM, so the daemonic workers are terminated along with us.
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        workers = [
+            multiprocessing.Process(target=serve, args=(args.repo, args.port, True), daemon=True)
+            for _ in range(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            logging.critical("Interrupted, shutting down.")
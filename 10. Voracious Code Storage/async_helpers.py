@@ -3,10 +3,11 @@ import re
 import sys
 from asyncio import StreamReader, StreamWriter
 from collections import defaultdict
-from hashlib import md5
 from string import ascii_letters, digits, punctuation, whitespace
 from typing import List
 
+from storage import DiskStore, MemoryStore
+
 logging.basicConfig(
     format=(
         "%(asctime)s | %(levelname)s | %(name)s |  [%(filename)s:%(lineno)d] | %(threadName)-10s |"
@@ -17,9 +18,10 @@ logging.basicConfig(
     handlers=[logging.FileHandler("app.log"), logging.StreamHandler(sys.stdout)],
 )
 
-DATASTORE: dict[str, List[str]] = defaultdict(list)
-# The list index is the revision number.
-# Starting from r1.
+DATASTORE: MemoryStore | DiskStore = MemoryStore()
+# file_path -> revisions, starting from r1.
+# Superseded revisions are held zlib compressed, see storage.MemoryStore.
+# Replaced by a DiskStore when the server is started with a repository, see open_repository.
 DIRS: dict[str, set[str]] = defaultdict(set)
 # For every directory, store all of its direct children only. (Only empty directories)
 FILES: dict[str, set[str]] = defaultdict(set)
@@ -111,6 +113,27 @@ def parse_child_parent_relationships(file_path: str):
             FILES[parent].add(child)
 
 
+def open_repository(repo_dir: str):
+    """
+    Serve files from the on-disk repository in `repo_dir`, instead of memory.
+    The directory listings are rebuilt from the repository's directory index.
+    """
+    global DATASTORE
+    DATASTORE = DiskStore(repo_dir)
+    for file_path in DATASTORE.paths():
+        parse_child_parent_relationships(file_path)
+    logging.info(f"Opened repository @ {repo_dir} with {len(DATASTORE.path_names)} files")
+
+
+def refresh_repository():
+    """
+    Picks up files added to the on-disk repository by other server processes.
+    """
+    if isinstance(DATASTORE, DiskStore):
+        for file_path in DATASTORE.refresh():
+            parse_child_parent_relationships(file_path)
+
+
 def validate_file_name(file_path: str):
     if file_path == "/":
         return
@@ -134,7 +157,11 @@ def get_revision(msg_parts: list[str]) -> int:
     revision = "0"
     if len(msg_parts) == 3:
         revision = msg_parts[2][1:]
-        if not revision.isdigit() or int(revision) < 1 or int(revision) > len(DATASTORE[file_path]):
+        if (
+            not revision.isdigit()
+            or int(revision) < 1
+            or int(revision) > DATASTORE.revisions(file_path)
+        ):
             raise ValidationError("ERR no such revision")
     return int(revision)
 
@@ -154,7 +181,7 @@ async def list(writer: Writer, msg_parts: list[str]):
 
     for file in files:
         full_path = path + "/" + file
-        revision = len(DATASTORE[full_path]) + 1
+        revision = DATASTORE.revisions(full_path) + 1
         ls.append(f"{file} r{revision}")
         seen.add(file)
     for dir in dirs:
@@ -175,8 +202,8 @@ async def get(writer: Writer, msg_parts: List[str]):
     if file_path not in DATASTORE:
         raise ProtocolError("ERR no such file")
     else:
-        revision = get_revision(msg_parts)
-        data = DATASTORE[file_path][revision - 1]
+        revision = get_revision(msg_parts) or DATASTORE.revisions(file_path)
+        data = DATASTORE.get(file_path, revision)
         resp = f"OK {len(data)}"
         await writer.writeline(resp)
         await writer.writeline(data)
@@ -191,12 +218,7 @@ async def put(writer: Writer, reader: Reader, msg_parts: List[str]):
     validate_data(data)
 
     data = data.decode("utf-8")
-    data_hash, prev_data_hash = md5(data.encode()).hexdigest(), ""
-    if len(DATASTORE[file_path]) > 0:
-        prev_data = DATASTORE[file_path][-1]
-        prev_data_hash = md5(prev_data.encode()).hexdigest()
-    if data_hash != prev_data_hash:
-        DATASTORE[file_path].append(data)
-        parse_child_parent_relationships(file_path)
-    resp = f"OK r{len(DATASTORE[file_path])}"
+    revision = DATASTORE.put(file_path, data)
+    parse_child_parent_relationships(file_path)
+    resp = f"OK r{revision}"
     await writer.writeline(resp)
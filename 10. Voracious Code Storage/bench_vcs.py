@@ -0,0 +1,274 @@
+"""
+Workload replay benchmark for the VCS server.
+
+Starts the server once per engine, builds the same synthetic repository over
+TCP, then replays a PUT/GET/LIST mix at the given concurrency and reports
+ops/s, latency percentiles and the server's peak RSS.
+
+    python bench_vcs.py --engines memory,disk,disk:4 --clients 32 --ops 20000
+"""
+import argparse
+import asyncio
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from asyncio import StreamReader, StreamWriter
+from dataclasses import dataclass, field
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "10_async_vcs.py")
+HOST = "127.0.0.1"
+WORDS = (
+    "def class return import self if else for while in not and or None True False async await"
+    " data path file revision print len range value key items append yield with as try except"
+).split()
+SIZES = [(0.6, 64, 2048), (0.3, 2048, 32 * 1024), (0.1, 32 * 1024, 256 * 1024)]
+# (weight, min, max) bytes. Mostly small source files, with a tail of large ones.
+
+
+@dataclass
+class Repository(object):
+    files: list[str] = field(default_factory=list)
+    dirs: list[str] = field(default_factory=list)
+    revisions: dict[str, int] = field(default_factory=dict)
+
+
+@dataclass
+class Result(object):
+    latencies: dict[str, list[float]] = field(default_factory=dict)
+    elapsed: float = 0
+
+    def record(self, op: str, latency: float):
+        self.latencies.setdefault(op, []).append(latency)
+
+    def ops(self) -> int:
+        return sum(len(samples) for samples in self.latencies.values())
+
+
+class Client(object):
+    def __init__(self, reader: StreamReader, writer: StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, port: int) -> "Client":
+        reader, writer = await asyncio.open_connection(HOST, port)
+        client = cls(reader, writer)
+        await client.ready()
+        return client
+
+    async def ready(self):
+        line = await self.reader.readline()
+        assert line == b"READY\n", line
+
+    async def put(self, path: str, data: bytes) -> int:
+        self.writer.write(f"PUT {path} {len(data)}\n".encode() + data)
+        line = await self.reader.readline()
+        assert line.startswith(b"OK r"), line
+        await self.ready()
+        return int(line[4:])
+
+    async def get(self, path: str, revision: int) -> bytes:
+        self.writer.write(f"GET {path} r{revision}\n".encode())
+        line = await self.reader.readline()
+        assert line.startswith(b"OK "), line
+        data = await self.reader.readexactly(int(line[3:]))
+        await self.ready()
+        return data
+
+    async def list(self, path: str) -> list[bytes]:
+        self.writer.write(f"LIST {path}\n".encode())
+        line = await self.reader.readline()
+        assert line.startswith(b"OK "), line
+        entries = [await self.reader.readline() for _ in range(int(line[3:]))]
+        await self.ready()
+        return entries
+
+    def close(self):
+        self.writer.close()
+
+
+def source_file(rng: random.Random) -> bytes:
+    weights = [weight for weight, _, _ in SIZES]
+    _, low, high = rng.choices(SIZES, weights)[0]
+    size, lines = rng.randint(low, high), []
+    while size > 0:
+        line = "    " * rng.randint(0, 3) + " ".join(rng.choices(WORDS, k=rng.randint(2, 10)))
+        lines.append(line)
+        size -= len(line) + 1
+    return ("\n".join(lines) + "\n").encode()
+
+
+def edit(rng: random.Random, data: bytes) -> bytes:
+    """
+    A new revision, a few lines changed the way a commit would.
+    """
+    lines = data.split(b"\n")
+    for _ in range(rng.randint(1, 5)):
+        lines[rng.randrange(len(lines))] = " ".join(rng.choices(WORDS, k=6)).encode()
+    return b"\n".join(lines).rstrip(b"\n") + b"\n"
+
+
+def synthetic_tree(rng: random.Random, num_files: int, depth: int) -> Repository:
+    repo = Repository()
+    dirs = {""}
+    for i in range(num_files):
+        parts = [f"d{rng.randrange(4)}" for _ in range(rng.randint(1, depth))]
+        for level in range(1, len(parts) + 1):
+            dirs.add("/" + "/".join(parts[:level]))
+        repo.files.append("/" + "/".join(parts) + f"/file_{i}.py")
+    repo.dirs = sorted(dir or "/" for dir in dirs)
+    return repo
+
+
+async def build(port: int, repo: Repository, revisions: int, clients: int, seed: int):
+    async def worker(files: list[str], rng: random.Random):
+        client = await Client.connect(port)
+        for path in files:
+            data = source_file(rng)
+            for _ in range(revisions):
+                repo.revisions[path] = await client.put(path, data)
+                data = edit(rng, data)
+        client.close()
+
+    await asyncio.gather(
+        *(worker(repo.files[i::clients], random.Random(seed + i)) for i in range(clients))
+    )
+
+
+async def replay(
+    port: int, repo: Repository, mix: dict[str, int], ops: int, clients: int, seed: int
+) -> Result:
+    result = Result()
+    op_names, op_weights = list(mix), list(mix.values())
+
+    async def worker(count: int, rng: random.Random):
+        client = await Client.connect(port)
+        for _ in range(count):
+            op = rng.choices(op_names, op_weights)[0]
+            if op == "put":
+                # The revision edited is fetched before the clock starts, a put times the PUT only.
+                path = rng.choice(repo.files)
+                data = edit(rng, await client.get(path, repo.revisions[path]))
+            start = time.perf_counter()
+            if op == "put":
+                repo.revisions[path] = await client.put(path, data)
+            elif op == "get":
+                path = rng.choice(repo.files)
+                # Skewed towards recent revisions, the way checkouts are.
+                revision = max(1, repo.revisions[path] - int(rng.expovariate(0.5)))
+                await client.get(path, revision)
+            else:
+                await client.list(rng.choice(repo.dirs))
+            result.record(op, time.perf_counter() - start)
+        client.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(worker(ops // clients, random.Random(seed * 31 + i)) for i in range(clients))
+    )
+    result.elapsed = time.perf_counter() - start
+    return result
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def peak_rss_kb(pid: int) -> int:
+    """
+    Peak RSS of the server, summed over its worker processes in prefork mode.
+    """
+    total, pids = 0, [pid]
+    while pids:
+        pid = pids.pop()
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1])
+            with open(f"/proc/{pid}/task/{pid}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except FileNotFoundError:
+            continue
+    return total
+
+
+def start_server(engine: str, port: int, workdir: str) -> subprocess.Popen:
+    name, _, workers = engine.partition(":")
+    cmd = [sys.executable, SERVER, "--port", str(port), "--log-level", "WARNING"]
+    if name == "disk":
+        cmd += ["--repo", os.path.join(workdir, "repo"), "--workers", workers or "1"]
+    elif name != "memory":
+        raise ValueError(f"Unknown engine : {engine}")
+    # The server logs to app.log in its working directory.
+    server = subprocess.Popen(cmd, cwd=workdir, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline and server.poll() is None:
+        try:
+            socket.create_connection((HOST, port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError(f"Server for {engine} did not start")
+
+
+def run(engine: str, args: argparse.Namespace) -> tuple[Result, int]:
+    with tempfile.TemporaryDirectory() as workdir:
+        server = start_server(engine, args.port, workdir)
+        try:
+            repo = synthetic_tree(random.Random(args.seed), args.files, args.depth)
+            asyncio.run(build(args.port, repo, args.revisions, args.clients, args.seed))
+            result = asyncio.run(
+                replay(args.port, repo, args.mix, args.ops, args.clients, args.seed)
+            )
+            return result, peak_rss_kb(server.pid)
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def parse_mix(mix: str) -> dict[str, int]:
+    ops = {}
+    for part in mix.split(","):
+        op, _, weight = part.partition("=")
+        if op not in ("put", "get", "list"):
+            raise argparse.ArgumentTypeError(f"Unknown op : {op}")
+        ops[op] = int(weight)
+    return ops
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument(
+        "--engines", default="memory,disk", help="memory, disk or disk:WORKERS, comma separated"
+    )
+    arg_parser.add_argument("--files", type=int, default=500)
+    arg_parser.add_argument("--depth", type=int, default=6, help="Max directory depth")
+    arg_parser.add_argument("--revisions", type=int, default=10, help="Revisions per file")
+    arg_parser.add_argument("--ops", type=int, default=10000, help="Replayed operations")
+    arg_parser.add_argument("--mix", type=parse_mix, default="put=10,get=70,list=20")
+    arg_parser.add_argument("--clients", type=int, default=16)
+    arg_parser.add_argument("--port", type=int, default=9190)
+    arg_parser.add_argument("--seed", type=int, default=1)
+    args = arg_parser.parse_args()
+
+    print(f"{'engine':<10} {'op':<5} {'ops/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'peak rss':>10}")
+    for engine in args.engines.split(","):
+        result, rss_kb = run(engine, args)
+        print(
+            f"{engine:<10} {'all':<5} {result.ops() / result.elapsed:>9.0f} {'':>8} {'':>8}"
+            f" {rss_kb / 1024:>8.1f}MB"
+        )
+        for op, samples in sorted(result.latencies.items()):
+            p50, p99 = percentile(samples, 50) * 1000, percentile(samples, 99) * 1000
+            print(f"{'':<10} {op:<5} {len(samples) / result.elapsed:>9.0f} {p50:>8.2f} {p99:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
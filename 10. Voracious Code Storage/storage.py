@@ -0,0 +1,434 @@
+import fcntl
+import mmap
+import os
+import struct
+import zlib
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional
+
+CACHE_BYTES = 32 * 1024 * 1024  # Budget for decompressed revisions held in the LRU.
+COMPRESSION_LEVEL = 6
+
+
+class RevisionCache(object):
+    """
+    Bounded LRU of decompressed revisions, keyed by (file_path, revision).
+    The budget is counted in characters of cached data, not in entries.
+    """
+
+    def __init__(self, max_bytes: int = CACHE_BYTES) -> None:
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries: OrderedDict[tuple[str, int], str] = OrderedDict()
+
+    def get(self, key: tuple[str, int]) -> Optional[str]:
+        data = self.entries.get(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return data
+
+    def put(self, key: tuple[str, int], data: str):
+        if len(data) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        self.entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+
+class MemoryStore(object):
+    """
+    In-memory revision store. The latest revision of every file is kept as is,
+    so PUT dedup and GET of the head never touch zlib. Once a revision is
+    superseded it is compressed, and only kept raw if compression doesn't help.
+    """
+
+    def __init__(self, cache_bytes: int = CACHE_BYTES, level: int = COMPRESSION_LEVEL) -> None:
+        self.level = level
+        self.heads: dict[str, str] = {}  # file_path -> latest revision
+        self.history: dict[str, list[str | bytes]] = {}
+        # file_path -> [r1, r2, ...] excluding the head. bytes entries are zlib compressed.
+        self.cache = RevisionCache(cache_bytes)
+        self.raw_bytes = 0  # Size of all superseded revisions, before compression.
+        self.stored_bytes = 0  # Size of all superseded revisions, as held in memory.
+
+    def __contains__(self, file_path: str) -> bool:
+        return file_path in self.heads
+
+    def revisions(self, file_path: str) -> int:
+        if file_path not in self.heads:
+            return 0
+        return len(self.history[file_path]) + 1
+
+    def latest(self, file_path: str) -> Optional[str]:
+        return self.heads.get(file_path)
+
+    def get(self, file_path: str, revision: int) -> str:
+        """
+        Returns the data for a revision, counting from r1.
+        """
+        history = self.history[file_path]
+        if revision == len(history) + 1:
+            return self.heads[file_path]
+
+        key = (file_path, revision)
+        data = self.cache.get(key)
+        if data is None:
+            data = self._decode(history[revision - 1])
+            self.cache.put(key, data)
+        return data
+
+    def put(self, file_path: str, data: str) -> int:
+        """
+        Stores `data` as the new head of `file_path`, and returns its revision.
+        Storing the same data as the head is a no-op, returning the head's revision.
+        """
+        history = self.history.setdefault(file_path, [])
+        if file_path in self.heads:
+            if self.heads[file_path] == data:
+                return len(history) + 1
+            prev_data = self.heads[file_path]
+            history.append(self._encode(prev_data))
+            # The revision just superseded is the likeliest to be read again.
+            self.cache.put((file_path, len(history)), prev_data)
+        self.heads[file_path] = data
+        return len(history) + 1
+
+    def bytes_saved(self) -> int:
+        return self.raw_bytes - self.stored_bytes
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "files": len(self.heads),
+            "cache_hits": self.cache.hits,
+            "cache_misses": self.cache.misses,
+            "cache_bytes": self.cache.size,
+            "bytes_saved": self.bytes_saved(),
+        }
+
+    def _encode(self, data: str) -> str | bytes:
+        compressed = zlib.compress(data.encode("utf-8"), self.level)
+        self.raw_bytes += len(data)
+        if len(compressed) >= len(data):
+            self.stored_bytes += len(data)
+            return data
+        self.stored_bytes += len(compressed)
+        return compressed
+
+    def _decode(self, entry: str | bytes) -> str:
+        if isinstance(entry, str):
+            return entry
+        return zlib.decompress(entry).decode("utf-8")
+
+
+# On-disk repository layout, every file is append-only except `heads`.
+PACK_FILE = "pack"  # Revision data, back to back.
+INDEX_FILE = "index"  # Fixed size INDEX_RECORD per revision, in the order they were stored.
+PATHS_FILE = "paths"  # Directory index, one file path per line. The line number is the path id.
+HEADS_FILE = "heads"  # u32 per path id, the index record number (+1) of its latest revision.
+LOCK_FILE = "lock"  # flock'ed by writers.
+INDEX_RECORD = struct.Struct("<IIIIQI")  # path_id, revision, prev record (+1), flags, offset, length
+HEAD_RECORD = struct.Struct("<I")
+FLAG_COMPRESSED = 1
+
+
+class DiskStore(object):
+    """
+    Durable revision store, with the same interface as MemoryStore.
+    Opening a repository only reads the directory index, the revision index
+    and the heads are memory-mapped, and each revision record points back to
+    the previous revision of the same file. The record numbers of a file's
+    revisions are walked once, on the first GET of an old revision.
+    """
+
+    def __init__(
+        self, repo_dir: str, cache_bytes: int = CACHE_BYTES, level: int = COMPRESSION_LEVEL
+    ) -> None:
+        os.makedirs(repo_dir, exist_ok=True)
+        self.repo_dir = repo_dir
+        self.level = level
+        self.cache = RevisionCache(cache_bytes)
+        self.raw_bytes = 0  # Size of revisions stored by this process, before compression.
+        self.stored_bytes = 0  # Size of revisions stored by this process, as written to the pack.
+
+        flags = os.O_RDWR | os.O_CREAT | os.O_APPEND
+        self.pack_fd = os.open(os.path.join(repo_dir, PACK_FILE), flags)
+        self.index_fd = os.open(os.path.join(repo_dir, INDEX_FILE), flags)
+        self.paths_fd = os.open(os.path.join(repo_dir, PATHS_FILE), flags)
+        self.heads_fd = os.open(os.path.join(repo_dir, HEADS_FILE), os.O_RDWR | os.O_CREAT)
+
+        self.path_ids: dict[str, int] = {}
+        self.path_names: list[str] = []
+        self.records: dict[str, array] = {}  # file_path -> index record numbers, r1 first.
+        self.index: Optional[mmap.mmap] = None
+        self.heads: Optional[mmap.mmap] = None
+        self.paths_size = 0  # Bytes of the directory index read so far.
+        self.unlisted: list[str] = []  # Files added by other processes, picked up by a put().
+        self.lock_fd = os.open(os.path.join(repo_dir, LOCK_FILE), os.O_RDWR | os.O_CREAT)
+        with self._locked():
+            self._recover()
+
+    @contextmanager
+    def _locked(self):
+        """
+        Serializes writers, across every process sharing the repository.
+        """
+        fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    def _recover(self):
+        """
+        Drops the tail of a write that was interrupted half way through.
+        Nothing in the pack is reachable until its index record and head are written,
+        and a head is only written once the pack and the index are synced. A head left
+        past the index, by a disk that lost what it was told to keep, is rolled back.
+        """
+        index_size = os.fstat(self.index_fd).st_size
+        pack_size = os.fstat(self.pack_fd).st_size
+        count = index_size // INDEX_RECORD.size
+        while count:
+            # Records of a blob the pack lost are as good as torn.
+            *_, offset, length = INDEX_RECORD.unpack(
+                os.pread(self.index_fd, INDEX_RECORD.size, (count - 1) * INDEX_RECORD.size)
+            )
+            if offset + length <= pack_size:
+                break
+            count -= 1
+        if index_size != count * INDEX_RECORD.size:
+            os.truncate(self.index_fd, count * INDEX_RECORD.size)
+
+        self._read_paths()
+        paths_size = os.fstat(self.paths_fd).st_size
+        if paths_size > self.paths_size:
+            # Partially written path, it can't have a head yet.
+            os.truncate(self.paths_fd, self.paths_size)
+
+        self._map_heads()
+        self._map_index()
+        self._roll_back_heads(count)
+
+    def _roll_back_heads(self, count: int):
+        """
+        Points every head at or past the `count` records of the index back at the
+        latest revision of its file the index still has, or at none.
+        """
+        stale = {
+            path_id for path_id in range(len(self.path_names)) if self._head(path_id) >= count
+        }
+        if not stale:
+            return
+        latest: dict[int, int] = {}
+        for record_no in range(count - 1, -1, -1):
+            path_id = self._record(record_no)[0]
+            if path_id in stale and path_id not in latest:
+                latest[path_id] = record_no
+                if len(latest) == len(stale):
+                    break
+        for path_id in stale:
+            head = latest.get(path_id, -1) + 1
+            HEAD_RECORD.pack_into(self.heads, path_id * HEAD_RECORD.size, head)  # type: ignore
+        self.heads.flush()  # type: ignore
+
+    def _read_paths(self) -> list[str]:
+        """
+        Reads every complete line appended to the directory index since the last call.
+        """
+        paths_size = os.fstat(self.paths_fd).st_size
+        if paths_size == self.paths_size:
+            return []
+        data = os.pread(self.paths_fd, paths_size - self.paths_size, self.paths_size)
+        complete = data.rfind(b"\n") + 1
+        self.paths_size += complete
+        new_paths = [line.decode("utf-8") for line in data[:complete].split(b"\n")[:-1]]
+        for file_path in new_paths:
+            self._add_path(file_path)
+        return new_paths
+
+    def _catch_up(self) -> list[str]:
+        new_paths = self._read_paths()
+        if new_paths:
+            self._map_heads()
+        return new_paths
+
+    def refresh(self) -> list[str]:
+        """
+        Picks up files added by other processes sharing the repository, and returns them,
+        along with those a put() picked up since the last refresh.
+        New revisions of known files are visible without a refresh, through the shared heads.
+        """
+        new_paths, self.unlisted = self.unlisted + self._catch_up(), []
+        return new_paths
+
+    def _add_path(self, file_path: str) -> int:
+        path_id = len(self.path_names)
+        self.path_ids[file_path] = path_id
+        self.path_names.append(file_path)
+        return path_id
+
+    def _map_heads(self):
+        size = len(self.path_names) * HEAD_RECORD.size
+        if os.fstat(self.heads_fd).st_size < size:
+            os.ftruncate(self.heads_fd, size)
+        if self.heads is not None:
+            self.heads.close()
+        self.heads = mmap.mmap(self.heads_fd, size) if size else None
+
+    def _map_index(self):
+        size = os.fstat(self.index_fd).st_size
+        if self.index is not None:
+            self.index.close()
+        self.index = mmap.mmap(self.index_fd, size, access=mmap.ACCESS_READ) if size else None
+
+    def _head(self, path_id: int) -> int:
+        """
+        Returns the index record number of the latest revision, or -1.
+        """
+        if self.heads is None or (path_id + 1) * HEAD_RECORD.size > len(self.heads):
+            return -1
+        (head,) = HEAD_RECORD.unpack_from(self.heads, path_id * HEAD_RECORD.size)
+        return head - 1
+
+    def _record(self, record_no: int) -> tuple[int, int, int, int, int, int]:
+        offset = record_no * INDEX_RECORD.size
+        if self.index is None or offset + INDEX_RECORD.size > len(self.index):
+            self._map_index()
+        return INDEX_RECORD.unpack_from(self.index, offset)  # type: ignore
+
+    def _read(self, record_no: int) -> str:
+        _, _, _, flags, offset, length = self._record(record_no)
+        data = os.pread(self.pack_fd, length, offset)
+        if flags & FLAG_COMPRESSED:
+            data = zlib.decompress(data)
+        return data.decode("utf-8")
+
+    def _head_of(self, file_path: str) -> int:
+        path_id = self.path_ids.get(file_path)
+        if path_id is None:
+            return -1
+        return self._head(path_id)
+
+    def _revision_records(self, file_path: str) -> array:
+        """
+        Record numbers of every revision of `file_path`, walking back from the head
+        only as far as the revisions that are already known.
+        """
+        records = self.records.setdefault(file_path, array("I"))
+        record_no = self._head_of(file_path)
+        missing: list[int] = []
+        while record_no >= 0:
+            _, revision, prev, _, _, _ = self._record(record_no)
+            if revision <= len(records):
+                break
+            missing.append(record_no)
+            record_no = prev - 1
+        records.extend(reversed(missing))
+        return records
+
+    def paths(self) -> list[str]:
+        return [path for path in self.path_names if path in self]
+
+    def __contains__(self, file_path: str) -> bool:
+        return self._head_of(file_path) >= 0
+
+    def revisions(self, file_path: str) -> int:
+        record_no = self._head_of(file_path)
+        if record_no < 0:
+            return 0
+        return self._record(record_no)[1]
+
+    def latest(self, file_path: str) -> Optional[str]:
+        revision = self.revisions(file_path)
+        if not revision:
+            return None
+        return self.get(file_path, revision)
+
+    def get(self, file_path: str, revision: int) -> str:
+        """
+        Returns the data for a revision, counting from r1.
+        """
+        key = (file_path, revision)
+        data = self.cache.get(key)
+        if data is None:
+            data = self._read(self._revision_records(file_path)[revision - 1])
+            self.cache.put(key, data)
+        return data
+
+    def put(self, file_path: str, data: str) -> int:
+        """
+        Appends `data` as the new head of `file_path`, and returns its revision.
+        Storing the same data as the head is a no-op, returning the head's revision.
+        """
+        with self._locked():
+            # Kept for the next refresh(), the caller lists them from there.
+            self.unlisted.extend(self._catch_up())
+            revision = self.revisions(file_path)
+            if revision and self.get(file_path, revision) == data:
+                return revision
+            return self._append(file_path, data)
+
+    def _append(self, file_path: str, data: str) -> int:
+        path_id = self.path_ids.get(file_path)
+        if path_id is None:
+            line = (file_path + "\n").encode("utf-8")
+            os.write(self.paths_fd, line)
+            os.fsync(self.paths_fd)
+            self.paths_size += len(line)
+            path_id = self._add_path(file_path)
+            self._map_heads()
+
+        prev = self._head(path_id)
+        revision = self._record(prev)[1] + 1 if prev >= 0 else 1
+        blob, flags = data.encode("utf-8"), 0
+        compressed = zlib.compress(blob, self.level)
+        if len(compressed) < len(blob):
+            blob, flags = compressed, FLAG_COMPRESSED
+        self.raw_bytes += len(data)
+        self.stored_bytes += len(blob)
+
+        offset = os.lseek(self.pack_fd, 0, os.SEEK_END)
+        os.write(self.pack_fd, blob)
+        os.fsync(self.pack_fd)
+        record_no = os.lseek(self.index_fd, 0, os.SEEK_END) // INDEX_RECORD.size
+        os.write(
+            self.index_fd,
+            INDEX_RECORD.pack(path_id, revision, prev + 1, flags, offset, len(blob)),
+        )
+        os.fsync(self.index_fd)
+        # Published only once what it points at is on disk.
+        HEAD_RECORD.pack_into(self.heads, path_id * HEAD_RECORD.size, record_no + 1)  # type: ignore
+        self.heads.flush()  # type: ignore
+        self.cache.put((file_path, revision), data)
+        return revision
+
+    def bytes_saved(self) -> int:
+        return self.raw_bytes - self.stored_bytes
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "files": len(self.path_names),
+            "cache_hits": self.cache.hits,
+            "cache_misses": self.cache.misses,
+            "cache_bytes": self.cache.size,
+            "bytes_saved": self.bytes_saved(),
+        }
+
+    def close(self):
+        for view in (self.index, self.heads):
+            if view is not None:
+                view.close()
+        for fd in (self.pack_fd, self.index_fd, self.paths_fd, self.heads_fd, self.lock_fd):
+            os.close(fd)
@@ -0,0 +1,146 @@
+import os
+
+from storage import (
+    INDEX_FILE,
+    INDEX_RECORD,
+    PACK_FILE,
+    PATHS_FILE,
+    DiskStore,
+    MemoryStore,
+    RevisionCache,
+)
+
+SOURCE = "".join(f"def handler_{i}(request):\n    return request.body\n\n" for i in range(200))
+
+
+class TestRevisionCache:
+    def test_evicts_least_recently_used(self):
+        cache = RevisionCache(max_bytes=10)
+        cache.put(("/a", 1), "aaaa")
+        cache.put(("/b", 1), "bbbb")
+        cache.get(("/a", 1))
+        cache.put(("/c", 1), "cccc")
+        assert cache.get(("/b", 1)) is None
+        assert cache.get(("/a", 1)) == "aaaa"
+        assert cache.size == 8
+
+    def test_counters(self):
+        cache = RevisionCache()
+        cache.put(("/a", 1), "data")
+        cache.get(("/a", 1))
+        cache.get(("/a", 2))
+        assert (cache.hits, cache.misses) == (1, 1)
+
+
+class TestMemoryStore:
+    def test_revisions(self):
+        store = MemoryStore()
+        assert store.put("/a.py", "r1\n") == 1
+        assert store.put("/a.py", "r2\n") == 2
+        assert store.revisions("/a.py") == 2
+        assert store.revisions("/b.py") == 0
+        assert store.latest("/a.py") == "r2\n"
+
+    def test_get_old_revision_from_compressed_history(self):
+        store = MemoryStore(cache_bytes=0)
+        for i in range(5):
+            store.put("/src/app.py", SOURCE + str(i))
+        assert store.get("/src/app.py", 1) == SOURCE + "0"
+        assert store.get("/src/app.py", 5) == SOURCE + "4"
+
+    def test_bytes_saved(self):
+        store = MemoryStore()
+        for i in range(10):
+            store.put("/src/app.py", SOURCE + str(i))
+        assert store.raw_bytes >= 3 * store.stored_bytes
+        assert store.stats()["bytes_saved"] == store.raw_bytes - store.stored_bytes
+
+    def test_incompressible_revision_kept_raw(self):
+        store = MemoryStore()
+        store.put("/x", "a")
+        store.put("/x", "b")
+        assert store.history["/x"] == ["a"]
+        assert store.bytes_saved() == 0
+
+
+class TestDiskStore:
+    def test_reopen(self, tmp_path):
+        store = DiskStore(str(tmp_path))
+        store.put("/a/b.py", "first\n")
+        store.put("/a/b.py", SOURCE)
+        store.put("/c.py", "other\n")
+        store.close()
+
+        store = DiskStore(str(tmp_path))
+        assert store.paths() == ["/a/b.py", "/c.py"]
+        assert store.revisions("/a/b.py") == 2
+        assert store.get("/a/b.py", 1) == "first\n"
+        assert store.latest("/a/b.py") == SOURCE
+        assert "/d.py" not in store
+        assert store.put("/a/b.py", "third\n") == 3
+
+    def test_old_revisions_without_cache(self, tmp_path):
+        store = DiskStore(str(tmp_path), cache_bytes=0)
+        for i in range(20):
+            store.put(f"/f{i % 3}", f"{i}\n")
+        assert [store.get("/f1", r) for r in range(1, 8)] == [f"{i}\n" for i in range(1, 20, 3)]
+        assert store.get("/f2", 6) == "17\n"
+
+    def test_recovers_torn_write(self, tmp_path):
+        store = DiskStore(str(tmp_path))
+        store.put("/a", "a\n")
+        store.close()
+        with open(tmp_path / INDEX_FILE, "ab") as f:
+            f.write(b"\x01\x02\x03")
+        with open(tmp_path / PATHS_FILE, "ab") as f:
+            f.write(b"/partial")
+
+        store = DiskStore(str(tmp_path))
+        assert store.paths() == ["/a"]
+        assert store.put("/b", "b\n") == 1
+        assert store.get("/a", 1) == "a\n"
+
+    def test_rolls_back_heads_past_the_index(self, tmp_path):
+        store = DiskStore(str(tmp_path))
+        store.put("/a", "a1\n")
+        store.put("/a", "a2\n")
+        store.put("/b", "b1\n")
+        store.close()
+        # The disk kept the heads, but only the first revision's record.
+        os.truncate(tmp_path / INDEX_FILE, INDEX_RECORD.size)
+
+        store = DiskStore(str(tmp_path))
+        assert store.paths() == ["/a"]
+        assert store.revisions("/a") == 1 and store.latest("/a") == "a1\n"
+        assert store.put("/a", "a2\n") == 2
+        assert store.put("/b", "b1\n") == 1
+
+    def test_drops_records_of_a_lost_blob(self, tmp_path):
+        store = DiskStore(str(tmp_path))
+        store.put("/a", "a1\n")
+        store.put("/a", SOURCE)
+        store.close()
+        os.truncate(tmp_path / PACK_FILE, len("a1\n"))
+
+        store = DiskStore(str(tmp_path))
+        assert store.revisions("/a") == 1
+        assert os.path.getsize(tmp_path / INDEX_FILE) == INDEX_RECORD.size
+
+    def test_shared_repository(self, tmp_path):
+        writer, reader = DiskStore(str(tmp_path)), DiskStore(str(tmp_path))
+        writer.put("/a", "a1\n")
+        assert "/a" not in reader
+        assert reader.refresh() == ["/a"]
+        writer.put("/a", "a2\n")
+        assert reader.revisions("/a") == 2
+        assert reader.get("/a", 1) == "a1\n"
+        assert reader.put("/a", "a2\n") == 2
+        assert reader.put("/a", "a3\n") == 3
+        assert writer.latest("/a") == "a3\n"
+
+    def test_put_keeps_new_paths_for_refresh(self, tmp_path):
+        ours, other = DiskStore(str(tmp_path)), DiskStore(str(tmp_path))
+        other.put("/a/x.txt", "x\n")
+        ours.put("/b/y.txt", "y\n")
+        assert ours.refresh() == ["/a/x.txt"]
+        assert ours.refresh() == []
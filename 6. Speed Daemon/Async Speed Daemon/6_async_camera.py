@@ -1,12 +1,23 @@
+import argparse
 import asyncio
 import logging
 import sys
 import uuid
-from asyncio import StreamReader, StreamWriter
 from typing import Optional
 
-from async_helpers import Camera, Dispatcher, Sightings, Heartbeat
-from async_protocol import Parser, Serializer, SocketHandler
+from async_helpers import (
+    ENGINE,
+    HEARTBEATS,
+    Camera,
+    Dispatcher,
+    Sightings,
+    open_journal,
+)
+from async_protocol import FrameProtocol, Serializer, SocketHandler, TransportWriter
+from daemon import add_arguments, setup, sync_journal
+from metrics import export_metrics
+from sharding import serve_sharded
+from wal import JournalWriter
 
 logging.basicConfig(
     format=(
@@ -22,89 +33,123 @@ IP, PORT = "10.128.0.2", 9090
 sightings = Sightings()
 
 
-async def handler(reader: StreamReader, writer: StreamWriter):
+async def handler(reader: FrameProtocol, writer: TransportWriter):
     client_uuid = str(uuid.uuid4()).split("-")[0]
     logging.info(
         f"Connected to client @ {writer.get_extra_info('peername')}, referred to as {client_uuid}"
     )
-    parser = Parser()
     serializer = Serializer()
     sock_handler = SocketHandler(reader, writer)
 
     cam_client: Optional[Camera] = None
     disp_client: Optional[Dispatcher] = None
+    dispatch_task: Optional[asyncio.Task] = None
     heartbeat_requested: bool = False
     client_known: bool = False
 
-    while 1:
-        try:
+    try:
+        while 1:
             try:
-                msg_code = await parser.parse_message_type(reader)
+                frames = await reader.read_frames()
             except asyncio.exceptions.IncompleteReadError:
                 logging.error(f"Connection Reset by client : {client_uuid}")
                 await sock_handler.close(client_uuid)
                 break
 
-            if msg_code == 32:  # Plate
-                plate, timestamp = await parser.parse_plate_data(reader)
-                logging.debug(f"Message : {client_uuid} : Sighting @ {plate}/{timestamp}.")
-                if cam_client is None:
-                    raise RuntimeError("Unknown client")
-                road, mile, speed_limit = cam_client.road, cam_client.mile, cam_client.limit
-                await sightings.get_tickets(road, plate, timestamp, mile, speed_limit)
-                await sightings.add_sighting(road, plate, timestamp, mile)
-
-            elif msg_code == 64:  # Want Heartbeat
-                interval = await parser.parse_wantheartbeat_data(reader)
-                logging.info(f"Message : {client_uuid} : WantHeartBeat @ {interval} deciseconds.")
-                if heartbeat_requested:
-                    raise RuntimeError("Heartbeat already requested")
-                if interval > 0:
-                    heartbeat_requested = True
-                    await Heartbeat(reader, writer, interval / 10).send_heartbeat()
-
-            elif msg_code == 128:
-                road, mile, limit = await parser.parse_iamcamera_data(reader)
-                logging.info(f"Message : {client_uuid} : Camera @ {road}/{mile}/{limit}")
-                if client_known:
-                    raise RuntimeError("Client has already identified itself")
-                cam_client = Camera(road, mile, limit)
-                client_known = True
-
-            elif msg_code == 129:
-                roads = await parser.parse_iamdispatcher_data(reader)
-                logging.info(f"Message : {client_uuid} : Dispatcher @ {roads} @ {client_uuid}")
-                if client_known:
-                    raise RuntimeError("Client has already identified itself")
-                disp_client = Dispatcher(writer, roads)
-                client_known = True
-                asyncio.create_task(disp_client.dispatch())
-                logging.info(f"Started dispatching tickets from Dispatcher : {client_uuid}")
-
-            else:
-                raise RuntimeError(f"Unexpected msg_type : {msg_code}")
-
-        except RuntimeError as err:
-            logging.error(err)
-            error_msg = await serializer.serialize_error_data(msg=str(err))
-            await sock_handler.write(error_msg.decode())
-            await sock_handler.close(client_uuid)
-            return
-        except (ConnectionResetError, OSError, asyncio.exceptions.IncompleteReadError) as err:
-            logging.error(err)
-            return
-
-
-async def main():
-    server = await asyncio.start_server(handler, IP, PORT)
-    logging.info(f"Started Camera Server @ {IP}:{PORT}")
+            try:
+                for frame in frames:
+                    msg_code = frame[0]
+                    if msg_code == 32:  # Plate
+                        _, plate, timestamp = frame
+                        logging.debug(f"Message : {client_uuid} : Sighting @ {plate}/{timestamp}.")
+                        if cam_client is None:
+                            raise RuntimeError("Unknown client")
+                        road, mile, limit = cam_client.road, cam_client.mile, cam_client.limit
+                        await sightings.get_tickets(road, plate, timestamp, mile, limit)
+
+                    elif msg_code == 64:  # Want Heartbeat
+                        _, interval = frame
+                        logging.info(
+                            f"Message : {client_uuid} : WantHeartBeat @ {interval} deciseconds."
+                        )
+                        if heartbeat_requested:
+                            raise RuntimeError("Heartbeat already requested")
+                        if interval > 0:
+                            heartbeat_requested = True
+                            HEARTBEATS.add(reader, writer, interval)
+
+                    elif msg_code == 128:
+                        _, road, mile, limit = frame
+                        logging.info(f"Message : {client_uuid} : Camera @ {road}/{mile}/{limit}")
+                        if client_known:
+                            raise RuntimeError("Client has already identified itself")
+                        cam_client = Camera(road, mile, limit)
+                        client_known = True
+
+                    elif msg_code == 129:
+                        _, roads = frame
+                        logging.info(
+                            f"Message : {client_uuid} : Dispatcher @ {roads} @ {client_uuid}"
+                        )
+                        if client_known:
+                            raise RuntimeError("Client has already identified itself")
+                        disp_client = Dispatcher(writer, roads)
+                        client_known = True
+                        dispatch_task = asyncio.create_task(disp_client.dispatch())
+                        logging.info(f"Started dispatching tickets from Dispatcher : {client_uuid}")
+
+                    else:
+                        raise RuntimeError(f"Unexpected msg_type : {msg_code}")
+
+            except RuntimeError as err:
+                logging.error(err)
+                error_msg = await serializer.serialize_error_data(msg=str(err))
+                await sock_handler.write(error_msg.decode())
+                await sock_handler.close(client_uuid)
+                return
+            except (ConnectionResetError, OSError) as err:
+                logging.error(err)
+                return
+    finally:
+        if dispatch_task is not None:
+            dispatch_task.cancel()  # Hands its undelivered tickets to other dispatchers.
+
+
+async def main(
+    ip: str = IP,
+    port: int = PORT,
+    metrics: Optional[str] = None,
+    journal: Optional[JournalWriter] = None,
+):
+    # Frames are decoded straight off the socket's buffer, by FrameProtocol.
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(lambda: FrameProtocol(handler), ip, port)
+    logging.info(f"Started Camera Server @ {ip}:{port}")
 
     async with server:
-        await server.serve_forever()
+        # A failing log stops the server, rather than serving without it.
+        await asyncio.gather(
+            server.serve_forever(), sync_journal(journal), export_metrics(ENGINE, metrics)
+        )
 
 
 if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Speed Daemon server")
+    arg_parser.add_argument(
+        "--shards", type=int, default=0, help="Processes owning the roads, behind a front door"
+    )
+    add_arguments(arg_parser)
+    arg_parser.add_argument("--ip", default=IP)
+    arg_parser.add_argument("--port", type=int, default=PORT)
+    args = arg_parser.parse_args()
+    if args.wal and args.shards:
+        arg_parser.error("--wal doesn't support --shards")
+    setup(ENGINE, args)  # In the front door with --shards, the shards hand it their tickets.
+    journal = open_journal(args.wal) if args.wal else None
     try:
-        asyncio.run(main())
+        if args.shards:
+            serve_sharded(handler, sightings, args.ip, args.port, args.shards, args.metrics)
+        else:
+            asyncio.run(main(args.ip, args.port, args.metrics, journal))
     except KeyboardInterrupt:
         logging.critical("Interrupted, shutting down.")
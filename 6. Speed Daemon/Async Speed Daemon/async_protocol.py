@@ -1,18 +1,8 @@
+import asyncio
 import logging
 import struct
-import sys
-from asyncio import StreamReader, StreamWriter
-from typing import Callable
-
-logging.basicConfig(
-    format=(
-        "%(asctime)s | %(levelname)s | %(name)s |  [%(filename)s:%(lineno)d] | %(threadName)-10s |"
-        " %(message)s"
-    ),
-    datefmt="%Y-%m-%d %H:%M:%S",
-    level="INFO",
-    handlers=[logging.FileHandler("app.log"), logging.StreamHandler(sys.stdout)],
-)
+from asyncio import BaseTransport, Transport
+from typing import Any, Awaitable, Callable, Optional
 
 # Messages types -> Integer message codes. (Can be serialized to their exp values)
 MSG_CODES = {
@@ -31,63 +21,112 @@ U32 = ">I"
 LP_STR: Callable[[int], str] = lambda length: ">" + "B" * length  # Length prefixed str
 
 
-class Parser(object):
-    async def parse_str(self, reader: StreamReader) -> str:
-        length = await self.parse_uint8(reader)
-        data = await self.parse_array_uint(reader, length, U8, bits=8)
-        return "".join(chr(ascii) for ascii in data)
-
-    async def _parse_uint(self, reader: StreamReader, fmt: str, bits: int) -> int:
-        uint = await reader.readexactly(bits // 8)
-        unpacked, *_ = struct.unpack(fmt, uint)
-        return unpacked
-
-    async def parse_uint8(self, reader: StreamReader) -> int:
-        return await self._parse_uint(reader, fmt=U8, bits=8)
-
-    async def parse_uint16(self, reader: StreamReader) -> int:
-        return await self._parse_uint(reader, fmt=U16, bits=16)
-
-    async def parse_uint32(self, reader: StreamReader) -> int:
-        return await self._parse_uint(reader, fmt=U32, bits=32)
-
-    async def parse_array_uint(
-        self, reader: StreamReader, array_length: int, fmt: str, bits: int
-    ) -> list[int]:
-        bytes = array_length * (bits // 8)
-        data = await reader.readexactly(bytes)
-        array_fmt = fmt[0] + fmt[1] * array_length
-        unpacked = struct.unpack(array_fmt, data)
-        return list(map(int, unpacked))
-
-    async def parse_message_type(self, reader: StreamReader) -> int:
-        return await self.parse_uint8(reader)
-
-    # Type : 20
-    async def parse_plate_data(self, reader: StreamReader) -> tuple[str, int]:
-        plate = await self.parse_str(reader)
-        timestamp = await self.parse_uint32(reader)
-
-        return plate, timestamp
-
-    # Type : 40
-    async def parse_wantheartbeat_data(self, reader: StreamReader) -> int:
-        interval = await self.parse_uint32(reader)
-        return interval
-
-    # Type : 80
-    async def parse_iamcamera_data(self, reader: StreamReader) -> tuple[int, int, int]:
-        road = await self.parse_uint16(reader)
-        mile = await self.parse_uint16(reader)
-        limit = await self.parse_uint16(reader)
-        return (road, mile, limit)
-
-    # Type : 81
-    async def parse_iamdispatcher_data(self, reader: StreamReader) -> list[int]:
-        num_roads = await self.parse_uint8(reader)
-        roads = await self.parse_array_uint(reader, num_roads, U16, 16)
-
-        return roads
+Frame = tuple  # (msg_code, *fields), fields in the order they are on the wire.
+PLATE = MSG_CODES["PLATE"]
+TICKET = MSG_CODES["TICKET"]
+WHEARTBEAT = MSG_CODES["WHEARTBEAT"]
+CAMERA = MSG_CODES["CAMERA"]
+DISPATCHER = MSG_CODES["DISPATCHER"]
+U32_STRUCT = struct.Struct(U32)
+CAMERA_STRUCT = struct.Struct(">HHH")  # road, mile, limit
+TICKET_STRUCT = struct.Struct(">HHIHIH")  # road, mile1, timestamp1, mile2, timestamp2, speed
+ROADS_STRUCTS = [struct.Struct(">" + "H" * length) for length in range(256)]
+BUFFER_SIZE = 64 * 1024  # Receive buffer per connection, frames are 512 bytes at most.
+MAX_PENDING_FRAMES = 4096  # Decoded but not handled yet, before reading is paused.
+
+
+class FrameDecoder(object):
+    """
+    Decodes frames in place from a receive buffer, without awaiting per field.
+    The transport reads into get_buffer(), buffer_updated() returns every frame that
+    is complete so far. A partial frame is kept, and moved to the front of the buffer
+    before the next read.
+    """
+
+    def __init__(self, size: int = BUFFER_SIZE):
+        self.buffer = bytearray(size)
+        self.start = 0  # First byte not decoded yet.
+        self.end = 0  # End of the bytes received.
+
+    def get_buffer(self) -> memoryview:
+        if self.start:
+            pending = self.end - self.start
+            self.buffer[:pending] = self.buffer[self.start : self.end]
+            self.start, self.end = 0, pending
+        return memoryview(self.buffer)[self.end :]
+
+    def buffer_updated(self, nbytes: int) -> list[Frame]:
+        self.end += nbytes
+        buffer, pos, end = self.buffer, self.start, self.end
+        frames: list[Frame] = []
+        while pos < end:
+            msg_code = buffer[pos]
+            if msg_code == PLATE:
+                if pos + 2 > end:
+                    break
+                length = buffer[pos + 1]
+                size = 6 + length
+                if pos + size > end:
+                    break
+                plate = buffer[pos + 2 : pos + 2 + length].decode("latin-1")
+                (timestamp,) = U32_STRUCT.unpack_from(buffer, pos + 2 + length)
+                frames.append((msg_code, plate, timestamp))
+            elif msg_code == TICKET:
+                if pos + 2 > end:
+                    break
+                length = buffer[pos + 1]
+                size = 2 + length + TICKET_STRUCT.size
+                if pos + size > end:
+                    break
+                plate = buffer[pos + 2 : pos + 2 + length].decode("latin-1")
+                fields = TICKET_STRUCT.unpack_from(buffer, pos + 2 + length)
+                frames.append((msg_code, plate, *fields))
+            elif msg_code == WHEARTBEAT:
+                size = 5
+                if pos + size > end:
+                    break
+                frames.append((msg_code, *U32_STRUCT.unpack_from(buffer, pos + 1)))
+            elif msg_code == CAMERA:
+                size = 7
+                if pos + size > end:
+                    break
+                frames.append((msg_code, *CAMERA_STRUCT.unpack_from(buffer, pos + 1)))
+            elif msg_code == DISPATCHER:
+                if pos + 2 > end:
+                    break
+                roads = ROADS_STRUCTS[buffer[pos + 1]]
+                size = 2 + roads.size
+                if pos + size > end:
+                    break
+                frames.append((msg_code, list(roads.unpack_from(buffer, pos + 2))))
+            else:
+                # Nothing after an unknown message can be framed, the client gets an error.
+                frames.append((msg_code,))
+                size = end - pos
+            pos += size
+        self.start = pos
+        return frames
+
+    def feed(self, data: bytes) -> list[Frame]:
+        """
+        Decodes bytes that were read some other way.
+        """
+        frames: list[Frame] = []
+        while data:
+            buffer = self.get_buffer()
+            nbytes = min(len(buffer), len(data))
+            buffer[:nbytes] = data[:nbytes]
+            del buffer
+            frames += self.buffer_updated(nbytes)
+            data = data[nbytes:]
+        return frames
+
+
+def encode_ticket(
+    plate: str, road: int, mile1: int, timestamp1: int, mile2: int, timestamp2: int, speed: int
+) -> bytes:
+    head = bytes((TICKET, len(plate))) + plate.encode("latin-1")
+    return head + TICKET_STRUCT.pack(road, mile1, timestamp1, mile2, timestamp2, speed)
 
 
 class Serializer(object):
@@ -151,10 +190,9 @@ class Serializer(object):
 
 
 class SocketHandler(object):
-    def __init__(self, reader: StreamReader, writer: StreamWriter) -> None:
+    def __init__(self, reader: "FrameProtocol", writer: "TransportWriter") -> None:
         self.reader = reader
         self.writer = writer
-        self.p = Parser()
 
     async def write(self, data: str, log: bool = True):
         self.writer.write(data.encode())
@@ -167,3 +205,118 @@ class SocketHandler(object):
         self.writer.write_eof()
         self.writer.close()
         logging.debug(f"Closed connection to client @ {conn}.")
+
+
+class TransportWriter(object):
+    """
+    The parts of StreamWriter the handlers use, over a FrameProtocol's transport.
+    """
+
+    def __init__(self, transport: Transport) -> None:
+        self.transport = transport
+        self.writable = asyncio.Event()  # Cleared while the transport's buffer is full.
+        self.writable.set()
+        self.closed = False
+
+    def write(self, data: bytes):
+        self.transport.write(data)
+
+    async def drain(self):
+        await self.writable.wait()
+        if self.closed:
+            raise ConnectionResetError("Connection lost")
+
+    def write_eof(self):
+        if not self.transport.is_closing() and self.transport.can_write_eof():
+            self.transport.write_eof()
+
+    def close(self):
+        self.transport.close()
+
+    def is_closing(self) -> bool:
+        return self.closed or self.transport.is_closing()
+
+    def get_extra_info(self, name: str, default: Any = None) -> Any:
+        return self.transport.get_extra_info(name, default)
+
+    def connection_lost(self):
+        self.closed = True
+        self.writable.set()
+
+
+class FrameProtocol(asyncio.BufferedProtocol):
+    """
+    Reads straight into a FrameDecoder, and hands the decoded frames to the
+    connection's handler in batches, through read_frames().
+    """
+
+    def __init__(
+        self,
+        handler: Callable[["FrameProtocol", TransportWriter], Awaitable[None]],
+        initial: bytes = b"",
+    ):
+        self.handler = handler
+        self.initial = initial  # Read from the socket before it was handed to us.
+        self.decoder = FrameDecoder()
+        self.frames: list[Frame] = []
+        self.eof = False
+        self.paused = False
+        self.waiter: Optional[asyncio.Future] = None
+        self.transport: Transport
+        self.writer: TransportWriter
+        self.task: asyncio.Task
+
+    def connection_made(self, transport: BaseTransport):
+        self.transport = transport  # type: ignore
+        self.writer = TransportWriter(self.transport)
+        self.task = asyncio.get_running_loop().create_task(self.handler(self, self.writer))
+        if self.initial:
+            self.frames.extend(self.decoder.feed(self.initial))
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.decoder.get_buffer()
+
+    def buffer_updated(self, nbytes: int):
+        self.frames.extend(self.decoder.buffer_updated(nbytes))
+        if len(self.frames) >= MAX_PENDING_FRAMES and not self.paused:
+            self.paused = True  # The handler is behind, let the socket buffer fill up.
+            self.transport.pause_reading()
+        self._wakeup()
+
+    def eof_received(self):
+        self.eof = True
+        self._wakeup()
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self.eof = True
+        self.writer.connection_lost()
+        self._wakeup()
+
+    def pause_writing(self):
+        self.writer.writable.clear()
+
+    def resume_writing(self):
+        self.writer.writable.set()
+
+    def _wakeup(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def at_eof(self) -> bool:
+        return self.eof and not self.frames
+
+    async def read_frames(self) -> list[Frame]:
+        """
+        Returns every frame decoded since the last call, waiting for one if there are
+        none. Raises IncompleteReadError once the client is gone.
+        """
+        while not self.frames:
+            if self.eof:
+                raise asyncio.IncompleteReadError(b"", None)
+            self.waiter = asyncio.get_running_loop().create_future()
+            await self.waiter
+        frames, self.frames = self.frames, []
+        if self.paused:
+            self.paused = False
+            self.transport.resume_reading()
+        return frames
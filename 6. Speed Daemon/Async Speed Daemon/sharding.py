@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import multiprocessing
+import socket
+import sys
+from asyncio import BaseTransport, Transport
+from typing import Awaitable, Callable, Optional
+
+from async_helpers import ENGINE, HEARTBEATS, Sightings, Ticket, route_tickets
+from async_protocol import (
+    CAMERA,
+    WHEARTBEAT,
+    FrameDecoder,
+    FrameProtocol,
+    TransportWriter,
+    encode_ticket,
+)
+from metrics import export_metrics
+
+logging.basicConfig(
+    format=(
+        "%(asctime)s | %(levelname)s | %(name)s |  [%(filename)s:%(lineno)d] | %(threadName)-10s |"
+        " %(message)s"
+    ),
+    datefmt="%Y-%m-%d %H:%M:%S",
+    level="INFO",
+    handlers=[logging.FileHandler("app.log"), logging.StreamHandler(sys.stdout)],
+)
+
+Handler = Callable[[FrameProtocol, TransportWriter], Awaitable[None]]
+HANDOFF_SIZE = 1024 * 1024  # Largest handoff, the bytes read before IAmCamera travel with the socket.
+
+
+class FrontDoorProtocol(asyncio.Protocol):
+    """
+    Reads a new connection until it identifies itself. Cameras are handed to the
+    shard owning their road, with the bytes read so far. Dispatchers, and clients
+    that don't start with IAmCamera, are served by the front door itself.
+    """
+
+    def __init__(self, handler: Handler, handoffs: list[socket.socket]):
+        self.handler = handler
+        self.handoffs = handoffs  # Shard -> its end of the handoff socket.
+        self.decoder = FrameDecoder()
+        self.raw = bytearray()
+        self.heartbeat_requested = False
+        self.done = False  # Handed to a shard, or to a FrameProtocol.
+        self.transport: Transport
+        self.writer: TransportWriter
+
+    def connection_made(self, transport: BaseTransport):
+        self.transport = transport  # type: ignore
+        self.writer = TransportWriter(self.transport)
+
+    def data_received(self, data: bytes):
+        self.raw += data
+        for frame in self.decoder.feed(data):
+            msg_code = frame[0]
+            if msg_code == WHEARTBEAT and not self.heartbeat_requested:
+                # Heartbeats are due before the client identifies, the front door sends
+                # them until the connection changes hands.
+                if frame[1] > 0:
+                    self.heartbeat_requested = True
+                    HEARTBEATS.add(self, self.writer, frame[1])  # type: ignore
+            elif msg_code == CAMERA:
+                self.hand_off(frame[1])
+                return
+            else:
+                self.serve()
+                return
+
+    def hand_off(self, road: int):
+        shard = road % len(self.handoffs)
+        sock = self.transport.get_extra_info("socket")
+        try:
+            socket.send_fds(self.handoffs[shard], [bytes(self.raw)], [sock.fileno()])
+        except OSError as err:
+            logging.error(f"Handoff to shard {shard} failed, serving camera locally : {err}")
+            self.serve()
+            return
+        # The shard holds its own copy of the socket now, closing ours doesn't end the connection.
+        self.done = True
+        self.transport.abort()
+
+    def serve(self):
+        protocol = FrameProtocol(self.handler, initial=bytes(self.raw))
+        self.done = True
+        self.transport.set_protocol(protocol)
+        protocol.connection_made(self.transport)
+
+    def eof_received(self):
+        self.done = True
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self.done = True
+        self.writer.connection_lost()
+
+    def at_eof(self) -> bool:
+        return self.done
+
+
+async def relay_handler(reader: FrameProtocol, writer: TransportWriter):
+    # Tickets a shard found, claimed against the front door's ticketed days.
+    while 1:
+        try:
+            frames = await reader.read_frames()
+        except asyncio.exceptions.IncompleteReadError:
+            logging.critical("Shard is gone.")
+            return
+        route_tickets([Ticket(*fields) for _, *fields in frames])
+
+
+async def front_door(
+    handler: Handler,
+    handoffs: list[socket.socket],
+    relays: list[socket.socket],
+    ip: str,
+    port: int,
+    metrics: Optional[str],
+):
+    loop = asyncio.get_running_loop()
+    for relay in relays:
+        await loop.connect_accepted_socket(lambda: FrameProtocol(relay_handler), relay)
+    server = await loop.create_server(lambda: FrontDoorProtocol(handler, handoffs), ip, port)
+    logging.info(f"Started Camera Server @ {ip}:{port} with {len(handoffs)} shards")
+
+    async with server:
+        await asyncio.gather(server.serve_forever(), export_metrics(ENGINE, metrics))
+
+
+async def shard(handler: Handler, sightings: Sightings, handoff: socket.socket, relay: socket.socket):
+    loop = asyncio.get_running_loop()
+    relay_transport, _ = await loop.connect_accepted_socket(asyncio.Protocol, relay)
+
+    def relay_tickets(tickets: list[Ticket]):
+        relay_transport.write(b"".join(encode_ticket(*ticket.fields()) for ticket in tickets))
+
+    sightings.relay = relay_tickets
+    closed = loop.create_future()
+
+    def accept_handoff():
+        try:
+            data, fds, _, _ = socket.recv_fds(handoff, HANDOFF_SIZE, 1)
+        except BlockingIOError:
+            return
+        if not fds:  # The front door is gone.
+            loop.remove_reader(handoff.fileno())
+            closed.set_result(None)
+            return
+        sock = socket.socket(fileno=fds[0])
+        loop.create_task(
+            loop.connect_accepted_socket(lambda: FrameProtocol(handler, initial=data), sock)
+        )
+
+    handoff.setblocking(False)
+    loop.add_reader(handoff.fileno(), accept_handoff)
+    await closed
+
+
+def run_shard(
+    handler: Handler,
+    sightings: Sightings,
+    handoff: socket.socket,
+    relay: socket.socket,
+    inherited: list[socket.socket],
+):
+    # The front door's ends, so the shard sees EOF once the front door exits.
+    for sock in inherited:
+        sock.close()
+    try:
+        asyncio.run(shard(handler, sightings, handoff, relay))
+    except KeyboardInterrupt:
+        pass
+
+
+def serve_sharded(
+    handler: Handler,
+    sightings: Sightings,
+    ip: str,
+    port: int,
+    shards: int,
+    metrics: Optional[str] = None,
+):
+    """
+    Runs `shards` processes, each owning the sightings of the roads equal to its index
+    modulo `shards`, behind a front door process that accepts every connection. The
+    front door keeps the ticketed days and the dispatchers, shards relay their tickets
+    to it over a socket, so a plate is still ticketed once per day across all roads.
+    The front door exports the metrics, the tickets' latencies are measured from the
+    relay.
+    """
+    context = multiprocessing.get_context("fork")
+    handoffs: list[socket.socket] = []
+    relays: list[socket.socket] = []
+    for _ in range(shards):
+        handoff, shard_handoff = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        for sock in (handoff, shard_handoff):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, HANDOFF_SIZE)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, HANDOFF_SIZE)
+        relay, shard_relay = socket.socketpair()
+        handoffs.append(handoff)
+        relays.append(relay)
+        context.Process(
+            target=run_shard,
+            args=(handler, sightings, shard_handoff, shard_relay, handoffs + relays),
+            daemon=True,
+        ).start()
+        shard_handoff.close()
+        shard_relay.close()
+
+    asyncio.run(front_door(handler, handoffs, relays, ip, port, metrics))
@@ -0,0 +1,49 @@
+import struct
+import sys
+
+sys.modules.pop("async_protocol", None)  # 11. Pest Control has one too, pytest collects both.
+from async_protocol import FrameDecoder, encode_ticket  # noqa: E402
+
+PLATE = b"\x20\x04UN1X" + struct.pack(">I", 1000)
+CAMERA = b"\x80" + struct.pack(">HHH", 66, 100, 60)
+DISPATCHER = b"\x81\x03" + struct.pack(">HHH", 66, 368, 5000)
+WHEARTBEAT = b"\x40" + struct.pack(">I", 10)
+TICKET = encode_ticket("RE05BKG", 368, 1234, 1000000, 1235, 1000060, 6000)
+STREAM = CAMERA + WHEARTBEAT + PLATE + DISPATCHER + TICKET + PLATE
+FRAMES = [
+    (0x80, 66, 100, 60),
+    (0x40, 10),
+    (0x20, "UN1X", 1000),
+    (0x81, [66, 368, 5000]),
+    (0x21, "RE05BKG", 368, 1234, 1000000, 1235, 1000060, 6000),
+    (0x20, "UN1X", 1000),
+]
+
+
+class TestFrameDecoder:
+    def test_frames_in_one_chunk(self):
+        decoder = FrameDecoder()
+        assert decoder.feed(STREAM) == FRAMES
+        assert decoder.start == decoder.end
+
+    def test_split_at_every_byte(self):
+        for split in range(len(STREAM) + 1):
+            decoder = FrameDecoder()
+            assert decoder.feed(STREAM[:split]) + decoder.feed(STREAM[split:]) == FRAMES, split
+
+    def test_byte_at_a_time(self):
+        decoder = FrameDecoder()
+        frames = []
+        for i in range(len(STREAM)):
+            frames += decoder.feed(STREAM[i : i + 1])
+        assert frames == FRAMES
+
+    def test_partial_frame_moved_to_the_front(self):
+        # A buffer smaller than the stream, partial frames wrap around it.
+        decoder = FrameDecoder(size=32)
+        assert decoder.feed(STREAM * 20) == FRAMES * 20
+
+    def test_unknown_message_code(self):
+        decoder = FrameDecoder()
+        assert decoder.feed(CAMERA + b"\x99" + PLATE) == [FRAMES[0], (0x99,)]
+        assert decoder.start == decoder.end  # Nothing after it is framed.
@@ -1,22 +1,20 @@
+import argparse
 import logging
+import selectors
 import socket
 import sys
 import threading
-import time
 import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import SimpleQueue
+from typing import Optional
 
 from errors import ProtocolError
 from heartbeat import heartbeat_deregister_client, heartbeat_register_client, heartbeat_thread
-from helpers import (
-    CAMERAS,
-    DISPATCHERS,
-    Camera,
-    Dispatcher,
-    Sightings,
-    ticket_dispatcher_thread,
-    tickets_lock,
-)
+from helpers import CAMERAS, ENGINE, Camera, Dispatcher, Sightings, metrics_thread, open_journal
 from protocol import Parser, Serializer, SocketHandler
+from daemon import add_arguments, setup
 
 logging.basicConfig(
     format=(
@@ -29,86 +27,237 @@ logging.basicConfig(
 )
 
 IP, PORT = "10.128.0.2", 9090
+RECV_SIZE = 64 * 1024  # Bytes read from a client at once, in reactor mode.
+BATCHES_PER_WORKER = 2  # In the pool at once, past that cameras wait to be read again.
 parser = Parser()
 serializer = Serializer()
 sock_handler = SocketHandler()
 sightings = Sightings()
+SightingData = tuple[int, str, int, int, int]  # road, plate, timestamp, mile, speed_limit
+
+
+class Session(object):
+    """
+    What a client has told us so far. Shared by the thread per client and the reactor.
+    """
+
+    def __init__(self, conn: socket.socket, client_uuid: str):
+        self.conn = conn
+        self.client_uuid = client_uuid
+        self.client_type_known = self.heartbeat_requested = False
+        self.cam_client: Optional[Camera] = None
+        self.disp_client: Optional[Dispatcher] = None
+
+    def handle_message(self, msg_type: str, data: bytes) -> Optional[SightingData]:
+        """
+        Returns the (road, plate, timestamp, mile, speed_limit) of a sighting, for the
+        caller to compute its tickets.
+        """
+        if msg_type == "20":
+            plate, timestamp, _ = parser.parse_plate_data(data)
+            if not self.client_type_known or self.cam_client is None:
+                raise RuntimeError("Client unknown")
+            cam_client = self.cam_client
+            return cam_client.road, plate, timestamp, cam_client.mile, cam_client.limit
+
+        elif msg_type == "40":
+            interval, _ = parser.parse_wantheartbeat_data(data)
+            logging.info(f"Message : WantHeartBeat @ {interval/10} seconds.")
+            if self.heartbeat_requested:
+                raise RuntimeError("Heartbeat already requested")
+            if interval > 0:
+                heartbeat_register_client(self.client_uuid, self.conn, interval / 10)
+            self.heartbeat_requested = True
+
+        elif msg_type == "80":
+            road, mile, limit, _ = parser.parse_iamcamera_data(data)
+            logging.debug(f"Message : Camera @ {road}/{mile}/{limit}")
+            if self.client_type_known:
+                raise RuntimeError("Client has already identified itself")
+            self.cam_client = Camera(self.conn, road, mile, limit)
+            CAMERAS[road].append(self.cam_client)
+            self.client_type_known = True
+
+        elif msg_type == "81":
+            roads, _ = parser.parse_iamdispatcher_data(data)
+            logging.debug(f"Message : Dispatcher @ {roads}")
+            if self.client_type_known:
+                raise RuntimeError("Client has already identified itself")
+            self.disp_client = Dispatcher(self.conn, roads)
+            self.disp_client.start()
+            self.client_type_known = True
+
+        else:
+            raise RuntimeError("Unknown message type")
+        return None
+
+    def reject(self):
+        err = serializer.serialize_error_data(msg="Unknown message type")
+        sock_handler.send_data(self.conn, err)
+
+    def close(self):
+        heartbeat_deregister_client(self.client_uuid)
+        if self.disp_client is not None:
+            self.disp_client.stop()
+        self.conn.close()
+
+
+def record_sightings(batch: list[SightingData]):
+    try:
+        for road, plate, timestamp, mile, speed_limit in batch:
+            sightings.get_tickets(road, plate, timestamp, mile, speed_limit)
+    except Exception:
+        logging.exception("Failed to record sightings")
 
 
 def handler(conn: socket.socket, addr: socket.AddressFamily, client_uuid: str):
     logging.info(f"Connected to client @ {addr}")
-    client_type_known = heartbeat_requested = False
-    cam_client = disp_client = None
+    session = Session(conn, client_uuid)
     while 1:
         try:
             msg_type, data = sock_handler.read_data(conn)
             logging.debug(f"Req : {msg_type} : {data} as hex : {data.hex()}")
-
-            if msg_type == "20":
-                plate, timestamp, _ = parser.parse_plate_data(data)
-                if not client_type_known or cam_client is None:
-                    raise RuntimeError("Client unknown")
-                road, mile = cam_client.road, cam_client.mile
-                speed_limit = cam_client.limit
-                with tickets_lock:
-                    sightings.get_tickets(road, plate, timestamp, mile, speed_limit)
-                    sightings.add_sighting(road, plate, timestamp, mile)
-            elif msg_type == "40":
-                interval, _ = parser.parse_wantheartbeat_data(data)
-                logging.info(f"Message : WantHeartBeat @ {interval/10} seconds.")
-                if heartbeat_requested:
-                    raise RuntimeError("Heartbeat already requested")
-                if interval > 0:
-                    heartbeat_register_client(client_uuid, conn, interval / 10)
-                heartbeat_requested = True
-
-            elif msg_type == "80":
-                road, mile, limit, _ = parser.parse_iamcamera_data(data)
-                logging.debug(f"Message : Camera @ {road}/{mile}/{limit}")
-                if client_type_known:
-                    raise RuntimeError("Client has already identified itself")
-                cam_client = Camera(conn, road, mile, limit)
-                CAMERAS[road].append(cam_client)
-                client_type_known = True
-
-            elif msg_type == "81":
-                roads, _ = parser.parse_iamdispatcher_data(data)
-                logging.debug(f"Message : Dispatcher @ {roads}")
-                if client_type_known:
-                    raise RuntimeError("Client has already identified itself")
-                disp_client = Dispatcher(conn, roads)
-                for road in roads:
-                    DISPATCHERS[road].append(disp_client)
-                client_type_known = True
-
-            else:
-                raise RuntimeError("Unknown message type")
+            sighting = session.handle_message(msg_type, data)
+            if sighting is not None:
+                record_sightings([sighting])
         except (ConnectionResetError, OSError) as err:
             logging.error(err)
-            heartbeat_deregister_client(client_uuid)
-            conn.close()
+            session.close()
             return
         except RuntimeError as err:
             logging.error(err)
-            heartbeat_deregister_client(client_uuid)
-            err = serializer.serialize_error_data(msg="Unknown message type")
-            sock_handler.send_data(conn, err)
-            conn.close()
+            session.reject()
+            session.close()
             return
         except ProtocolError as err:
             logging.error(err)
-            conn.close()
+            session.close()
+            return
+
+
+class Reactor(object):
+    """
+    Serves every client from one selector loop. Whatever a read brings in is framed
+    at once, and its sightings go to the worker pool as a single batch, so a camera
+    is only limited by how fast the workers compute tickets. Dispatchers still get
+    their writer thread, and heartbeats their own.
+
+    A connection isn't read again until its batch is computed, so its sightings stay
+    in order, and the pool takes `workers` * BATCHES_PER_WORKER batches at once. The
+    batches past that wait here, one per connection at most, and a camera faster than
+    the workers is held back by its socket's buffer.
+    """
+
+    def __init__(self, server_socket: socket.socket, workers: int):
+        self.server_socket = server_socket
+        self.selector = selectors.DefaultSelector()
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="Tickets")
+        self.buffers: dict[socket.socket, bytearray] = {}
+        self.max_in_flight = workers * BATCHES_PER_WORKER
+        self.in_flight = 0  # Batches in the pool.
+        self.waiting: deque[tuple[Session, list[SightingData]]] = deque()  # For the pool.
+        self.computed: SimpleQueue[Session] = SimpleQueue()  # Put by the workers.
+        self.wakeup, self.notify = socket.socketpair()  # The workers wake the loop up with it.
+        self.wakeup.setblocking(False)
+        self.notify.setblocking(False)
+
+    def serve_forever(self):
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        while True:
+            for key, _ in self.selector.select():
+                if key.fileobj is self.server_socket:
+                    self.accept()
+                elif key.fileobj is self.wakeup:
+                    self.resume()
+                else:
+                    self.read(key.data)
+
+    def accept(self):
+        conn, addr = self.server_socket.accept()
+        logging.info(f"Connected to client @ {addr}")
+        session = Session(conn, str(uuid.uuid4()))
+        self.buffers[conn] = bytearray()
+        self.selector.register(conn, selectors.EVENT_READ, session)
+
+    def read(self, session: Session):
+        conn = session.conn
+        try:
+            chunk = conn.recv(RECV_SIZE)
+        except OSError as err:
+            logging.error(err)
+            chunk = b""
+        if not chunk:
+            self.close(session)
             return
-        time.sleep(1)  # Give other threads a chance.
+
+        buffer = self.buffers[conn]
+        buffer += chunk
+        batch: list[SightingData] = []
+        try:
+            for msg_type, data in sock_handler.split_frames(buffer):
+                sighting = session.handle_message(msg_type, data)
+                if sighting is not None:
+                    batch.append(sighting)
+        except (RuntimeError, ProtocolError) as err:
+            logging.error(err)
+            if isinstance(err, RuntimeError):
+                session.reject()
+            self.close(session)
+        if batch:
+            if conn in self.buffers:
+                self.selector.unregister(conn)  # Until the batch is computed.
+            self.submit(session, batch)
+
+    def submit(self, session: Session, batch: list[SightingData]):
+        if self.in_flight >= self.max_in_flight:
+            self.waiting.append((session, batch))
+            return
+        self.in_flight += 1
+        self.pool.submit(self.compute, session, batch)
+
+    def compute(self, session: Session, batch: list[SightingData]):
+        # In a worker.
+        record_sightings(batch)
+        self.computed.put(session)
+        try:
+            self.notify.send(b"\0")
+        except BlockingIOError:
+            pass  # The loop has wakeups to read already.
+
+    def resume(self):
+        """
+        Reads the connections whose batch is computed again, and hands the pool the
+        batches waiting for it.
+        """
+        try:
+            self.wakeup.recv(RECV_SIZE)
+        except BlockingIOError:
+            pass
+        while not self.computed.empty():
+            session = self.computed.get()
+            self.in_flight -= 1
+            if session.conn in self.buffers:
+                self.selector.register(session.conn, selectors.EVENT_READ, session)
+        while self.waiting and self.in_flight < self.max_in_flight:
+            self.submit(*self.waiting.popleft())
+
+    def close(self, session: Session):
+        self.selector.unregister(session.conn)
+        self.buffers.pop(session.conn, None)
+        session.close()
 
 
-def main():
-    server_socket = socket.create_server((IP, PORT), reuse_port=True)
-    logging.info(f"Started Server @ {IP}")
+def main(
+    reactor: bool, workers: int, ip: str = IP, port: int = PORT, metrics: Optional[str] = None
+):
+    server_socket = socket.create_server((ip, port), reuse_port=True)
+    logging.info(f"Started Server @ {ip}")
     threading.Thread(target=heartbeat_thread, daemon=True).start()
-    threading.Thread(target=ticket_dispatcher_thread, daemon=True).start()
-    threading.Thread(target=ticket_dispatcher_thread, daemon=True).start()
-    threading.Thread(target=ticket_dispatcher_thread, daemon=True).start()
+    if metrics:
+        threading.Thread(target=metrics_thread, args=(metrics,), daemon=True).start()
+    if reactor:
+        Reactor(server_socket, workers).serve_forever()
     while True:
         conn, addr = server_socket.accept()
         # conn.settimeout(10)  # Set timeout for connection to 10 seconds.
@@ -117,4 +266,18 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    arg_parser = argparse.ArgumentParser(description="Multithreaded Speed Daemon server")
+    arg_parser.add_argument(
+        "--reactor", action="store_true", help="Serve all clients from one selector loop"
+    )
+    arg_parser.add_argument(
+        "--workers", type=int, default=4, help="Threads computing tickets, with --reactor"
+    )
+    add_arguments(arg_parser)
+    arg_parser.add_argument("--ip", default=IP)
+    arg_parser.add_argument("--port", type=int, default=PORT)
+    args = arg_parser.parse_args()
+    setup(ENGINE, args)
+    if args.wal:
+        open_journal(args.wal)
+    main(args.reactor, args.workers, args.ip, args.port, args.metrics)
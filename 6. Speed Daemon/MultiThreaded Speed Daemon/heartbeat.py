@@ -1,10 +1,12 @@
+import heapq
+import itertools
 import logging
 import socket
 import sys
-from threading import Lock
 import time
+from threading import Condition
 
-from protocol import Serializer, SocketHandler
+from protocol import Serializer
 
 logging.basicConfig(
     format=(
@@ -18,56 +20,77 @@ logging.basicConfig(
 
 
 heartbeat_clients: dict[str, "Heartbeat"] = {}  # client_uuid -> Heartbeat object
-heartbeat_clients_lock = Lock()
+heartbeat_schedule: list[tuple[float, int, str, "Heartbeat"]] = []
+# Heap of (deadline, seq, client_uuid, Heartbeat), entries of deregistered clients are skipped.
+heartbeat_clients_lock = Condition()  # Notified when a client registers.
+heartbeat_seq = itertools.count()  # Tie breaker, Heartbeats don't compare.
 
 
 class Heartbeat(object):
     def __init__(self, conn: socket.socket, interval: float):
         self.serializer = Serializer()
-        self.sock_handler = SocketHandler()
         self.msg = self.generate_heartbeat()
         self.conn = conn
         self.interval = interval  # second
-        self.elapsed = 0
 
     def send_heartbeat(self):
-        self.sock_handler.send_data(self.conn, self.msg)
+        # Never blocks the other heartbeats, a client that doesn't read just misses one.
+        try:
+            self.conn.send(self.msg, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            pass
 
     def generate_heartbeat(self) -> bytes:
         return self.serializer.serialize_heartbeat_data()
 
-    def ticktock(self, uuid: str, sleep_interval: float = 0.5):
-        # logging.debug(f"Ticktock : {self.elapsed}")
-        self.elapsed += sleep_interval
-        if self.elapsed == self.interval:
-            self.elapsed = 0
-            logging.info(f"Sending heartbeat to : {uuid}")
-            self.send_heartbeat()
+
+def schedule_heartbeat(client_uuid: str, client: Heartbeat, deadline: float):
+    heapq.heappush(heartbeat_schedule, (deadline, next(heartbeat_seq), client_uuid, client))
 
 
 def heartbeat_register_client(client_uuid: str, conn: socket.socket, interval: float):
-    # interval is in deciseconds
+    # interval is in seconds
     logging.info(f"Registering new client : {client_uuid} for Heartbeat.")
-    heartbeat_clients[client_uuid] = Heartbeat(conn, interval)
+    client = Heartbeat(conn, interval)
+    with heartbeat_clients_lock:
+        heartbeat_clients[client_uuid] = client
+        schedule_heartbeat(client_uuid, client, time.monotonic() + interval)
+        heartbeat_clients_lock.notify()
 
 
 def heartbeat_deregister_client(client_uuid: str):
     logging.info(f"Deregistering client : {client_uuid} from Heartbeat.")
-    if client_uuid in heartbeat_clients:
-        heartbeat_clients.pop(client_uuid)
+    with heartbeat_clients_lock:
+        heartbeat_clients.pop(client_uuid, None)
 
 
 def heartbeat_thread():
-    sleep_interval = 0.5  # 5 decisecond
-
+    """
+    Sleeps until the earliest deadline, then sends every heartbeat that is due outside
+    the lock. The next deadline is counted from the last one, not from when it was
+    sent, so heartbeats don't drift.
+    """
     while 1:
+        due: list[tuple[str, Heartbeat]] = []
         with heartbeat_clients_lock:
+            while not due:
+                now = time.monotonic()
+                while heartbeat_schedule and heartbeat_schedule[0][0] <= now:
+                    deadline, _, client_uuid, client = heapq.heappop(heartbeat_schedule)
+                    if heartbeat_clients.get(client_uuid) is not client:
+                        continue  # Deregistered.
+                    due.append((client_uuid, client))
+                    deadline += client.interval
+                    if deadline <= now:
+                        deadline = now + client.interval  # Too far behind, skip the missed ones.
+                    schedule_heartbeat(client_uuid, client, deadline)
+                if not due:
+                    timeout = heartbeat_schedule[0][0] - now if heartbeat_schedule else None
+                    heartbeat_clients_lock.wait(timeout)
+
+        for client_uuid, client in due:
             try:
-                for client in heartbeat_clients:
-                    # logging.debug(f"Ticking client : {client}")
-                    heartbeat_clients[client].ticktock(uuid=client)
-            except (ConnectionResetError, OSError) as err:
-                logging.error(err)
-                heartbeat_deregister_client(client)
-
-        time.sleep(sleep_interval)
+                client.send_heartbeat()
+            except OSError as err:
+                logging.error(f"Heartbeat to {client_uuid} : {err}")
+                heartbeat_deregister_client(client_uuid)
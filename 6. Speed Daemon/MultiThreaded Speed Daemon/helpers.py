@@ -1,13 +1,24 @@
-import bisect
+import itertools
 import logging
+import os
 import socket
 import sys
+import threading
 import time
 from collections import defaultdict
 from threading import Lock
+from typing import Optional
 
 from protocol import Parser, Serializer, SocketHandler
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from daemon import delivered  # noqa: E402  Shared with the other servers.
+from daemon import open_journal as replay_journal  # noqa: E402
+from daemon import wake_dispatchers  # noqa: E402
+from engine import COMPACT_EVERY, Engine, Ticket  # noqa: E402
+from metrics import METRICS_INTERVAL, render_metrics, write_metrics  # noqa: E402
+from wal import JournalWriter  # noqa: E402
+
 logging.basicConfig(
     format=(
         "%(asctime)s | %(levelname)s | %(name)s |  [%(filename)s:%(lineno)d] | %(threadName)-10s |"
@@ -19,13 +30,9 @@ logging.basicConfig(
 )
 
 CAMERAS: dict[int, list["Camera"]] = defaultdict(list)  # Road -> [Camera]
-DISPATCHERS: dict[int, list["Dispatcher"]] = defaultdict(list)  # Road -> [Dispatcher]
-SIGHTINGS: dict[int, dict[str, list[tuple[int, int]]]] = defaultdict(
-    lambda: defaultdict(list)
-)  # Road -> {Plate -> [Time, Mile]}
-TICKETS: set["Ticket"] = set()
-TICKETS_SERVED: dict[str, set[int]] = defaultdict(set)  # plate -> [day]
-tickets_lock = Lock()
+dispatchers_lock = Lock()  # ENGINE's dispatchers and the tickets waiting for them.
+days_lock = Lock()  # ENGINE's ticketed days, claimed from every stripe.
+LOCK_STRIPES = 16  # Sighting stores, each behind its own lock. A road always maps to the same.
 
 
 parser = Parser()
@@ -53,55 +60,105 @@ class Dispatcher(object):
         self.conn = conn
         self.num_roads = len(roads)
         self.roads = roads
+        self.wakeup = threading.Event()  # Set when its roads get tickets.
+        self.alive = True
 
     def __str__(self):
         return f"Dispatcher@{id(self)}"
 
-    def dispatch_ticket(self, ticket: "Ticket"):
-        p, r, m1, t1, m2, t2, s = (
-            ticket.plate,
-            ticket.road,
-            ticket.mile1,
-            ticket.timestamp1,
-            ticket.mile2,
-            ticket.timestamp2,
-            ticket.speed,
-        )
-        ticket_object = serializer.serialize_ticket_data(p, r, m1, t1, m2, t2, s)
-        logging.critical(f"Dispatching ticket : {ticket.print_ticket()}")
-        sock_handler.send_data(self.conn, ticket_object)
-
-
-class Ticket(object):
-    def __init__(
-        self,
-        plate: str,
-        road: int,
-        mile1: int,
-        timestamp1: int,
-        mile2: int,
-        timestamp2: int,
-        speed: int,
-    ) -> None:
-        self.plate = plate
-        self.road = road
-        self.mile1 = mile1
-        self.timestamp1 = timestamp1
-        self.mile2 = mile2
-        self.timestamp2 = timestamp2
-        self.speed = speed
-
-    def print_ticket(self):
-        return (
-            f"Ticket for {self.plate} on {self.road} between {self.mile1, self.timestamp1} and"
-            f" {self.mile2, self.timestamp2}"
-        )
-
-    def get_day1(self) -> int:
-        return self.timestamp1 // 86400
-
-    def get_day2(self) -> int:
-        return self.timestamp2 // 86400
+    def start(self):
+        with dispatchers_lock:
+            ENGINE.register_dispatcher(self, self.roads)
+        threading.Thread(target=self.writer_thread, daemon=True).start()
+
+    def dispatch_ticket(self, ticket: Ticket):
+        ticket_object = serializer.serialize_ticket_data(*ticket.fields())
+        logging.critical(f"Dispatching ticket : {ticket}")
+        self.conn.sendall(ticket_object)
+
+    def writer_thread(self):
+        # The only thread writing tickets to this dispatcher, as daemon.write_tickets().
+        while self.alive:
+            with dispatchers_lock:
+                tickets = ENGINE.poll_tickets(self)
+            if not tickets:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+            for idx, ticket in enumerate(tickets):
+                try:
+                    self.dispatch_ticket(ticket)
+                    with dispatchers_lock:
+                        delivered(ENGINE, JOURNAL, (ticket,))
+                except OSError as err:
+                    logging.error(f"{self} : {err}")
+                    self.stop()
+                    requeue_tickets(tickets[idx:])
+                    return
+
+    def stop(self):
+        """
+        Deregisters the dispatcher, the writer puts back what it couldn't write.
+        """
+        with dispatchers_lock:
+            if not self.alive:
+                return
+            self.alive = False
+            wake_dispatchers(ENGINE, ENGINE.unregister_dispatcher(self))
+        self.wakeup.set()  # Wake the writer up, if it's still waiting.
+
+
+def requeue_tickets(tickets: list[Ticket]):
+    with dispatchers_lock:
+        wake_dispatchers(ENGINE, ENGINE.requeue(tickets))  # Next dispatcher on the road.
+
+
+def release_tickets(tickets: list[Ticket]):
+    with dispatchers_lock:
+        wake_dispatchers(ENGINE, ENGINE.enqueue(tickets))
+
+
+ENGINE = Engine(stripes=LOCK_STRIPES)  # Sightings, ticketed days, and tickets waiting.
+JOURNAL: Optional[JournalWriter] = None  # Set by open_journal(), when the server runs with a log.
+sightings_locks = [Lock() for _ in range(LOCK_STRIPES)]  # Road % LOCK_STRIPES -> lock
+inserted_count = itertools.count(1)  # Sightings added to any stripe, next() is atomic.
+
+
+def metrics_thread(path: str):
+    while True:
+        time.sleep(METRICS_INTERVAL)
+        with dispatchers_lock:
+            text = render_metrics(ENGINE)
+        write_metrics(text, path)
+
+
+def open_journal(wal_dir: str):
+    """
+    Replays the log in `wal_dir` into the engine, and logs to it from now on, with a
+    thread of its own syncing it.
+    """
+    global JOURNAL
+    JOURNAL, stats = replay_journal(ENGINE, wal_dir, release_tickets, locks=sightings_locks)
+    threading.Thread(target=JOURNAL.run_forever, daemon=True).start()
+    logging.info(f"Replayed log @ {wal_dir} : {stats}")
+
+
+def compact_sightings():
+    """
+    Compacts the stripes one at a time, so the others keep taking sightings. Every
+    stripe is first moved up to the newest timestamp seen on any road, so that once
+    they are all compacted no stripe can pair a sighting from before the cutoff,
+    and the ticketed days before it can be forgotten.
+    """
+    newest = ENGINE.newest()
+    for stripe, lock in enumerate(sightings_locks):
+        with lock, days_lock:
+            ENGINE.compact_stripe(stripe, newest)
+    with days_lock:
+        ENGINE.forget_days(newest)
+    logging.info(f"Compacted sightings : {ENGINE.stats()}")
+    if JOURNAL is not None:
+        JOURNAL.snapshot_due = True
 
 
 class Sightings(object):
@@ -111,73 +168,26 @@ class Sightings(object):
     def __str__(self):
         return f"Dispatcher@{id(self)}"
 
-    def add_sighting(self, road: int, plate: str, timestamp: int, mile: int):
-        # Add sighting to datastore only after checking for possible tickets.
-        entry = tuple((timestamp, mile))
-        # with tickets_lock:
-        logging.info(f"Add sighting for {plate} @ {entry} on road {road}")
-        bisect.insort(SIGHTINGS[road][plate], entry, key=lambda item: item[0])
-
-    def _get_closest_sightings(
-        self, road: int, plate: str, timestamp: int
-    ) -> list[tuple[int, int]]:
-        logging.info(f"Looking for closest sightings for {plate},{timestamp} on {road}")
-        # with tickets_lock:
-        idx = bisect.bisect(SIGHTINGS[road][plate], timestamp, key=lambda item: item[0])
-        entries: list[tuple[int, int]] = []
-        arr = SIGHTINGS[road][plate]
-        if idx >= 0 and idx < len(arr):
-            entries.append(arr[idx])
-        if idx > 0:
-            entries.append(arr[idx - 1])
-        if idx < len(arr) - 1:
-            entries.append(arr[idx + 1])
-        logging.info(f"Found sightings : {entries}")
-        return entries
-
-    def _compute_speed(self, timestamp1: int, mile1: int, timestamp2: int, mile2: int):
-        dist = mile2 - mile1  # miles
-        time = (timestamp2 - timestamp1) / 60 / 60  # hour
-        speed = dist / time  # mph
-        return abs(round(speed, 2))
-
     def get_tickets(self, road: int, plate: str, timestamp: int, mile: int, speed_limit: int):
-        # entries = self._get_closest_sightings(road, plate, timestamp)
-        entries = SIGHTINGS[road][plate]
-        for sighting in entries:
-            _timestamp, _mile = sighting
-            if _timestamp < timestamp:
-                timestamp1, mile1, timestamp2, mile2 = _timestamp, _mile, timestamp, mile
-            else:
-                timestamp1, mile1, timestamp2, mile2 = timestamp, mile, _timestamp, _mile
-
-            _speed = self._compute_speed(timestamp1, mile1, timestamp2, mile2)
-            if _speed > speed_limit:
-                speed = int(_speed * 100)
-
-                tix = Ticket(plate, road, mile1, timestamp1, mile2, timestamp2, speed)
-                logging.info(f"New ticket created : {tix.print_ticket()}")
-                TICKETS.add(tix)
-
-
-def ticket_dispatcher_thread():
-    sleep_interval = 5  # 5 seconds
-
-    while 1:
-        served: set[Ticket] = set()
-        with tickets_lock:
-            for ticket in TICKETS:
-                day1, day2 = ticket.get_day1(), ticket.get_day2()
-                if day1 in TICKETS_SERVED[ticket.plate] or day2 in TICKETS_SERVED[ticket.plate]:
-                    served.add(ticket)
-                    continue
-                road = ticket.road
-                if road in DISPATCHERS:
-                    dispatcher = DISPATCHERS[road][0]
-                    dispatcher.dispatch_ticket(ticket)
-                    served.add(ticket)
-                    TICKETS_SERVED[ticket.plate].add(ticket.get_day1())
-                    TICKETS_SERVED[ticket.plate].add(ticket.get_day2())
-        for served_ticket in served:
-            TICKETS.remove(served_ticket)
-        time.sleep(sleep_interval)
+        # Adds the sighting, then checks it against its neighbours. Only the road's stripe
+        # is locked, cameras on other roads carry on.
+        logging.info(f"Add sighting for {plate} @ {timestamp, mile} on road {road}")
+        with sightings_locks[road % LOCK_STRIPES]:
+            tickets = ENGINE.check(road, mile, speed_limit, plate, timestamp)
+            if tickets:
+                # Days are claimed when the ticket is created, dispatchers only deliver.
+                with days_lock:
+                    tickets = ENGINE.claim(tickets)
+            if JOURNAL is not None:
+                # In the order the store gets them, with its claims in the same write, the
+                # tickets handed out once they're on disk.
+                JOURNAL.log(road, mile, plate, timestamp, tickets)
+        if tickets:
+            if JOURNAL is None:
+                with dispatchers_lock:
+                    wake_dispatchers(ENGINE, ENGINE.enqueue(tickets))
+            for tix in tickets:
+                logging.info(f"New ticket created : {tix}")
+
+        if next(inserted_count) % COMPACT_EVERY == 0:
+            compact_sightings()
@@ -1,21 +1,10 @@
 import logging
 import socket
 import struct
-import sys
 from typing import Callable
 
 from errors import ProtocolError
 
-logging.basicConfig(
-    format=(
-        "%(asctime)s | %(levelname)s | %(name)s |  [%(filename)s:%(lineno)d] | %(threadName)-10s |"
-        " %(message)s"
-    ),
-    datefmt="%Y-%m-%d %H:%M:%S",
-    level="DEBUG",
-    handlers=[logging.FileHandler("app.log"), logging.StreamHandler(sys.stdout)],
-)
-
 
 class Parser(object):
     def __init__(self):
@@ -255,6 +244,39 @@ class SocketHandler(object):
         length = self.parser.parse_uint8(l)[0]
         return l + self._read_uint8(conn, size=length)
 
+    def split_frames(self, buffer: bytearray) -> list[tuple[str, bytes]]:
+        """
+        Takes every complete message off the front of buffer, the way read_data()
+        returns them. Nothing after an unknown message type can be framed, it's
+        returned with no data and the rest of the buffer is dropped.
+        """
+        frames = []
+        pos, end = 0, len(buffer)
+        while pos < end:
+            msg_type = buffer[pos]
+            if msg_type == 0x20:
+                if pos + 2 > end:
+                    break
+                size = 6 + buffer[pos + 1]
+            elif msg_type == 0x40:
+                size = 5
+            elif msg_type == 0x80:
+                size = 7
+            elif msg_type == 0x81:
+                if pos + 2 > end:
+                    break
+                size = 2 + 2 * buffer[pos + 1]
+            else:
+                frames.append((hex(msg_type)[2:], b""))
+                pos = end
+                break
+            if pos + size > end:
+                break
+            frames.append((hex(msg_type)[2:], bytes(buffer[pos + 1 : pos + size])))
+            pos += size
+        del buffer[:pos]
+        return frames
+
     def read_data(self, conn: socket.socket) -> tuple[str, bytes]:
         msg_type_bytes = self._read_uint8(conn)
         if not msg_type_bytes:
@@ -0,0 +1,44 @@
+import struct
+import sys
+
+sys.modules.pop("errors", None)  # 11. Pest Control has one too, pytest collects both.
+from protocol import SocketHandler  # noqa: E402
+
+PLATE = b"\x20\x04UN1X" + struct.pack(">I", 1000)
+CAMERA = b"\x80" + struct.pack(">HHH", 66, 100, 60)
+DISPATCHER = b"\x81\x03" + struct.pack(">HHH", 66, 368, 5000)
+WHEARTBEAT = b"\x40" + struct.pack(">I", 10)
+STREAM = CAMERA + WHEARTBEAT + PLATE + DISPATCHER + PLATE
+FRAMES = [
+    ("80", CAMERA[1:]),
+    ("40", WHEARTBEAT[1:]),
+    ("20", PLATE[1:]),
+    ("81", DISPATCHER[1:]),
+    ("20", PLATE[1:]),
+]
+
+
+class TestSplitFrames:
+    def test_frames_in_one_chunk(self):
+        buffer = bytearray(STREAM)
+        assert SocketHandler().split_frames(buffer) == FRAMES
+        assert buffer == b""
+
+    def test_split_at_every_byte(self):
+        handler = SocketHandler()
+        for split in range(len(STREAM) + 1):
+            buffer = bytearray(STREAM[:split])
+            frames = handler.split_frames(buffer)
+            buffer += STREAM[split:]
+            assert frames + handler.split_frames(buffer) == FRAMES, split
+            assert buffer == b""
+
+    def test_partial_frame_kept(self):
+        buffer = bytearray(CAMERA + PLATE[:3])
+        assert SocketHandler().split_frames(buffer) == FRAMES[:1]
+        assert buffer == PLATE[:3]
+
+    def test_unknown_message_type(self):
+        buffer = bytearray(CAMERA + b"\x99" + PLATE)
+        assert SocketHandler().split_frames(buffer) == [FRAMES[0], ("99", b"")]
+        assert buffer == b""  # Nothing after it is framed.
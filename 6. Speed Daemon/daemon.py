@@ -0,0 +1,97 @@
+"""
+What the Speed Daemon servers share besides the engine: the options they take, the
+spill and the log they are set up with, and how a dispatcher's tickets are written
+and its writer woken up. Each server keeps its transport, and the locks it needs.
+"""
+import argparse
+from typing import Any, Awaitable, Callable, Optional, Sequence
+
+from engine import Engine, Ticket
+from spill import SPILL_MEMORY, SpillingTickets
+from wal import Journal, JournalWriter
+
+
+def add_arguments(arg_parser: argparse.ArgumentParser):
+    # Every server's, besides where it listens.
+    arg_parser.add_argument(
+        "--wal", help="Directory of a log the sightings and ticketed days survive restarts in"
+    )
+    arg_parser.add_argument("--metrics", help="File the ticket metrics are exported to")
+    arg_parser.add_argument(
+        "--spill", help="Directory pending tickets spill to, past --spill-memory of them"
+    )
+    arg_parser.add_argument("--spill-memory", type=int, default=SPILL_MEMORY)
+    arg_parser.add_argument(
+        "--retention",
+        type=int,
+        help="Seconds of sightings kept behind the newest one, every one that can make a ticket"
+        " by default",
+    )
+
+
+def setup(engine: Engine, args: argparse.Namespace):
+    """
+    Sets the engine up as the command line asks. The log is opened by open_journal(),
+    after, so that its undelivered tickets go to the spill, if any.
+    """
+    engine.set_retention(args.retention)
+    if args.spill:
+        engine.pending = SpillingTickets(args.spill, args.spill_memory, engine.clock)
+
+
+def wake_dispatchers(engine: Engine, tickets: list[Ticket]):
+    # Of the tickets' roads, the threaded server calls it under its dispatchers' lock.
+    for road in {ticket.road for ticket in tickets}:
+        for dispatcher in engine.dispatchers_of(road):
+            dispatcher.wakeup.set()  # type: ignore
+
+
+def open_journal(
+    engine: Engine,
+    wal_dir: str,
+    release: Optional[Callable[[list[Ticket]], None]] = None,
+    locks: Sequence[Any] = (),
+) -> tuple[JournalWriter, dict[str, int]]:
+    """
+    Replays the log in `wal_dir` into the engine, and returns what logs to it from now
+    on, along with what was replayed. The writer has to run along with the server,
+    `release` queues the tickets it put on disk, and wakes their dispatchers by default.
+    """
+    journal = Journal(wal_dir)
+    stats = journal.recover(engine)
+    if release is None:
+        release = lambda held: wake_dispatchers(engine, engine.enqueue(held))  # noqa: E731
+    return JournalWriter(journal, engine, release, locks), stats
+
+
+async def sync_journal(journal: Optional[JournalWriter]):
+    # Runs along with an asyncio server, done at once when there's no log.
+    if journal is not None:
+        await journal.run()
+
+
+def delivered(engine: Engine, journal: Optional[JournalWriter], tickets: Sequence[Ticket]):
+    # Once written to a dispatcher, so a restart doesn't hand them out again.
+    engine.written(tickets)
+    if journal is not None:
+        journal.delivered(tickets)
+
+
+async def write_tickets(
+    engine: Engine,
+    journal: Optional[JournalWriter],
+    dispatcher: Any,
+    send: Callable[[Ticket], Awaitable[None]],
+):
+    """
+    Writes the dispatcher's outbox with `send` until it's empty, for the asyncio
+    servers. It polls its outbox once it wrote what it had, a slow dispatcher's outbox
+    fills up and the road's tickets go to the others, it never backs up the cameras.
+    What was polled and not written yet waits in dispatcher.in_flight, to be handed
+    out again if the dispatcher goes.
+    """
+    while tickets := engine.poll_tickets(dispatcher):
+        dispatcher.in_flight.extend(tickets)
+        while dispatcher.in_flight:
+            await send(dispatcher.in_flight[0])
+            delivered(engine, journal, (dispatcher.in_flight.popleft(),))
@@ -0,0 +1,571 @@
+"""
+The Speed Daemon's ticket engine, without any I/O.
+
+Sightings go in, tickets come out of the outboxes that dispatchers poll. The
+servers are adapters that decode frames into these calls, wake the dispatchers of
+the roads that got tickets, and write what the dispatchers poll. Nothing in here
+blocks, awaits or locks, the threaded server locks around it.
+"""
+import bisect
+import operator
+import sys
+import time
+from array import array
+from collections import defaultdict, deque
+from typing import Callable, Hashable, Iterable, Optional
+
+RETENTION: Optional[int] = None  # Seconds of sightings kept behind the newest one, or all.
+COMPACT_EVERY = 100_000  # Sightings inserted between two Engine.compact().
+OUTBOX_SIZE = 64  # Tickets handed to a dispatcher and not written yet, the rest wait on their road.
+EMPTY_DAYS = array("I")
+LATENCY_BUCKETS = tuple(0.0001 * 2**i for i in range(21))  # Seconds, upper bounds, 100us to 105s.
+
+
+class Ticket(object):
+    __slots__ = (
+        "plate",
+        "road",
+        "mile1",
+        "timestamp1",
+        "mile2",
+        "timestamp2",
+        "speed",
+        "created",
+        "polled",
+    )
+
+    def __init__(
+        self,
+        plate: str,
+        road: int,
+        mile1: int,
+        timestamp1: int,
+        mile2: int,
+        timestamp2: int,
+        speed: int,
+    ) -> None:
+        self.plate = plate
+        self.road = road
+        self.mile1 = mile1
+        self.timestamp1 = timestamp1
+        self.mile2 = mile2
+        self.timestamp2 = timestamp2
+        self.speed = speed  # 100x mph.
+        self.created = 0.0  # Engine clock, when the sighting that made it came in.
+        self.polled = 0.0  # Engine clock, when a dispatcher took it.
+
+    def __str__(self):
+        return (
+            f"Ticket for {self.plate} on {self.road} between {self.mile1} @ {self.timestamp1} and"
+            f" {self.mile2} @ {self.timestamp2} at {self.speed / 100} mph"
+        )
+
+    def fields(self) -> tuple[str, int, int, int, int, int, int]:
+        return (
+            self.plate,
+            self.road,
+            self.mile1,
+            self.timestamp1,
+            self.mile2,
+            self.timestamp2,
+            self.speed,
+        )
+
+
+def speeding_ticket(
+    plate: str, road: int, limit: int, timestamp1: int, mile1: int, timestamp2: int, mile2: int
+) -> Optional[Ticket]:
+    """
+    The ticket for two sightings of a plate on a road, if it averaged limit + 0.5 mph
+    or more between them.
+    """
+    if timestamp1 == timestamp2:
+        return None
+    if timestamp1 > timestamp2:
+        timestamp1, mile1, timestamp2, mile2 = timestamp2, mile2, timestamp1, mile1
+    speed = abs(mile2 - mile1) * 3600 / (timestamp2 - timestamp1)  # mph
+    if speed < limit + 0.5:
+        return None
+    return Ticket(plate, road, mile1, timestamp1, mile2, timestamp2, round(speed * 100))
+
+
+class Histogram(object):
+    """
+    Counts of latencies in LATENCY_BUCKETS, each bucket twice as wide as the one
+    before, and one more for anything slower.
+    """
+
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0  # Seconds.
+        self.count = 0
+
+    def record(self, seconds: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def percentile(self, pct: float) -> float:
+        """
+        Upper bound of the bucket the pct-th percentile falls in, inf past the last one.
+        """
+        rank, seen = pct / 100 * self.count, 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return LATENCY_BUCKETS[idx] if idx < len(LATENCY_BUCKETS) else float("inf")
+        return 0.0
+
+
+class RoadLatency(object):
+    __slots__ = ("queue_wait", "write")
+
+    def __init__(self):
+        self.queue_wait = Histogram()  # From the sighting making a ticket to a dispatcher's poll.
+        self.write = Histogram()  # From a dispatcher polling a ticket to its write completing.
+
+
+class DayIndex(object):
+    """
+    Days every plate has been ticketed on, as a sorted array('I') of days per plate.
+    Checking and claiming the days of a ticket is a single bisect.
+    """
+
+    def __init__(self):
+        self.days: dict[str, array] = {}
+        self.horizon = 0  # Days before it were forgotten, and can't be claimed any more.
+        self.refused = 0  # Claims of a forgotten day.
+
+    def claim(self, plate: str, timestamp1: int, timestamp2: int) -> bool:
+        """
+        Claims every day from timestamp1 to timestamp2 for the plate, unless any
+        of them is already claimed, or forgotten. Returns whether the days were claimed.
+        """
+        day1, day2 = sorted((timestamp1 // 86400, timestamp2 // 86400))
+        if day1 < self.horizon:
+            # It may have been ticketed already, better miss it than ticket it twice.
+            self.refused += 1
+            return False
+        days = self.days.get(plate)
+        if days is None:
+            days = self.days[plate] = array("I")
+        idx = bisect.bisect_left(days, day1)
+        if idx < len(days) and days[idx] <= day2:
+            return False
+        days[idx:idx] = array("I", range(day1, day2 + 1))
+        return True
+
+    def claimed(self, plate: str) -> array:
+        return self.days.get(plate, EMPTY_DAYS)
+
+    def forget_before(self, day: int) -> int:
+        """
+        Drops the days before day, once no sighting that old is kept to pair with.
+        Returns how many were dropped.
+        """
+        self.horizon = max(self.horizon, day)
+        forgotten = 0
+        for plate in list(self.days):
+            days = self.days[plate]
+            idx = bisect.bisect_left(days, day)
+            if idx == len(days):
+                del self.days[plate]
+            elif idx:
+                del days[:idx]
+            forgotten += idx
+        return forgotten
+
+
+class PlateSightings(object):
+    __slots__ = ("timestamps", "miles")
+
+    def __init__(self):
+        self.timestamps = array("I")  # Sorted.
+        self.miles = array("H")  # miles[i] is where the plate was seen at timestamps[i].
+
+
+class SightingStore(object):
+    """
+    Sightings of every plate on every road, as parallel arrays of timestamps and miles.
+    That's 6 bytes per sighting, against 100+ for a list of (timestamp, mile) tuples,
+    and bisects compare plain ints instead of calling a key function.
+
+    compact() drops the sightings of a plate on a road that fall on days the plate is
+    already ticketed for, every pair they are part of spans that day, so they can't
+    make a ticket any more. That's all that's evicted, unless there's a `retention`
+    window: then sightings more than `retention` seconds apart don't pair, and compact()
+    also evicts the sightings more than `retention` behind the newest one, on any road.
+    Sightings arriving that late are still stored, and paired with what's kept.
+    """
+
+    def __init__(self, retention: Optional[int] = RETENTION):
+        self.roads: dict[int, dict[str, PlateSightings]] = defaultdict(dict)
+        self.retention = retention
+        self.newest = 0
+        self.count = 0
+        self.inserted = 0
+        self.evicted = 0  # Older than the retention window.
+        self.compacted = 0  # On days already ticketed.
+        self.late = 0  # Arrived older than the retention window, stored anyway.
+        self.nbytes = 0  # As of the last compact().
+
+    def cutoff(self) -> int:
+        # Sightings before it are behind the window, none without one.
+        if self.retention is None:
+            return 0
+        return max(self.newest - self.retention, 0)
+
+    def insert(self, road: int, plate: str, timestamp: int, mile: int) -> list[tuple[int, int]]:
+        """
+        Adds a sighting, and returns the (timestamp, mile) of the sightings just before
+        and after it, no further than the retention window from it. Those are the only
+        new pairs a ticket can come from.
+        """
+        if timestamp < self.cutoff():
+            self.late += 1
+        self.newest = max(self.newest, timestamp)
+
+        plates = self.roads[road]
+        sightings = plates.get(plate)
+        if sightings is None:
+            sightings = plates[sys.intern(plate)] = PlateSightings()
+        timestamps, miles = sightings.timestamps, sightings.miles
+        idx = bisect.bisect_left(timestamps, timestamp)
+        timestamps.insert(idx, timestamp)
+        miles.insert(idx, mile)
+        self.count += 1
+        self.inserted += 1
+
+        neighbours: list[tuple[int, int]] = []
+        # Sightings further apart than the window never pair, so fed in order, the tickets
+        # don't depend on when compact() evicts the sightings behind it.
+        window = self.retention if self.retention is not None else 2**32
+        if idx > 0 and timestamp - timestamps[idx - 1] <= window:
+            neighbours.append((timestamps[idx - 1], miles[idx - 1]))
+        if idx + 1 < len(timestamps) and timestamps[idx + 1] - timestamp <= window:
+            neighbours.append((timestamps[idx + 1], miles[idx + 1]))
+        return neighbours
+
+    def load(self, road: int, plate: str, timestamps: list[int], miles: list[int]):
+        """
+        Stores the sightings of a plate the road has none of yet, in the order they
+        arrived, as insert() would have. They are not checked for tickets, that's up to
+        the caller.
+        """
+        sightings = self.roads[road][sys.intern(plate)] = PlateSightings()
+        if len(timestamps) > 1 and not all(map(operator.lt, timestamps, timestamps[1:])):
+            # By timestamp, later arrivals first on a tie, as insert() leaves them.
+            order = sorted(range(len(timestamps)), key=lambda i: (timestamps[i], -i))
+            timestamps = [timestamps[i] for i in order]
+            miles = [miles[i] for i in order]
+        sightings.timestamps = array("I", timestamps)
+        sightings.miles = array("H", miles)
+        self.newest = max(self.newest, timestamps[-1])
+        self.count += len(timestamps)
+        self.inserted += len(timestamps)
+
+    def compact(self, ticketed: DayIndex) -> None:
+        """
+        Evicts the sightings that can no longer be part of a ticket.
+        """
+        cutoff, nbytes = self.cutoff(), 0
+        for road in list(self.roads):
+            plates = self.roads[road]
+            for plate in list(plates):
+                sightings = plates[plate]
+                timestamps, miles = sightings.timestamps, sightings.miles
+                idx = bisect.bisect_left(timestamps, cutoff)
+                del timestamps[:idx], miles[:idx]
+                self.evicted += idx
+
+                for day in ticketed.claimed(plate):
+                    start = bisect.bisect_left(timestamps, day * 86400)
+                    end = bisect.bisect_left(timestamps, (day + 1) * 86400, start)
+                    del timestamps[start:end], miles[start:end]
+                    self.compacted += end - start
+
+                if timestamps:
+                    nbytes += sys.getsizeof(timestamps) + sys.getsizeof(miles)
+                else:
+                    del plates[plate]
+            if not plates:
+                del self.roads[road]
+        self.count = self.inserted - self.evicted - self.compacted
+        self.nbytes = nbytes
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "sightings": self.count,
+            "plates": sum(len(plates) for plates in list(self.roads.values())),
+            "bytes": self.nbytes,
+            "evicted": self.evicted,
+            "compacted": self.compacted,
+            "late": self.late,
+        }
+
+
+class PendingTickets(object):
+    """
+    Tickets waiting on their road for an outbox, in memory, first in first out.
+    spill.SpillingTickets is the same with a bounded memory, the rest on disk.
+    """
+
+    def __init__(self):
+        self.queues: dict[int, deque[Ticket]] = {}  # Road -> [Ticket]
+        self.size = 0
+
+    def push(self, ticket: Ticket):
+        queue = self.queues.get(ticket.road)
+        if queue is None:
+            queue = self.queues[ticket.road] = deque()
+        queue.append(ticket)
+        self.size += 1
+
+    def pop(self, road: int, count: int) -> list[Ticket]:
+        queue = self.queues.get(road)
+        if not queue:
+            return []
+        tickets = [queue.popleft() for _ in range(min(count, len(queue)))]
+        if not queue:
+            del self.queues[road]
+        self.size -= len(tickets)
+        return tickets
+
+    def count(self, road: int) -> int:
+        return len(self.queues.get(road, ()))
+
+    def roads(self) -> list[int]:
+        return list(self.queues)
+
+    def total(self) -> int:
+        return self.size
+
+    def spilled(self, road: int) -> int:
+        return 0
+
+
+class Engine(object):
+    """
+    Sightings, ticketed days, and the tickets waiting for a dispatcher.
+
+    add_sighting() is check(), then claim(), then enqueue(). check() only touches the
+    store of the sighting's road, one of `stripes`, so the three can be called under
+    different locks, or in different processes. Dispatchers are any hashable object.
+    Tickets are spread between the outboxes of their road's dispatchers, which
+    poll_tickets() them and requeue() what they couldn't write.
+    """
+
+    def __init__(
+        self,
+        retention: Optional[int] = RETENTION,
+        stripes: int = 1,
+        outbox_size: int = OUTBOX_SIZE,
+        clock: Callable[[], float] = time.monotonic,
+        pending: Optional[PendingTickets] = None,
+    ):
+        self.retention = retention
+        self.clock = clock
+        self.outbox_size = outbox_size
+        self.stores = [SightingStore(retention) for _ in range(stripes)]  # Road % stripes.
+        self.ticketed = DayIndex()  # plate -> [day]
+        self.pending = pending or PendingTickets()
+        self.dispatchers: dict[int, list[Hashable]] = defaultdict(list)  # Road -> dispatchers
+        self.roads: dict[Hashable, list[int]] = {}  # Dispatcher -> roads
+        self.outboxes: dict[Hashable, deque[Ticket]] = {}  # Dispatcher -> [Ticket]
+        self.compacted_at = 0  # inserted(), as of the last compact().
+        self.latencies: dict[int, RoadLatency] = defaultdict(RoadLatency)  # Road -> latencies
+
+    def set_retention(self, retention: Optional[int]):
+        # Before any sighting, the servers set it from their arguments.
+        self.retention = retention
+        for store in self.stores:
+            store.retention = retention
+
+    def store(self, road: int) -> SightingStore:
+        return self.stores[road % len(self.stores)]
+
+    def check(self, road: int, mile: int, limit: int, plate: str, timestamp: int) -> list[Ticket]:
+        """
+        Adds the sighting, and returns the tickets it makes with its neighbours, days
+        not claimed yet.
+        """
+        tickets = []
+        for timestamp2, mile2 in self.store(road).insert(road, plate, timestamp, mile):
+            ticket = speeding_ticket(plate, road, limit, timestamp, mile, timestamp2, mile2)
+            if ticket is not None:
+                ticket.created = self.clock()
+                tickets.append(ticket)
+        return tickets
+
+    def claim(self, tickets: Iterable[Ticket]) -> list[Ticket]:
+        """
+        Returns the tickets on days their plate wasn't ticketed for yet, and claims them.
+        """
+        return [
+            ticket
+            for ticket in tickets
+            if self.ticketed.claim(ticket.plate, ticket.timestamp1, ticket.timestamp2)
+        ]
+
+    def enqueue(self, tickets: Iterable[Ticket]) -> list[Ticket]:
+        tickets = list(tickets)
+        for ticket in tickets:
+            if not ticket.created:  # Made by another engine, relayed.
+                ticket.created = self.clock()
+            self.assign(ticket)
+        return tickets
+
+    def add_sighting(
+        self, road: int, mile: int, limit: int, plate: str, timestamp: int
+    ) -> list[Ticket]:
+        """
+        Returns the tickets the sighting issued, queued on their road.
+        """
+        return self.enqueue(self.claim(self.check(road, mile, limit, plate, timestamp)))
+
+    def assign(self, ticket: Ticket):
+        """
+        Puts the ticket in the outbox of the road's dispatcher with the fewest tickets
+        waiting, the one that got a ticket the longest ago on a tie. The road's queue
+        takes it while every outbox is full, or while the road has no dispatcher.
+        """
+        dispatchers = self.dispatchers.get(ticket.road)
+        if dispatchers:
+            dispatcher = min(dispatchers, key=lambda dispatcher: len(self.outboxes[dispatcher]))
+            outbox = self.outboxes[dispatcher]
+            if len(outbox) < self.outbox_size:
+                outbox.append(ticket)
+                # Round robin, min() picks the first of the dispatchers with the fewest tickets.
+                dispatchers.remove(dispatcher)
+                dispatchers.append(dispatcher)
+                return
+        self.pending.push(ticket)
+
+    def register_dispatcher(self, dispatcher: Hashable, roads: list[int]):
+        self.roads[dispatcher] = roads
+        self.outboxes[dispatcher] = deque()
+        for road in roads:
+            self.dispatchers[road].append(dispatcher)
+
+    def unregister_dispatcher(self, dispatcher: Hashable) -> list[Ticket]:
+        """
+        Returns the tickets that were waiting in the dispatcher's outbox, handed to the
+        other dispatchers of their road or queued.
+        """
+        for road in self.roads.pop(dispatcher, []):
+            dispatchers = self.dispatchers[road]
+            if dispatcher in dispatchers:
+                dispatchers.remove(dispatcher)
+            if not dispatchers:
+                del self.dispatchers[road]
+        return self.requeue(self.outboxes.pop(dispatcher, ()))
+
+    def dispatchers_of(self, road: int) -> list[Hashable]:
+        return self.dispatchers.get(road, [])
+
+    def poll_tickets(self, dispatcher: Hashable) -> list[Ticket]:
+        """
+        Takes the tickets in the dispatcher's outbox. An outbox is only topped up from
+        its roads' queues here, so a dispatcher that doesn't poll holds no more than
+        `outbox_size` tickets, and the rest go to the road's other dispatchers.
+        """
+        outbox = self.outboxes.get(dispatcher)
+        if outbox is None:
+            return []
+        tickets = list(outbox)
+        outbox.clear()
+        for road in self.roads[dispatcher]:
+            tickets.extend(self.pending.pop(road, self.outbox_size - len(tickets)))
+            if len(tickets) == self.outbox_size:
+                break
+        now = self.clock()
+        for ticket in tickets:
+            ticket.polled = now
+        return tickets
+
+    def written(self, tickets: Iterable[Ticket]):
+        """
+        Records the latencies of tickets a dispatcher polled and wrote.
+        """
+        now = self.clock()
+        for ticket in tickets:
+            latency = self.latencies[ticket.road]
+            latency.queue_wait.record(ticket.polled - ticket.created)
+            latency.write.record(now - ticket.polled)
+
+    def requeue(self, tickets: Iterable[Ticket]) -> list[Ticket]:
+        """
+        Hands out again tickets a dispatcher took but didn't write.
+        """
+        return self.enqueue(tickets)
+
+    def pending_count(self, road: Optional[int] = None) -> int:
+        if road is not None:
+            return self.pending.count(road)
+        return self.pending.total()
+
+    def undispatched(self) -> dict[int, int]:
+        """
+        Tickets waiting on each road that has no dispatcher at all.
+        """
+        return {
+            road: self.pending.count(road)
+            for road in self.pending.roads()
+            if road not in self.dispatchers
+        }
+
+    def inserted(self) -> int:
+        return sum(store.inserted for store in self.stores)
+
+    def due(self) -> bool:
+        return self.inserted() - self.compacted_at >= COMPACT_EVERY
+
+    def newest(self) -> int:
+        return max(store.newest for store in self.stores)
+
+    def compact_stripe(self, stripe: int, newest: int):
+        """
+        Compacts one store, moved up to `newest` first, so that once every store is
+        compacted up to the same newest no store can pair a sighting from before the
+        cutoff, and forget_days() can drop the ticketed days before it.
+        """
+        store = self.stores[stripe]
+        store.newest = max(store.newest, newest)
+        store.compact(self.ticketed)
+
+    def cutoff(self, newest: int) -> int:
+        if self.retention is None:
+            return 0
+        return max(newest - self.retention, 0)
+
+    def forget_days(self, newest: int) -> int:
+        """
+        Forgets the ticketed days behind the retention window, without one there's no
+        telling when a day can't be ticketed any more, they're all kept.
+        """
+        if self.retention is None:
+            return 0
+        return self.ticketed.forget_before(self.cutoff(newest) // 86400)
+
+    def compact(self):
+        newest = self.newest()
+        for stripe in range(len(self.stores)):
+            self.compact_stripe(stripe, newest)
+        self.forget_days(newest)
+        self.compacted_at = self.inserted()
+
+    def stats(self) -> dict[str, int]:
+        # Over copies of the dicts, the threaded server logs them while its cameras add to them.
+        stats: dict[str, int] = defaultdict(int)
+        for store in self.stores:
+            for name, value in store.stats().items():
+                stats[name] += value
+        stats["ticketed_days"] = sum(len(days) for days in list(self.ticketed.days.values()))
+        stats["refused_claims"] = self.ticketed.refused
+        stats["pending_tickets"] = self.pending_count()
+        stats["outbox_tickets"] = sum(len(outbox) for outbox in list(self.outboxes.values()))
+        stats["undispatched_tickets"] = sum(self.undispatched().values())
+        stats["spilled_tickets"] = sum(self.pending.spilled(road) for road in self.pending.roads())
+        return dict(stats)
@@ -0,0 +1,360 @@
+"""
+Camera and dispatcher load generator for the Speed Daemon servers.
+
+Starts a server, connects thousands of cameras across hundreds of roads and a set
+of dispatchers asking for heartbeats, then drives cars past the cameras, some of
+them speeding. Reports plates/s, plate to ticket latency, heartbeats, and checks
+that every speeder got exactly one ticket per day and nobody else got one.
+Exits non-zero when a ticket is missed, duplicated or unexpected.
+
+    python loadgen.py --servers "server,async,async:--shards 4,threaded:--reactor"
+"""
+import argparse
+import asyncio
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from asyncio import StreamReader, StreamWriter
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SERVERS = {
+    "server": os.path.join(ROOT, "server.py"),
+    "async": os.path.join(ROOT, "Async Speed Daemon", "6_async_camera.py"),
+    "threaded": os.path.join(ROOT, "MultiThreaded Speed Daemon", "6_camera.py"),
+}
+HOST = "127.0.0.1"
+CAMERA_SPACING = 10  # Miles between two cameras on a road.
+LIMITS = [40, 50, 60, 70]  # mph, one per road.
+CONNECT_BATCH = 100  # Connections opened at once, below the servers' listen backlog.
+CAMERA_HEARTBEAT = 50  # Deciseconds.
+TICKET_STRUCT = struct.Struct(">HHIHIH")  # road, mile1, timestamp1, mile2, timestamp2, speed
+Sighting = tuple[int, str]  # timestamp, plate
+
+
+@dataclass
+class Scenario(object):
+    limits: list[int] = field(default_factory=list)  # Road -> limit.
+    sightings: dict[tuple[int, int], list[Sighting]] = field(default_factory=dict)
+    # (road, mile) -> sightings of that camera, by timestamp.
+    expected: set[tuple[str, int]] = field(default_factory=set)  # (plate, day) of every speeder.
+    ends: list[tuple[int, str, int]] = field(default_factory=list)
+    # (last timestamp, plate, day) of every speeder's trip, by timestamp.
+
+    def start(self) -> int:
+        return min(sightings[0][0] for sightings in self.sightings.values() if sightings)
+
+    def end(self) -> int:
+        return max(sightings[-1][0] for sightings in self.sightings.values() if sightings)
+
+
+@dataclass
+class Result(object):
+    sent: dict[tuple[str, int], float] = field(default_factory=dict)  # (plate, timestamp) -> time
+    tickets: list[tuple[float, str, int, int, int, int, int, int]] = field(default_factory=list)
+    heartbeats: list[int] = field(default_factory=list)  # Per dispatcher.
+    errors: list[bytes] = field(default_factory=list)
+    covered: set[tuple[str, int]] = field(default_factory=set)  # Expected, and ticketed.
+    all_covered: asyncio.Event = field(default_factory=asyncio.Event)
+    ticketed: asyncio.Event = field(default_factory=asyncio.Event)  # Set on every ticket.
+    elapsed: float = 0  # Sending every plate, without the waits for tickets.
+    dispatching: float = 0  # Heartbeats were counted over.
+
+    def latencies(self) -> list[float]:
+        latencies = []
+        for received, plate, _, _, timestamp1, _, timestamp2, _ in self.tickets:
+            sent = [self.sent.get((plate, timestamp)) for timestamp in (timestamp1, timestamp2)]
+            if None not in sent:
+                latencies.append(received - max(sent))  # type: ignore
+        return latencies
+
+    def check(self, expected: set[tuple[str, int]]) -> tuple[int, int, int]:
+        """
+        Returns how many (plate, day) were missed, ticketed more than once, and
+        ticketed without a speeder behind them.
+        """
+        ticketed: dict[tuple[str, int], int] = defaultdict(int)
+        for _, plate, _, _, timestamp1, _, timestamp2, _ in self.tickets:
+            for day in range(timestamp1 // 86400, timestamp2 // 86400 + 1):
+                ticketed[(plate, day)] += 1
+        missed = len(expected - ticketed.keys())
+        duplicate = sum(1 for count in ticketed.values() if count > 1)
+        unexpected = len(ticketed.keys() - expected)
+        return missed, duplicate, unexpected
+
+
+def scenario(
+    rng: random.Random, roads: int, cameras: int, plates: int, trips: int, speeders: float
+) -> Scenario:
+    """
+    Every plate drives `trips` times, on consecutive days and random roads, past a
+    stretch of at least two cameras at a constant speed. Speeders drive 10 to 40 mph
+    above the limit on every trip, everyone else at most 90% of it, so rounding
+    never decides a ticket. Trips don't cross midnight.
+    """
+    result = Scenario(limits=[rng.choice(LIMITS) for _ in range(roads)])
+    sightings: dict[tuple[int, int], list[Sighting]] = defaultdict(list)
+    for i in range(plates):
+        plate = f"LG{i:05d}"
+        speeder = rng.random() < speeders
+        for day in range(1, trips + 1):
+            road = rng.randrange(roads)
+            limit = result.limits[road]
+            first = rng.randrange(cameras - 1)
+            last = rng.randrange(first + 1, cameras)
+            speed = limit + rng.uniform(10, 40) if speeder else limit * rng.uniform(0.5, 0.9)
+            duration = (last - first) * CAMERA_SPACING / speed * 3600
+            start = day * 86400 + rng.randrange(600, int(86400 - duration - 600))
+            for camera in range(first, last + 1):
+                offset = (camera - first) * CAMERA_SPACING / speed * 3600
+                sightings[(road, camera * CAMERA_SPACING)].append((start + round(offset), plate))
+            if speeder:
+                result.expected.add((plate, day))
+                result.ends.append((start + round(offset), plate, day))
+    result.sightings = {camera: sorted(seen) for camera, seen in sightings.items()}
+    result.ends.sort()
+    return result
+
+
+def encode_plate(plate: str, timestamp: int) -> bytes:
+    return bytes((0x20, len(plate))) + plate.encode() + struct.pack(">I", timestamp)
+
+
+async def connect_all(port: int, count: int) -> list[tuple[StreamReader, StreamWriter]]:
+    connections = []
+    for start in range(0, count, CONNECT_BATCH):
+        batch = range(start, min(count, start + CONNECT_BATCH))
+        connections += await asyncio.gather(*(asyncio.open_connection(HOST, port) for _ in batch))
+    return connections
+
+
+class DispatcherClient(object):
+    def __init__(self, reader: StreamReader, writer: StreamWriter, index: int) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.index = index
+
+    async def identify(self, roads: list[int], interval: int):
+        self.writer.write(bytes((0x40,)) + struct.pack(">I", interval))
+        self.writer.write(bytes((0x81, len(roads))) + struct.pack(f">{len(roads)}H", *roads))
+        await self.writer.drain()
+
+    async def read_tickets(self, result: Result, expected: set[tuple[str, int]]):
+        reader = self.reader
+        try:
+            while 1:
+                msg_code = (await reader.readexactly(1))[0]
+                if msg_code == 0x41:
+                    result.heartbeats[self.index] += 1
+                elif msg_code == 0x21:
+                    plate = (await reader.readexactly((await reader.readexactly(1))[0])).decode()
+                    fields = TICKET_STRUCT.unpack(await reader.readexactly(TICKET_STRUCT.size))
+                    result.tickets.append((time.perf_counter(), plate, *fields))
+                    for day in range(fields[2] // 86400, fields[4] // 86400 + 1):
+                        if (plate, day) in expected:
+                            result.covered.add((plate, day))
+                    if len(result.covered) == len(expected):
+                        result.all_covered.set()
+                    result.ticketed.set()
+                else:
+                    result.errors.append(await reader.readexactly((await reader.readexactly(1))[0]))
+                    return
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            return
+
+    def close(self):
+        self.writer.close()
+
+
+async def drive(port: int, plan: Scenario, args: argparse.Namespace) -> Result:
+    result = Result(heartbeats=[0] * args.dispatchers)
+    roads = list(range(len(plan.limits)))
+    dispatchers = [
+        DispatcherClient(reader, writer, i)
+        for i, (reader, writer) in enumerate(await connect_all(port, args.dispatchers))
+    ]
+    for dispatcher in dispatchers:
+        await dispatcher.identify(roads[dispatcher.index :: args.dispatchers], args.heartbeat)
+    dispatch_start = time.perf_counter()
+    readers = [
+        asyncio.create_task(dispatcher.read_tickets(result, plan.expected))
+        for dispatcher in dispatchers
+    ]
+    if not plan.expected:
+        result.all_covered.set()
+
+    # Cameras want heartbeats too, the first one shows the server is reading the camera.
+    # Otherwise a camera accepted late has its first plates seen long after the others.
+    cameras = list(plan.sightings)
+    connections = await connect_all(port, len(cameras))
+    writers = [writer for _, writer in connections]
+    for (road, mile), writer in zip(cameras, writers):
+        writer.write(bytes((0x80,)) + struct.pack(">HHH", road, mile, plan.limits[road]))
+        writer.write(bytes((0x40,)) + struct.pack(">I", CAMERA_HEARTBEAT))
+    await asyncio.gather(*(reader.readexactly(1) for reader, _ in connections))
+
+    # Every camera sends a slice of simulated time before any sends the next, and a
+    # server slower than us reads whole backlogs, far out of order across cameras.
+    # With --lockstep, a slice first waits for the tickets of trips `lockstep` seconds
+    # before it, that time isn't counted in plates/s.
+    positions = [0] * len(cameras)
+    ends = 0
+    waited = 0.0
+    start = time.perf_counter()
+    for slice_end in range(plan.start() + args.slice, plan.end() + args.slice + 1, args.slice):
+        wait_start = time.perf_counter()
+        while (
+            args.lockstep is not None
+            and ends < len(plan.ends)
+            and plan.ends[ends][0] < slice_end - args.lockstep
+        ):
+            _, plate, day = plan.ends[ends]
+            while (plate, day) not in result.covered:
+                result.ticketed.clear()
+                try:
+                    await asyncio.wait_for(result.ticketed.wait(), args.settle)
+                except asyncio.TimeoutError:
+                    break  # Missed, the report says so.
+            ends += 1
+        waited += time.perf_counter() - wait_start
+        draining = []
+        for i, camera in enumerate(cameras):
+            sightings, position = plan.sightings[camera], positions[i]
+            end = position
+            while end < len(sightings) and sightings[end][0] < slice_end:
+                end += 1
+            if end == position:
+                continue
+            now = time.perf_counter()
+            frames = []
+            for timestamp, plate in sightings[position:end]:
+                result.sent[(plate, timestamp)] = now
+                frames.append(encode_plate(plate, timestamp))
+            writers[i].write(b"".join(frames))
+            draining.append(writers[i].drain())
+            positions[i] = end
+        await asyncio.gather(*draining)
+    result.elapsed = time.perf_counter() - start - waited
+
+    try:
+        await asyncio.wait_for(result.all_covered.wait(), args.settle)
+        await asyncio.sleep(args.linger)  # Duplicates would come in right behind.
+    except asyncio.TimeoutError:
+        pass
+    result.dispatching = time.perf_counter() - dispatch_start
+    for task in readers:
+        task.cancel()
+    for writer in writers:
+        writer.close()
+    for dispatcher in dispatchers:
+        dispatcher.close()
+    return result
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    if not samples:
+        return float("nan")
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def start_server(spec: str, port: int, workdir: str) -> subprocess.Popen:
+    name, _, extra = spec.partition(":")
+    if name not in SERVERS:
+        raise ValueError(f"Unknown server : {spec}")
+    cmd = [sys.executable, SERVERS[name], "--ip", HOST, "--port", str(port), *extra.split()]
+    # The servers log to app.log in their working directory.
+    server = subprocess.Popen(
+        cmd, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline and server.poll() is None:
+        try:
+            socket.create_connection((HOST, port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError(f"Server {spec} did not start")
+
+
+def run(spec: str, plan: Scenario, args: argparse.Namespace) -> Result:
+    with tempfile.TemporaryDirectory() as workdir:
+        server = start_server(spec, args.port, workdir)
+        try:
+            return asyncio.run(drive(args.port, plan, args))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def main() -> int:
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument(
+        "--servers",
+        default="server,async,threaded",
+        help="server, async or threaded, comma separated. NAME:ARGS passes ARGS to the server",
+    )
+    arg_parser.add_argument("--roads", type=int, default=200)
+    arg_parser.add_argument("--cameras", type=int, default=10, help="Cameras per road")
+    arg_parser.add_argument("--plates", type=int, default=5000)
+    arg_parser.add_argument("--trips", type=int, default=2, help="Trips per plate, one a day")
+    arg_parser.add_argument("--speeders", type=float, default=0.1, help="Fraction of plates")
+    arg_parser.add_argument("--dispatchers", type=int, default=20)
+    arg_parser.add_argument("--heartbeat", type=int, default=10, help="Deciseconds")
+    arg_parser.add_argument("--slice", type=int, default=600, help="Simulated seconds per round")
+    arg_parser.add_argument(
+        "--lockstep",
+        type=int,
+        help="Simulated seconds sent ahead of the tickets received at most, for servers run with"
+        " --retention. Cameras stream freely by default",
+    )
+    arg_parser.add_argument("--settle", type=float, default=30, help="Seconds to wait for tickets")
+    arg_parser.add_argument(
+        "--linger", type=float, default=1, help="Seconds to wait for duplicates"
+    )
+    arg_parser.add_argument("--port", type=int, default=9390)
+    arg_parser.add_argument("--seed", type=int, default=1)
+    args = arg_parser.parse_args()
+    if args.cameras < 2:
+        arg_parser.error("--cameras must be at least 2, a ticket needs two sightings")
+    if -(-args.roads // args.dispatchers) > 255:
+        arg_parser.error("A dispatcher covers 255 roads at most, add --dispatchers")
+
+    plan = scenario(
+        random.Random(args.seed), args.roads, args.cameras, args.plates, args.trips, args.speeders
+    )
+    sightings = sum(len(seen) for seen in plan.sightings.values())
+    print(
+        f"{len(plan.sightings)} cameras on {args.roads} roads, {sightings} sightings,"
+        f" {len(plan.expected)} tickets expected, {args.dispatchers} dispatchers"
+    )
+    print(
+        f"{'server':<24} {'plates/s':>9} {'tickets':>8} {'missed':>7} {'dup':>5} {'unexp':>6}"
+        f" {'p50 ms':>8} {'p99 ms':>8} {'hb/s':>6}"
+    )
+    failed = False
+    for spec in args.servers.split(","):
+        result = run(spec, plan, args)
+        missed, duplicate, unexpected = result.check(plan.expected)
+        latencies = result.latencies()
+        p50, p99 = percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000
+        heartbeat_rate = min(result.heartbeats) / result.dispatching if result.heartbeats else 0
+        print(
+            f"{spec:<24} {sightings / result.elapsed:>9.0f} {len(result.tickets):>8} {missed:>7}"
+            f" {duplicate:>5} {unexpected:>6} {p50:>8.1f} {p99:>8.1f} {heartbeat_rate:>6.1f}"
+        )
+        for error in set(result.errors):
+            print(f"{'':<24} error : {error.decode(errors='replace')}")
+        failed = failed or bool(missed or duplicate or unexpected or result.errors)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
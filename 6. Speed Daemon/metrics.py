@@ -0,0 +1,86 @@
+"""
+The Speed Daemon's ticket metrics, in the Prometheus text format.
+
+Servers started with --metrics PATH rewrite PATH every METRICS_INTERVAL, for a
+node_exporter textfile collector or anything else that can read a file. Per road:
+
+    speed_daemon_ticket_queue_wait_seconds  histogram, sighting to a dispatcher's poll
+    speed_daemon_ticket_write_seconds       histogram, dispatcher's poll to written
+    speed_daemon_pending_tickets            gauge, waiting on the road for an outbox
+    speed_daemon_undispatched_tickets       gauge, waiting on a road with no dispatcher
+    speed_daemon_spilled_tickets            gauge, of the pending ones, those on disk
+
+A dispatch backlog shows as sum(speed_daemon_undispatched_tickets) > 0.
+"""
+import asyncio
+import os
+from typing import Optional
+
+from engine import LATENCY_BUCKETS, Engine, Histogram
+
+METRICS_INTERVAL = 10  # Seconds between two exports.
+PREFIX = "speed_daemon_"
+
+
+def render_histogram(lines: list[str], name: str, road: int, histogram: Histogram):
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{road="{road}",le="{bound:g}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{road="{road}",le="+Inf"}} {histogram.count}')
+    lines.append(f'{name}_sum{{road="{road}"}} {histogram.total:.6f}')
+    lines.append(f'{name}_count{{road="{road}"}} {histogram.count}')
+
+
+def render_metrics(engine: Engine) -> str:
+    """
+    Reads the engine's dispatch state, call it under whatever lock guards that.
+    """
+    lines: list[str] = []
+    for metric, attr, help in (
+        ("ticket_queue_wait_seconds", "queue_wait", "From the sighting to a dispatcher's poll."),
+        ("ticket_write_seconds", "write", "From a dispatcher's poll to the ticket written."),
+    ):
+        name = PREFIX + metric
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} histogram")
+        for road, latency in sorted(engine.latencies.items()):
+            render_histogram(lines, name, road, getattr(latency, attr))
+
+    # Every road seen, at 0 once drained, so the series don't vanish under an alert.
+    roads = sorted(set(engine.latencies) | set(engine.pending.roads()) | set(engine.dispatchers))
+    undispatched = engine.undispatched()
+    name = PREFIX + "pending_tickets"
+    lines.append(f"# HELP {name} Tickets waiting on the road, every outbox of it full or none.")
+    lines.append(f"# TYPE {name} gauge")
+    for road in roads:
+        lines.append(f'{name}{{road="{road}"}} {engine.pending_count(road)}')
+
+    name = PREFIX + "undispatched_tickets"
+    lines.append(f"# HELP {name} Tickets waiting on a road that has no dispatcher.")
+    lines.append(f"# TYPE {name} gauge")
+    for road in roads:
+        lines.append(f'{name}{{road="{road}"}} {undispatched.get(road, 0)}')
+
+    name = PREFIX + "spilled_tickets"
+    lines.append(f"# HELP {name} Tickets waiting on the road, spilled to disk.")
+    lines.append(f"# TYPE {name} gauge")
+    for road in roads:
+        lines.append(f'{name}{{road="{road}"}} {engine.pending.spilled(road)}')
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(text: str, path: str):
+    # Replaced whole, a reader never sees half an export.
+    with open(path + ".tmp", "w") as file:
+        file.write(text)
+    os.replace(path + ".tmp", path)
+
+
+async def export_metrics(engine: Engine, path: Optional[str]):
+    # Runs along with an asyncio server, done at once without a path.
+    if path is None:
+        return
+    while 1:
+        await asyncio.sleep(METRICS_INTERVAL)
+        write_metrics(render_metrics(engine), path)
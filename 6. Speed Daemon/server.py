@@ -1,7 +1,7 @@
 from __future__ import annotations
 
+import argparse
 import asyncio
-import bisect
 import struct
 import traceback
 from abc import ABC
@@ -10,11 +10,24 @@ from asyncio import CancelledError
 from asyncio import IncompleteReadError
 from asyncio import StreamReader
 from asyncio import StreamWriter
-from collections import defaultdict
+from collections import deque
 from dataclasses import dataclass
+from dataclasses import field
 from typing import Optional
 from typing import Self
 
+from daemon import add_arguments
+from daemon import open_journal
+from daemon import setup
+from daemon import sync_journal
+from daemon import wake_dispatchers
+from daemon import write_tickets
+from engine import Engine
+from engine import Ticket
+from metrics import export_metrics
+from wal import JournalWriter
+from wheel import HeartbeatWheel
+
 
 async def read_u8(reader: StreamReader) -> int:
     content = await reader.readexactly(1)
@@ -64,6 +77,31 @@ async def write_str(writer: StreamWriter, string: str) -> None:
     await writer.drain()
 
 
+# Ticket frames by plate length, "p" packs the plate after its length byte.
+TICKET_STRUCTS = [struct.Struct(f"!B{length + 1}pHHIHIH") for length in range(256)]
+
+
+def encode_ticket(buffer: bytearray, ticket: Ticket) -> int:
+    """
+    Packs the whole ticket frame into buffer, returns its size.
+    """
+    plate = ticket.plate.encode("ascii")
+    ticket_struct = TICKET_STRUCTS[len(plate)]
+    ticket_struct.pack_into(
+        buffer,
+        0,
+        0x21,
+        plate,
+        ticket.road,
+        ticket.mile1,
+        ticket.timestamp1,
+        ticket.mile2,
+        ticket.timestamp2,
+        ticket.speed,
+    )
+    return ticket_struct.size
+
+
 @dataclass(frozen=True)
 class Message(ABC):
     client: Client
@@ -104,42 +142,29 @@ class Plate(Message):
         timestamp = await read_u32(client.reader)
         return Plate(client, plate, timestamp)
 
-    async def process_pair(self, sighting1: Sighting, sighting2: Sighting) -> None:
-        car_distance = abs(sighting2.camera.mile - sighting1.camera.mile)
-        elapsed_time = sighting2.plate.timestamp - sighting1.plate.timestamp
-        speed_mph = car_distance / (elapsed_time / 3600)
-        if sighting2.camera.limit >= round(speed_mph):
-            return
-
-        ticket = Ticket(
-            sighting1.plate.plate,
-            sighting1.camera.road,
-            sighting1.camera.mile,
-            sighting1.plate.timestamp,
-            sighting2.camera.mile,
-            sighting2.plate.timestamp,
-            speed_mph,
-        )
-        if sighting1.camera.road not in dispatchers:
-            queued_tickets[ticket.road].append(ticket)
-        else:
-            await dispatchers[sighting1.camera.road].send_ticket(ticket)
-
     async def process(self) -> None:
         if not isinstance(self.client.type, IAmCamera):
             raise ClientError("not a camera")
 
-        sighting = Sighting(self, self.client.type)
-        sightings = plate_sightings[sighting.plate.plate]
-        bisect.insort_left(sightings, sighting, key=lambda s: s.plate.timestamp)
-        if len(sightings) < 2:
-            return
-
-        to_process = []
-        for sighting1, sighting2 in zip(sightings, sightings[1:]):
-            to_process.append(self.process_pair(sighting1, sighting2))
-
-        await asyncio.gather(*to_process)
+        camera = self.client.type
+        if journal is None:
+            wake_dispatchers(
+                engine,
+                engine.add_sighting(
+                    camera.road, camera.mile, camera.limit, self.plate, self.timestamp
+                ),
+            )
+        else:
+            journal.sighting(camera.road, camera.mile, self.plate, self.timestamp)
+            tickets = engine.check(
+                camera.road, camera.mile, camera.limit, self.plate, self.timestamp
+            )
+            journal.hold(engine.claim(tickets))  # Handed out once the claims are on disk.
+        if engine.due():
+            engine.compact()
+            print(f"Compacted sightings: {engine.stats()}")
+            if journal is not None:
+                journal.snapshot_due = True
 
 
 @dataclass(frozen=True)
@@ -151,21 +176,13 @@ class WantHeartbeat(Message):
         interval = await read_u32(client.reader)
         return WantHeartbeat(client, interval)
 
-    async def heartbeat_task(self):
-        try:
-            while not self.client.reader.at_eof():
-                await asyncio.sleep(self.interval / 10)
-                await write_u8(self.client.writer, 0x41)
-        except ConnectionResetError:
-            pass
-
     async def process(self) -> None:
         if self.client.has_heartbeat:
             raise ClientError("already has a heartbeat")
 
         self.client.has_heartbeat = True
         if self.interval:
-            asyncio.create_task(self.heartbeat_task())
+            heartbeats.add(self.client.reader, self.client.writer, self.interval)
 
 
 @dataclass(frozen=True)
@@ -202,14 +219,9 @@ class IAmDispatcher(Message):
     async def process(self) -> None:
         await self.client.identify(self)
 
-        for road in self.roads:
-            dispatchers[road] = self.client
-
-            queued_tickets_for_road = queued_tickets[road]
-            await asyncio.gather(
-                *(self.client.send_ticket(ticket) for ticket in queued_tickets_for_road)
-            )
-            queued_tickets[road] = []
+        engine.register_dispatcher(self.client, self.roads)
+        self.client.wakeup.set()  # Tickets may be waiting for the roads already.
+        self.client.writer_task = asyncio.create_task(self.client.write_tickets())
 
 
 @dataclass(frozen=True)
@@ -217,46 +229,47 @@ class ClientError(Exception):
     message: str
 
 
-@dataclass(frozen=True)
-class Sighting:
-    plate: Plate
-    camera: IAmCamera
-
-
-@dataclass(frozen=True)
-class Ticket:
-    plate: str
-    road: int
-    mile_from: int
-    timestamp1: int
-    mile_to: int
-    timestamp2: int
-    speed: float
-
-
-@dataclass
+@dataclass(eq=False)
 class Client:
     reader: StreamReader
     writer: StreamWriter
     has_heartbeat: bool = False
     type: Optional[IAmCamera | IAmDispatcher] = None
+    wakeup: asyncio.Event = field(default_factory=asyncio.Event)  # Set on tickets for its roads.
+    in_flight: deque[Ticket] = field(default_factory=deque)  # Polled, not written yet.
+    writer_task: Optional[asyncio.Task] = None
+    ticket_buffer: bytearray = field(
+        default_factory=lambda: bytearray(TICKET_STRUCTS[-1].size)
+    )
 
     async def send_ticket(self, ticket: Ticket) -> None:
-        days = set(ts // 86400 for ts in (ticket.timestamp1, ticket.timestamp2))
-        for sent_ticket in sent_tickets[ticket.plate]:
-            if any(ts // 86400 in days for ts in (sent_ticket.timestamp1, sent_ticket.timestamp2)):
-                return
-
-        sent_tickets[ticket.plate].add(ticket)
-
-        await write_u8(self.writer, 0x21)
-        await write_str(self.writer, ticket.plate)
-        await write_u16(self.writer, ticket.road)
-        await write_u16(self.writer, ticket.mile_from)
-        await write_u32(self.writer, ticket.timestamp1)
-        await write_u16(self.writer, ticket.mile_to)
-        await write_u32(self.writer, ticket.timestamp2)
-        await write_u16(self.writer, int(ticket.speed * 100))
+        size = encode_ticket(self.ticket_buffer, ticket)
+        # The transport may keep what it's given if the socket is full, so it gets a copy.
+        self.writer.write(self.ticket_buffer[:size])
+        await self.writer.drain()
+
+    async def write_tickets(self) -> None:
+        # Writer task of a dispatcher, the only place its socket is written to with tickets.
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                await write_tickets(engine, journal, self, self.send_ticket)
+        except (ConnectionResetError, OSError):
+            self.disconnect()
+
+    def disconnect(self) -> None:
+        """
+        Redelivers every ticket that wasn't confirmed written, to other dispatchers.
+        """
+        if not isinstance(self.type, IAmDispatcher):
+            return
+        wake_dispatchers(engine, engine.unregister_dispatcher(self))
+        if self.writer_task is not None and self.writer_task is not asyncio.current_task():
+            self.writer_task.cancel()
+
+        wake_dispatchers(engine, engine.requeue(self.in_flight))
+        self.in_flight.clear()
 
     async def handle_messages(self):
         while not self.reader.at_eof():
@@ -274,30 +287,42 @@ class Client:
         self.type = type
 
 
-dispatchers: dict[int, Client] = {}
-queued_tickets: dict[int, list[Ticket]] = defaultdict(list)
-plate_sightings: dict[str, list[Sighting]] = defaultdict(list)
-sent_tickets: dict[str, set[Ticket]] = defaultdict(set)
+engine = Engine()  # Sightings, ticketed days, and tickets waiting for a dispatcher.
+journal: Optional[JournalWriter] = None  # Set by open_journal(), when the server runs with a log.
+heartbeats = HeartbeatWheel()
 
 
 async def handle_client(reader: StreamReader, writer: StreamWriter) -> None:
     client = Client(reader, writer)
     try:
         await client.handle_messages()
-    except (CancelledError, IncompleteReadError, KeyboardInterrupt):
+    except (CancelledError, IncompleteReadError, ConnectionResetError, KeyboardInterrupt):
         pass
     except:
         traceback.print_exc()
+    finally:
+        client.disconnect()
 
 
-async def main():
-    IP, PORT = "10.154.0.3", 9090
-    server = await asyncio.start_server(handle_client, IP, PORT)
+async def main(ip: str = "10.154.0.3", port: int = 9090, metrics: Optional[str] = None):
+    server = await asyncio.start_server(handle_client, ip, port)
     print("Accepting connections...")
 
     async with server:
-        await server.serve_forever()
+        # A failing log stops the server, rather than serving without it.
+        await asyncio.gather(
+            server.serve_forever(), sync_journal(journal), export_metrics(engine, metrics)
+        )
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    arg_parser = argparse.ArgumentParser(description="Speed Daemon server")
+    arg_parser.add_argument("--ip", default="10.154.0.3")
+    arg_parser.add_argument("--port", type=int, default=9090)
+    add_arguments(arg_parser)
+    args = arg_parser.parse_args()
+    setup(engine, args)
+    if args.wal:
+        journal, stats = open_journal(engine, args.wal)
+        print(f"Replayed log @ {args.wal}: {stats}")
+    asyncio.run(main(args.ip, args.port, args.metrics))
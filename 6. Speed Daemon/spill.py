@@ -0,0 +1,201 @@
+"""
+Tickets waiting for a dispatcher, spilled to disk past a memory budget.
+
+A road without a dispatcher collects tickets for as long as the outage lasts.
+SpillingTickets keeps at most `memory` of them in memory, across every road, and
+appends the rest to a file per road, road-<road>, in the spill directory. Once a
+road has tickets on disk, its new tickets go after them, so a road is still first
+in first out. A dispatcher's poll drains the file an outbox at a time, and the file
+is deleted once it's read through. The files of the roads spilled to most recently
+stay open for appending, up to `open_files` of them.
+
+The files outlive the server. Tickets found on disk at startup are handed out
+again, tickets in memory at a crash are lost, as without spilling.
+"""
+import os
+import struct
+import time
+from typing import Callable
+
+from engine import PendingTickets, Ticket
+
+SPILL_MEMORY = 10_000  # Tickets kept in memory, across every road.
+SPILL_PREFIX = "road-"
+SPILL_FILES = 64  # Spill files kept open for appending, at most.
+READ_SIZE = 64 * 1024  # Bytes read from a spill file at once, at most.
+TICKET_RECORD = struct.Struct("<HIHIHdB")
+# mile1, timestamp1, mile2, timestamp2, speed, created, plate length, then the plate.
+
+
+class Spill(object):
+    __slots__ = ("path", "fd", "read_offset", "size", "count", "recovered")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fd = -1  # Open for appending, while the road is among the recently spilled.
+        self.read_offset = 0  # Of the next ticket to hand out.
+        self.size = 0  # Of the file, every ticket appended so far.
+        self.count = 0  # Tickets between read_offset and size.
+        self.recovered = 0  # Offset up to which the file was written before the server started.
+
+
+class SpillingTickets(PendingTickets):
+    """
+    PendingTickets in at most `memory` tickets, the rest on disk, in `spill_dir`.
+    """
+
+    def __init__(
+        self,
+        spill_dir: str,
+        memory: int = SPILL_MEMORY,
+        clock: Callable[[], float] = time.monotonic,
+        open_files: int = SPILL_FILES,
+    ):
+        super().__init__()
+        os.makedirs(spill_dir, exist_ok=True)
+        self.spill_dir = spill_dir
+        self.memory = memory
+        self.open_files = open_files
+        self.opened = clock()  # The engine's clock, tickets of the previous run wait from then.
+        self.in_memory = 0
+        self.spills: dict[int, Spill] = {}  # Road -> its file, while it has tickets.
+        self.appending: dict[int, Spill] = {}  # The spills with an fd, least recently used first.
+        self.written = 0  # Tickets spilled to disk.
+        self.read = 0  # Tickets read back from disk.
+        self.recover()
+
+    def recover(self):
+        """
+        Counts the tickets left on disk by the previous run, dropping a torn last one.
+        """
+        for name in os.listdir(self.spill_dir):
+            if not name.startswith(SPILL_PREFIX):
+                continue
+            spill = Spill(os.path.join(self.spill_dir, name))
+            with open(spill.path, "rb") as file:
+                data = file.read()
+            offset = 0
+            while offset + TICKET_RECORD.size <= len(data):
+                end = offset + TICKET_RECORD.size + TICKET_RECORD.unpack_from(data, offset)[-1]
+                if end > len(data):
+                    break
+                offset, spill.count = end, spill.count + 1
+            if offset < len(data):
+                os.truncate(spill.path, offset)
+            if spill.count:
+                spill.size = spill.recovered = offset
+                self.spills[int(name[len(SPILL_PREFIX) :])] = spill
+                self.size += spill.count
+            else:
+                os.unlink(spill.path)
+
+    def push(self, ticket: Ticket):
+        spill = self.spills.get(ticket.road)
+        if spill is None and self.in_memory < self.memory:
+            super().push(ticket)
+            self.in_memory += 1
+            return
+        if spill is None:
+            spill = self.spills[ticket.road] = Spill(
+                os.path.join(self.spill_dir, f"{SPILL_PREFIX}{ticket.road}")
+            )
+        plate = ticket.plate.encode()
+        record = TICKET_RECORD.pack(
+            ticket.mile1,
+            ticket.timestamp1,
+            ticket.mile2,
+            ticket.timestamp2,
+            ticket.speed,
+            ticket.created,
+            len(plate),
+        )
+        os.write(self.append_fd(ticket.road, spill), record + plate)
+        spill.size += len(record) + len(plate)
+        spill.count += 1
+        self.size += 1
+        self.written += 1
+
+    def append_fd(self, road: int, spill: Spill) -> int:
+        """
+        The spill's fd, opened if need be, closing the least recently used one past
+        `open_files`.
+        """
+        if spill.fd >= 0:
+            self.appending[road] = self.appending.pop(road)
+            return spill.fd
+        if len(self.appending) >= self.open_files:
+            self.close_fd(next(iter(self.appending)))
+        spill.fd = os.open(spill.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.appending[road] = spill
+        return spill.fd
+
+    def close_fd(self, road: int):
+        spill = self.appending.pop(road, None)
+        if spill is not None:
+            os.close(spill.fd)
+            spill.fd = -1
+
+    def pop(self, road: int, count: int) -> list[Ticket]:
+        tickets = super().pop(road, count)
+        self.in_memory -= len(tickets)
+        spill = self.spills.get(road)
+        if spill is not None and len(tickets) < count:
+            tickets.extend(self.read_spill(road, spill, count - len(tickets)))
+        return tickets
+
+    def read_spill(self, road: int, spill: Spill, count: int) -> list[Ticket]:
+        with open(spill.path, "rb") as file:
+            file.seek(spill.read_offset)
+            data = file.read(min(READ_SIZE, spill.size - spill.read_offset))
+        tickets: list[Ticket] = []
+        offset = 0
+        while len(tickets) < count and offset + TICKET_RECORD.size <= len(data):
+            mile1, timestamp1, mile2, timestamp2, speed, created, plate_len = (
+                TICKET_RECORD.unpack_from(data, offset)
+            )
+            end = offset + TICKET_RECORD.size + plate_len
+            if end > len(data):
+                break
+            ticket = Ticket(
+                data[offset + TICKET_RECORD.size : end].decode(),
+                road,
+                mile1,
+                timestamp1,
+                mile2,
+                timestamp2,
+                speed,
+            )
+            # The previous run's clock means nothing to this one.
+            recovered = spill.read_offset + offset < spill.recovered
+            ticket.created = self.opened if recovered else created
+            tickets.append(ticket)
+            offset = end
+
+        spill.read_offset += offset
+        spill.count -= len(tickets)
+        self.size -= len(tickets)
+        self.read += len(tickets)
+        if not spill.count:
+            self.close_fd(road)
+            os.unlink(spill.path)
+            del self.spills[road]
+        return tickets
+
+    def count(self, road: int) -> int:
+        spill = self.spills.get(road)
+        return super().count(road) + (spill.count if spill is not None else 0)
+
+    def roads(self) -> list[int]:
+        return list(set(self.queues) | set(self.spills))
+
+    def spilled(self, road: int) -> int:
+        spill = self.spills.get(road)
+        return spill.count if spill is not None else 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "in_memory": self.in_memory,
+            "on_disk": sum(spill.count for spill in self.spills.values()),
+            "spilled": self.written,
+            "read_back": self.read,
+        }
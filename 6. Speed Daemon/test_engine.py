@@ -0,0 +1,160 @@
+import threading
+
+from engine import Engine, Ticket, speeding_ticket
+
+
+def ticket(plate: str = "UN1X", road: int = 1, day: int = 0) -> Ticket:
+    return Ticket(plate, road, 0, day * 86400, 10, day * 86400 + 300, 12000)
+
+
+class TestSpeedingTicket:
+    def test_threshold_is_half_a_mile_per_hour(self):
+        # 1 mile in 60s is 60 mph.
+        assert speeding_ticket("UN1X", 1, 60, 0, 0, 60, 1) is None
+        ticket = speeding_ticket("UN1X", 1, 59, 0, 0, 60, 1)
+        assert ticket is not None and ticket.speed == 6000
+
+    def test_sightings_in_order(self):
+        ticket = speeding_ticket("UN1X", 1, 60, 300, 10, 0, 0)
+        assert ticket is not None
+        assert ticket.fields() == ("UN1X", 1, 0, 0, 10, 300, 12000)
+
+    def test_same_timestamp(self):
+        assert speeding_ticket("UN1X", 1, 60, 0, 0, 0, 10) is None
+
+
+class TestSightings:
+    def test_ticket_from_neighbours(self):
+        engine = Engine()
+        assert engine.add_sighting(1, 0, 60, "UN1X", 0) == []
+        tickets = engine.add_sighting(1, 10, 60, "UN1X", 300)
+        assert [t.fields() for t in tickets] == [("UN1X", 1, 0, 0, 10, 300, 12000)]
+
+    def test_one_ticket_per_day(self):
+        engine = Engine()
+        assert len(engine.claim([ticket(day=0)])) == 1
+        assert engine.claim([ticket(day=0), ticket(road=2, day=0)]) == []
+        assert len(engine.claim([ticket(day=1)])) == 1
+
+    def test_later_sighting_elsewhere_drops_nothing(self):
+        engine = Engine()
+        engine.add_sighting(2, 0, 60, "OTHER", 5_000_000)
+        engine.add_sighting(1, 0, 60, "UN1X", 1_000_000)
+        assert len(engine.add_sighting(1, 100, 60, "UN1X", 1_000_600)) == 1
+        engine.compact()
+        assert engine.stats()["late"] == 0 and engine.stats()["sightings"] == 1
+
+    def test_compaction_drops_ticketed_days_only(self):
+        engine = Engine()
+        engine.add_sighting(1, 0, 60, "UN1X", 0)
+        engine.add_sighting(1, 10, 60, "UN1X", 300)
+        engine.add_sighting(1, 0, 60, "UN1X", 86400)
+        engine.compact()
+        assert engine.stats()["compacted"] == 2 and engine.stats()["sightings"] == 1
+        assert engine.add_sighting(1, 10, 60, "UN1X", 86400 + 300)
+
+    def test_late_sightings_kept_with_a_window(self):
+        engine = Engine(retention=3600)
+        engine.add_sighting(2, 0, 60, "OTHER", 10_000)
+        engine.add_sighting(1, 0, 60, "UN1X", 10_000 - 3601)
+        assert engine.add_sighting(1, 10, 60, "UN1X", 10_000 - 3301)
+        assert engine.stats()["late"] == 1
+
+    def test_forgotten_days_not_ticketed_again(self):
+        engine = Engine(retention=3600)
+        assert engine.add_sighting(1, 0, 60, "UN1X", 0) == []
+        assert engine.add_sighting(1, 10, 60, "UN1X", 300)
+        engine.add_sighting(1, 0, 60, "OTHER", 3 * 86400)
+        engine.compact()
+        engine.add_sighting(1, 0, 60, "UN1X", 600)
+        assert engine.add_sighting(1, 10, 60, "UN1X", 900) == []
+        assert engine.stats()["refused_claims"] == 1
+
+
+class TestDispatch:
+    def test_tickets_wait_for_a_dispatcher(self):
+        engine = Engine()
+        engine.enqueue([ticket(), ticket(plate="B")])
+        assert engine.pending_count(1) == 2
+        engine.register_dispatcher("d", [1])
+        assert len(engine.poll_tickets("d")) == 2
+        assert engine.pending_count() == 0
+
+    def test_round_robin(self):
+        engine = Engine()
+        engine.register_dispatcher("a", [1])
+        engine.register_dispatcher("b", [1, 2])
+        engine.enqueue([ticket(plate=str(i)) for i in range(10)])
+        assert len(engine.poll_tickets("a")) == len(engine.poll_tickets("b")) == 5
+
+    def test_full_outbox_spills_to_road(self):
+        engine = Engine(outbox_size=2)
+        engine.register_dispatcher("d", [1])
+        engine.enqueue([ticket(plate=str(i)) for i in range(5)])
+        assert engine.pending_count(1) == 3
+        assert [t.plate for t in engine.poll_tickets("d")] == ["0", "1"]
+        assert [t.plate for t in engine.poll_tickets("d")] == ["2", "3"]
+
+    def test_unregister_hands_outbox_over(self):
+        engine = Engine()
+        engine.register_dispatcher("a", [1])
+        engine.register_dispatcher("b", [1])
+        engine.enqueue([ticket(plate=str(i)) for i in range(4)])
+        assert len(engine.unregister_dispatcher("a")) == 2
+        assert len(engine.poll_tickets("b")) == 4
+
+    def test_requeue_without_dispatcher(self):
+        engine = Engine()
+        engine.register_dispatcher("d", [1])
+        engine.enqueue([ticket()])
+        tickets = engine.poll_tickets("d")
+        engine.unregister_dispatcher("d")
+        engine.requeue(tickets)
+        assert engine.pending_count(1) == 1
+
+
+class TestLatency:
+    def test_queue_wait_and_write(self):
+        now = [100.0]
+        engine = Engine(clock=lambda: now[0])
+        engine.register_dispatcher("d", [1])
+        engine.add_sighting(1, 0, 60, "UN1X", 0)
+        engine.add_sighting(1, 10, 60, "UN1X", 300)
+        now[0] = 100.5
+        tickets = engine.poll_tickets("d")
+        now[0] = 100.75
+        engine.written(tickets)
+        latency = engine.latencies[1]
+        assert (latency.queue_wait.count, latency.queue_wait.total) == (1, 0.5)
+        assert latency.write.total == 0.25
+        assert 0.25 <= latency.write.percentile(50) < 0.5
+
+    def test_undispatched(self):
+        engine = Engine()
+        engine.register_dispatcher("d", [1])
+        engine.enqueue([ticket(road=1), ticket(road=2), ticket(road=2)])
+        assert engine.undispatched() == {2: 2}
+        assert engine.stats()["undispatched_tickets"] == 2
+
+    def test_stats_while_cameras_add(self):
+        # Each thread adds to a stripe of its own, new roads and plates, as stats() reads.
+        engine, errors = Engine(stripes=4), []
+
+        def camera(stripe: int):
+            for i in range(5000):
+                road, plate = stripe + 4 * i, f"P{i}"
+                engine.claim(engine.check(road, 0, 60, plate, 0))
+                engine.claim(engine.check(road, 10, 60, plate, 300))
+
+        threads = [threading.Thread(target=camera, args=(stripe,)) for stripe in range(4)]
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            try:
+                engine.stats()
+            except RuntimeError as err:
+                errors.append(err)
+        for thread in threads:
+            thread.join()
+        assert not errors
+        assert engine.stats()["plates"] == 4 * 5000
@@ -0,0 +1,34 @@
+import random
+
+import pandas as pd
+
+from replay import COLUMNS, replay, replay_online
+
+
+def sightings(seed: int, count: int, plates: int, span: int) -> pd.DataFrame:
+    rng = random.Random(seed)
+    rows = [
+        (rng.randrange(3), rng.randrange(100), 60, f"P{rng.randrange(plates)}", rng.randrange(span))
+        for _ in range(count)
+    ]
+    return pd.DataFrame(rows, columns=COLUMNS)
+
+
+class TestReplay:
+    def test_ticket(self):
+        frame = pd.DataFrame([(1, 10, 60, "UN1X", 300), (1, 0, 60, "UN1X", 0)], columns=COLUMNS)
+        tickets = replay(frame)
+        assert [t.fields() for t in tickets] == [("UN1X", 1, 0, 0, 10, 300, 12000)]
+
+    def test_matches_online_engine(self):
+        for seed in range(5):
+            frame = sightings(seed, 2000, 20, 4 * 86400)
+            expected = [t.fields() for t in replay_online(frame)]
+            assert expected
+            assert [t.fields() for t in replay(frame)] == expected
+
+    def test_matches_online_engine_on_ties(self):
+        frame = sightings(1, 500, 3, 100)
+        assert [t.fields() for t in replay(frame, 50)] == [
+            t.fields() for t in replay_online(frame, 50)
+        ]
@@ -0,0 +1,64 @@
+import os
+
+from engine import Engine, Ticket
+from spill import SPILL_PREFIX, SpillingTickets
+
+
+def ticket(plate: str, road: int = 1) -> Ticket:
+    return Ticket(plate, road, 0, 0, 10, 300, 12000)
+
+
+class TestSpillingTickets:
+    def test_memory_stays_bounded(self, tmp_path):
+        pending = SpillingTickets(str(tmp_path), memory=3)
+        for i in range(100):
+            pending.push(ticket(str(i), road=i % 2))
+        assert pending.in_memory == 3
+        assert pending.total() == 100
+        assert pending.count(0) == 50 and pending.spilled(0) == 48
+        assert sorted(os.listdir(tmp_path)) == [f"{SPILL_PREFIX}0", f"{SPILL_PREFIX}1"]
+
+    def test_drains_in_order(self, tmp_path):
+        pending = SpillingTickets(str(tmp_path), memory=2)
+        for i in range(10):
+            pending.push(ticket(str(i)))
+        plates = []
+        while tickets := pending.pop(1, 4):
+            assert len(tickets) <= 4
+            plates.extend(t.plate for t in tickets)
+        assert plates == [str(i) for i in range(10)]
+        assert pending.total() == 0 and os.listdir(tmp_path) == []
+
+    def test_open_files_bounded(self, tmp_path):
+        pending = SpillingTickets(str(tmp_path), memory=0, open_files=3)
+        for i in range(50):
+            pending.push(ticket(str(i), road=i % 10))
+        assert list(pending.appending) == [7, 8, 9]
+        for road in range(10):
+            assert [t.plate for t in pending.pop(road, 10)] == [str(i) for i in range(road, 50, 10)]
+        assert pending.appending == {} and os.listdir(tmp_path) == []
+
+    def test_survives_restart(self, tmp_path):
+        pending = SpillingTickets(str(tmp_path), memory=0)
+        for i in range(5):
+            pending.push(ticket(str(i), road=7))
+        with open(os.path.join(tmp_path, f"{SPILL_PREFIX}7"), "ab") as file:
+            file.write(b"\x01\x02")  # Torn write.
+
+        recovered = SpillingTickets(str(tmp_path), clock=lambda: 42.0)
+        assert recovered.roads() == [7] and recovered.count(7) == 5
+        tickets = recovered.pop(7, 10)
+        assert [t.fields() for t in tickets] == [ticket(str(i), road=7).fields() for i in range(5)]
+        assert tickets[0].created == 42.0
+
+    def test_engine_drains_when_dispatcher_connects(self, tmp_path):
+        engine = Engine(outbox_size=8, pending=SpillingTickets(str(tmp_path), memory=4))
+        engine.enqueue([ticket(str(i)) for i in range(50)])
+        assert engine.undispatched() == {1: 50}
+        assert engine.stats()["spilled_tickets"] == 46
+        engine.register_dispatcher("d", [1])
+        batches = []
+        while tickets := engine.poll_tickets("d"):
+            batches.append(len(tickets))
+        assert sum(batches) == 50 and max(batches) == 8
+        assert engine.pending_count() == 0
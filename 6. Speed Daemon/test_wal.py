@@ -0,0 +1,164 @@
+import os
+import random
+import shutil
+import threading
+
+from engine import Engine
+from wal import Journal, JournalWriter, segment_name
+
+
+def ingest(engine: Engine, journal: Journal, sightings: list[tuple[int, int, str, int]]):
+    for road, mile, plate, timestamp in sightings:
+        journal.sighting(road, mile, plate, timestamp)
+        journal.claims(engine.claim(engine.check(road, mile, 60, plate, timestamp)))
+
+
+def state(engine: Engine):
+    engine.compact()
+    sightings = {
+        (road, plate): (list(s.timestamps), list(s.miles))
+        for store in engine.stores
+        for road, plates in store.roads.items()
+        for plate, s in plates.items()
+    }
+    return sightings, {plate: list(days) for plate, days in engine.ticketed.days.items() if days}
+
+
+def workload(seed: int, count: int) -> list[tuple[int, int, str, int]]:
+    rng = random.Random(seed)
+    return [
+        (rng.randrange(3), rng.randrange(100), f"P{rng.randrange(10)}", rng.randrange(3 * 86400))
+        for _ in range(count)
+    ]
+
+
+class TestJournal:
+    def test_recover(self, tmp_path):
+        engine, journal = Engine(), Journal(str(tmp_path))
+        journal.recover(engine)
+        ingest(engine, journal, workload(1, 2000))
+        journal.close()
+
+        recovered = Engine()
+        stats = Journal(str(tmp_path)).recover(recovered)
+        assert stats["sightings"] == 2000
+        assert stats["claims"] > 0
+        assert state(recovered) == state(engine)
+
+    def test_recover_from_snapshot(self, tmp_path):
+        for retention in (None, 3600):
+            wal_dir = str(tmp_path / str(retention))
+            engine, journal = Engine(retention=retention), Journal(wal_dir)
+            journal.recover(engine)
+            for seed in range(5):
+                later = [(r, m, p, t + seed * 3 * 86400) for r, m, p, t in workload(seed, 500)]
+                ingest(engine, journal, sorted(later, key=lambda s: s[3]))
+                engine.compact()
+                journal.write(*journal.snapshot(engine))
+            ingest(engine, journal, workload(5, 100))
+            journal.close()
+            assert journal.segments() == [6]
+            assert journal.snapshots() == [6]
+
+            recovered = Engine(retention=retention)
+            stats = Journal(wal_dir).recover(recovered)
+            assert stats["sightings"] == 100
+            assert state(recovered) == state(engine)
+
+    def test_snapshot_sightings_still_pair(self, tmp_path):
+        engine, journal = Engine(), Journal(str(tmp_path))
+        journal.recover(engine)
+        ingest(engine, journal, [(1, 0, "UN1X", 0)])
+        journal.write(*journal.snapshot(engine))
+        journal.close()
+
+        recovered = Engine()
+        assert Journal(str(tmp_path)).recover(recovered)["snapshot_sightings"] == 1
+        assert recovered.add_sighting(1, 10, 60, "UN1X", 300)
+
+    def test_torn_tail(self, tmp_path):
+        engine, journal = Engine(), Journal(str(tmp_path))
+        journal.recover(engine)
+        journal.sighting(1, 0, "UN1X", 0)
+        journal.sighting(1, 10, "UN1X", 300)
+        journal.close()
+        path = os.path.join(str(tmp_path), segment_name(1))
+        os.truncate(path, os.path.getsize(path) - 1)
+
+        recovered = Engine()
+        assert Journal(str(tmp_path)).recover(recovered)["sightings"] == 1
+        assert recovered.add_sighting(1, 10, 60, "UN1X", 300)
+
+    def test_undelivered_tickets_queued_again(self, tmp_path):
+        engine, journal = Engine(), Journal(str(tmp_path))
+        journal.recover(engine)
+        tickets = []
+        for road, plate in ((1, "UN1X"), (2, "RE05")):
+            for mile, timestamp in ((0, 0), (10, 300)):
+                journal.sighting(road, mile, plate, timestamp)
+                tickets += engine.claim(engine.check(road, mile, 60, plate, timestamp))
+        journal.claims(tickets)
+        journal.delivered([t for t in tickets if t.plate == "RE05"])
+        journal.close()
+
+        recovered = Engine()
+        stats = Journal(str(tmp_path)).recover(recovered)
+        assert (stats["claims"], stats["delivered"], stats["undelivered"]) == (2, 1, 1)
+        assert recovered.pending_count(1) == 1 and recovered.pending_count(2) == 0
+        (ticket,) = recovered.pending.pop(1, 10)
+        assert (ticket.plate, ticket.mile1, ticket.mile2, ticket.speed) == ("UN1X", 0, 10, 12000)
+
+    def test_snapshot_keeps_undelivered_tickets(self, tmp_path):
+        engine, journal = Engine(), Journal(str(tmp_path))
+        journal.recover(engine)
+        ingest(engine, journal, [(1, 0, "UN1X", 0), (1, 10, "UN1X", 300)])
+        journal.write(*journal.snapshot(engine))
+        journal.close()
+        assert journal.segments() == [2]  # Only the snapshot has the claim.
+
+        recovered = Engine()
+        assert Journal(str(tmp_path)).recover(recovered)["undelivered"] == 1
+        assert recovered.pending_count() == 1
+        assert not recovered.claim(recovered.check(1, 20, 60, "UN1X", 600))
+
+    def test_segments_left_before_the_snapshot_dropped(self, tmp_path):
+        engine, journal = Engine(), Journal(str(tmp_path))
+        journal.recover(engine)
+        tickets = engine.claim(engine.check(1, 0, 60, "UN1X", 0))
+        tickets += engine.claim(engine.check(1, 10, 60, "UN1X", 300))
+        journal.claims(tickets)
+        journal.sync()
+        left = str(tmp_path / "left")
+        shutil.copy(os.path.join(str(tmp_path), segment_name(1)), left)
+        journal.write(*journal.snapshot(engine))
+        journal.delivered(tickets)
+        journal.write(*journal.snapshot(engine))
+        journal.close()
+        # A crash before the claim's segment was deleted, the delivery's was.
+        shutil.move(left, os.path.join(str(tmp_path), segment_name(1)))
+
+        recovered = Engine()
+        stats = Journal(str(tmp_path)).recover(recovered)
+        assert stats["claims"] == 0 and recovered.pending_count() == 0
+        assert segment_name(1) not in os.listdir(tmp_path)
+
+    def test_sighting_written_with_its_claims(self, tmp_path):
+        engine, journal, released = Engine(), Journal(str(tmp_path)), []
+        journal.recover(engine)
+        lock = threading.Lock()
+        writer = JournalWriter(journal, engine, released.extend, locks=[lock])
+        for mile, timestamp in ((0, 0), (10, 300)):
+            with lock:
+                tickets = engine.claim(engine.check(1, mile, 60, "UN1X", timestamp))
+                writer.log(1, mile, "UN1X", timestamp, tickets)
+        args, held = writer.take()
+        journal.write(*args)
+        writer.release(held)
+        writer.snapshot_due = True
+        args, held = writer.take()
+        assert not held and not lock.locked()
+
+        recovered = Engine()
+        stats = Journal(str(tmp_path)).recover(recovered)
+        assert (stats["sightings"], stats["claims"]) == (2, 1)
+        assert [t.plate for t in released] == ["UN1X"] and recovered.pending_count() == 1
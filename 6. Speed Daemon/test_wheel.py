@@ -0,0 +1,71 @@
+import asyncio
+
+from wheel import HEARTBEAT, HeartbeatWheel
+
+
+class Client(object):
+    def __init__(self, wheel: HeartbeatWheel):
+        self.wheel = wheel
+        self.beats: list[int] = []  # Ticks of the wheel a heartbeat was written at.
+        self.eof = False
+
+    def at_eof(self) -> bool:
+        return self.eof
+
+    def write(self, data: bytes):
+        assert data == HEARTBEAT
+        self.beats.append(self.wheel.tick)
+
+    def is_closing(self) -> bool:
+        return False
+
+
+def turn(wheel: HeartbeatWheel, ticks: int):
+    for _ in range(ticks):
+        wheel.turn()
+
+
+class TestHeartbeatWheel:
+    def test_intervals_shorter_and_longer_than_a_turn(self):
+        async def run():
+            wheel = HeartbeatWheel(slots=8)
+            clients = {interval: Client(wheel) for interval in (1, 3, 8, 9, 20)}
+            for interval, client in clients.items():
+                wheel.add(client, client, interval)
+            wheel.handle.cancel()  # Turned by hand.
+            turn(wheel, 40)
+            return {interval: client.beats for interval, client in clients.items()}
+
+        beats = asyncio.run(run())
+        for interval, ticks in beats.items():
+            assert ticks == list(range(interval, 41, interval)), interval
+
+    def test_added_mid_turn(self):
+        async def run():
+            wheel = HeartbeatWheel(slots=8)
+            first, second = Client(wheel), Client(wheel)
+            wheel.add(first, first, 5)
+            wheel.handle.cancel()
+            turn(wheel, 6)
+            wheel.add(second, second, 10)
+            turn(wheel, 20)
+            wheel.handle.cancel()
+            return second.beats
+
+        assert asyncio.run(run()) == [16, 26]
+
+    def test_stops_at_eof(self):
+        async def run():
+            wheel = HeartbeatWheel(slots=8)
+            client = Client(wheel)
+            wheel.add(client, client, 2)
+            wheel.handle.cancel()
+            turn(wheel, 4)
+            client.eof = True
+            turn(wheel, 4)
+            return wheel, client.beats
+
+        wheel, beats = asyncio.run(run())
+        assert beats == [2, 4]
+        assert wheel.count == 0 and wheel.handle is None
+        assert not any(wheel.slots)
@@ -0,0 +1,516 @@
+"""
+Write-ahead log of the Speed Daemon's sightings and ticket claims.
+
+The log is a directory of append-only segments, wal-000001, wal-000002... of
+fixed-size records followed by their plate. A sighting is logged along with the
+claims it made, whole tickets, and a delivery once a dispatcher was written the
+ticket. Records are buffered and written with one fsync per batch, the server holds
+the tickets claimed in a batch until that fsync returns.
+
+At every compaction the log moves on to a new segment, and the sightings left, the
+ticketed days, and the tickets claimed but not delivered yet are snapshotted into
+snapshot-<segment>, covering every record logged before that segment. Every segment
+before it is then deleted, so a recovery replays what came in since the last
+compaction at most. Recovery loads the snapshot and replays the segments after it,
+sightings go straight into the store without being checked for tickets again.
+
+Tickets claimed but not delivered before a crash are handed out again at recovery.
+One delivered just before the crash, its delivery not on disk yet, is delivered
+twice.
+
+    python wal.py --sightings 200000
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import struct
+import tempfile
+import threading
+import time
+from array import array
+from contextlib import ExitStack
+from typing import Callable, Iterable, Optional, Sequence
+
+from engine import Engine, Ticket
+
+SYNC_INTERVAL = 0.01  # Seconds between two fsyncs of the log, at most.
+SYNC_BYTES = 1024 * 1024  # Buffered bytes that trigger a write, before SYNC_INTERVAL.
+SEGMENT_PREFIX = "wal-"
+SNAPSHOT_PREFIX = "snapshot-"
+RECORD = struct.Struct("<BHHIIB")  # kind, road, mile, timestamp, timestamp2, plate length
+TICKET_RECORD = struct.Struct("<BHHIHIIB")
+# kind, road, mile1, timestamp1, mile2, timestamp2, speed, plate length
+SNAPSHOT_HEADER = struct.Struct("<IIII")  # plates ticketed, tickets, plates sighted, newest
+SNAPSHOT_ENTRY = struct.Struct("<BI")  # plate length, days
+SNAPSHOT_SIGHTINGS = struct.Struct("<HBI")  # road, plate length, sightings
+SIGHTING, CLAIM, DELIVERED = 1, 2, 3
+
+
+def segment_name(segment: int) -> str:
+    return f"{SEGMENT_PREFIX}{segment:06d}"
+
+
+def ticket_key(ticket: Ticket) -> tuple[str, int, int]:
+    # A plate's claims never share a day, its timestamps tell its tickets apart.
+    return ticket.plate, ticket.timestamp1, ticket.timestamp2
+
+
+def encode_ticket(kind: int, ticket: Ticket) -> bytes:
+    encoded = ticket.plate.encode()
+    return (
+        TICKET_RECORD.pack(
+            kind,
+            ticket.road,
+            ticket.mile1,
+            ticket.timestamp1,
+            ticket.mile2,
+            ticket.timestamp2,
+            ticket.speed,
+            len(encoded),
+        )
+        + encoded
+    )
+
+
+def decode_ticket(data: bytes, offset: int) -> tuple[Optional[Ticket], int]:
+    """
+    The ticket record at offset, and the offset after it. No ticket for a torn one.
+    """
+    if offset + TICKET_RECORD.size > len(data):
+        return None, offset
+    _, road, mile1, timestamp1, mile2, timestamp2, speed, plate_len = (
+        TICKET_RECORD.unpack_from(data, offset)
+    )
+    end = offset + TICKET_RECORD.size + plate_len
+    if end > len(data):
+        return None, offset
+    plate = data[offset + TICKET_RECORD.size : end].decode()
+    return Ticket(plate, road, mile1, timestamp1, mile2, timestamp2, speed), end
+
+
+class Journal(object):
+    """
+    The log of one engine. Nothing is durable until sync(), or until the buffer
+    taken by swap() was written with write().
+    """
+
+    def __init__(self, wal_dir: str):
+        os.makedirs(wal_dir, exist_ok=True)
+        self.wal_dir = wal_dir
+        self.buffer = bytearray()
+        self.segment = 0  # Being appended to.
+        self.segment_fd = -1
+        self.snapshot_segment = 0  # Segments before it are in the latest snapshot.
+        self.undelivered: dict[tuple[str, int, int], bytes] = {}
+        # ticket_key() -> its CLAIM record, for every ticket claimed and not delivered yet.
+        self.synced_bytes = 0
+        self.syncs = 0
+
+    def segments(self) -> list[int]:
+        return sorted(
+            int(name[len(SEGMENT_PREFIX) :])
+            for name in os.listdir(self.wal_dir)
+            if name.startswith(SEGMENT_PREFIX)
+        )
+
+    def snapshots(self) -> list[int]:
+        return sorted(
+            int(name[len(SNAPSHOT_PREFIX) :])
+            for name in os.listdir(self.wal_dir)
+            if name.startswith(SNAPSHOT_PREFIX) and not name.endswith(".tmp")
+        )
+
+    def recover(self, engine: Engine) -> dict[str, int]:
+        """
+        Rebuilds the engine's sightings and ticketed days from the log, queues the
+        tickets that were claimed and never delivered again, and opens a new segment to
+        append to. Returns what was replayed. What the log holds past the retention
+        window is evicted by the engine's next compaction.
+        """
+        stats = {
+            "snapshot_days": 0,
+            "snapshot_sightings": 0,
+            "sightings": 0,
+            "claims": 0,
+            "delivered": 0,
+            "undelivered": 0,
+            "segments": 0,
+        }
+        # (road, plate) -> ([timestamp], [mile]), stored in one go once every segment is read.
+        sightings: dict[tuple[int, str], tuple[list[int], list[int]]] = {}
+        snapshots = self.snapshots()
+        if snapshots:
+            self.snapshot_segment = snapshots[-1]
+            self.load_snapshot(engine, self.snapshot_segment, sightings, stats)
+
+        for segment in self.segments():
+            if segment < self.snapshot_segment:
+                # Left by a crash right after the snapshot, which has all of it.
+                os.unlink(os.path.join(self.wal_dir, segment_name(segment)))
+                continue
+            self.replay_segment(engine, segment, sightings, stats)
+            stats["segments"] += 1
+        for (road, plate), (timestamps, miles) in sightings.items():
+            engine.store(road).load(road, plate, timestamps, miles)
+        # The days the snapshot forgot can't be claimed again.
+        engine.forget_days(engine.newest())
+        # Whatever a spill kept across the restart is among them, they're queued once.
+        for road in engine.pending.roads():
+            while engine.pending.pop(road, engine.outbox_size):
+                pass
+        tickets = [decode_ticket(record, 0)[0] for record in self.undelivered.values()]
+        engine.enqueue(tickets)  # type: ignore
+        stats["undelivered"] = len(tickets)
+        self.open_segment((self.segments() or [self.snapshot_segment])[-1] + 1)
+        return stats
+
+    def load_snapshot(
+        self,
+        engine: Engine,
+        segment: int,
+        sightings: dict[tuple[int, str], tuple[list[int], list[int]]],
+        stats: dict[str, int],
+    ):
+        with open(os.path.join(self.wal_dir, f"{SNAPSHOT_PREFIX}{segment:06d}"), "rb") as file:
+            data = file.read()
+        plates, tickets, sighted, newest = SNAPSHOT_HEADER.unpack_from(data)
+        for store in engine.stores:
+            # The window stays where it was, whether any sighting was left in it or not.
+            store.newest = max(store.newest, newest)
+        offset = SNAPSHOT_HEADER.size
+        for _ in range(plates):
+            plate_len, days = SNAPSHOT_ENTRY.unpack_from(data, offset)
+            offset += SNAPSHOT_ENTRY.size
+            plate = data[offset : offset + plate_len].decode()
+            offset += plate_len
+            claimed = array("I")
+            claimed.frombytes(data[offset : offset + days * claimed.itemsize])
+            offset += days * claimed.itemsize
+            engine.ticketed.days[plate] = claimed
+            stats["snapshot_days"] += days
+        for _ in range(tickets):
+            ticket, end = decode_ticket(data, offset)
+            self.undelivered[ticket_key(ticket)] = data[offset:end]  # type: ignore
+            offset = end
+        for _ in range(sighted):
+            road, plate_len, count = SNAPSHOT_SIGHTINGS.unpack_from(data, offset)
+            offset += SNAPSHOT_SIGHTINGS.size
+            plate = data[offset : offset + plate_len].decode()
+            offset += plate_len
+            timestamps, miles = array("I"), array("H")
+            timestamps.frombytes(data[offset : offset + count * timestamps.itemsize])
+            offset += count * timestamps.itemsize
+            miles.frombytes(data[offset : offset + count * miles.itemsize])
+            offset += count * miles.itemsize
+            sightings[road, plate] = (timestamps.tolist(), miles.tolist())
+            stats["snapshot_sightings"] += count
+
+    def replay_segment(
+        self,
+        engine: Engine,
+        segment: int,
+        sightings: dict[tuple[int, str], tuple[list[int], list[int]]],
+        stats: dict[str, int],
+    ):
+        path = os.path.join(self.wal_dir, segment_name(segment))
+        with open(path, "rb") as file:
+            data = file.read()
+        offset, size = 0, len(data)
+        unpack_from, header = RECORD.unpack_from, RECORD.size
+        while offset + header <= size:
+            kind = data[offset]
+            if kind in (CLAIM, DELIVERED):
+                ticket, end = decode_ticket(data, offset)
+                if ticket is None:
+                    break
+                if kind == CLAIM:
+                    engine.ticketed.claim(ticket.plate, ticket.timestamp1, ticket.timestamp2)
+                    self.undelivered[ticket_key(ticket)] = data[offset:end]
+                    stats["claims"] += 1
+                else:
+                    self.undelivered.pop(ticket_key(ticket), None)
+                    stats["delivered"] += 1
+                offset = end
+                continue
+
+            kind, road, mile, timestamp, timestamp2, plate_len = unpack_from(data, offset)
+            end = offset + header + plate_len
+            if end > size:
+                break
+            plate = data[offset + header : end].decode()
+            offset = end
+            if kind == SIGHTING:
+                plate_sightings = sightings.get((road, plate))
+                if plate_sightings is None:
+                    plate_sightings = sightings[road, plate] = ([], [])
+                plate_sightings[0].append(timestamp)
+                plate_sightings[1].append(mile)
+                stats["sightings"] += 1
+            else:
+                break
+        if offset < size:
+            # The tail of a write that didn't make it to the disk whole.
+            os.truncate(path, offset)
+
+    def open_segment(self, segment: int):
+        if self.segment_fd >= 0:
+            os.close(self.segment_fd)
+        self.segment = segment
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+        self.segment_fd = os.open(os.path.join(self.wal_dir, segment_name(segment)), flags, 0o644)
+        self.sync_dir()
+
+    def sync_dir(self):
+        fd = os.open(self.wal_dir, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def sighting(self, road: int, mile: int, plate: str, timestamp: int):
+        encoded = plate.encode()
+        self.buffer += RECORD.pack(SIGHTING, road, mile, timestamp, 0, len(encoded))
+        self.buffer += encoded
+
+    def claims(self, tickets: Iterable[Ticket]):
+        for ticket in tickets:
+            record = encode_ticket(CLAIM, ticket)
+            self.buffer += record
+            self.undelivered[ticket_key(ticket)] = record
+
+    def delivered(self, tickets: Iterable[Ticket]):
+        for ticket in tickets:
+            self.buffer += encode_ticket(DELIVERED, ticket)
+            self.undelivered.pop(ticket_key(ticket), None)
+
+    def due(self) -> bool:
+        return len(self.buffer) >= SYNC_BYTES
+
+    def swap(self) -> bytes:
+        """
+        Takes the buffered records, for write(), so more can be logged meanwhile.
+        """
+        data, self.buffer = bytes(self.buffer), bytearray()
+        return data
+
+    def write(self, data: bytes, snapshot: Optional[bytes] = None):
+        """
+        Appends the records and fsyncs them. With a snapshot, taken along with the
+        records, moves on to a new segment, writes the snapshot, and deletes the
+        segments and the snapshot before it. Safe to run in another thread than the
+        one logging, as long as no two write() overlap.
+        """
+        if data:
+            os.write(self.segment_fd, data)
+        os.fsync(self.segment_fd)
+        self.synced_bytes += len(data)
+        self.syncs += 1
+        if snapshot is None:
+            return
+
+        segment = self.segment + 1
+        self.open_segment(segment)
+        path = os.path.join(self.wal_dir, f"{SNAPSHOT_PREFIX}{segment:06d}")
+        with open(path + ".tmp", "wb") as file:
+            file.write(snapshot)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + ".tmp", path)
+        self.sync_dir()
+        self.snapshot_segment = segment
+
+        for old in self.snapshots():
+            if old < segment:
+                os.unlink(os.path.join(self.wal_dir, f"{SNAPSHOT_PREFIX}{old:06d}"))
+        # Every record in them is in the snapshot, or was compacted away.
+        for old in self.segments():
+            if old < segment:
+                os.unlink(os.path.join(self.wal_dir, segment_name(old)))
+
+    def sync(self):
+        self.write(self.swap())
+
+    def snapshot(self, engine: Engine) -> tuple[bytes, bytes]:
+        """
+        Takes the buffered records with a snapshot of the engine's sightings and
+        ticketed days, and of the tickets not delivered, that covers them, for write().
+        Nothing may be logged or stored meanwhile.
+        """
+        # A copy, in one go, the threaded server forgets days meanwhile.
+        ticketed = list(engine.ticketed.days.items())
+        sighted = [
+            (road, plate, sightings)
+            for store in engine.stores
+            for road, plates in store.roads.items()
+            for plate, sightings in plates.items()
+        ]
+        header = (len(ticketed), len(self.undelivered), len(sighted), engine.newest())
+        chunks = [SNAPSHOT_HEADER.pack(*header)]
+        for plate, days in ticketed:
+            encoded, raw = plate.encode(), days.tobytes()
+            chunks.append(SNAPSHOT_ENTRY.pack(len(encoded), len(raw) // days.itemsize))
+            chunks.append(encoded)
+            chunks.append(raw)
+        chunks.extend(self.undelivered.values())
+        for road, plate, sightings in sighted:
+            encoded = plate.encode()
+            chunks.append(SNAPSHOT_SIGHTINGS.pack(road, len(encoded), len(sightings.timestamps)))
+            chunks.append(encoded)
+            chunks.append(sightings.timestamps.tobytes())
+            chunks.append(sightings.miles.tobytes())
+        return self.swap(), b"".join(chunks)
+
+    def close(self):
+        if self.segment_fd >= 0:
+            self.sync()
+            os.close(self.segment_fd)
+            self.segment_fd = -1
+
+
+class JournalWriter(object):
+    """
+    Group commit of a Journal, for the servers. Every SYNC_INTERVAL, what was logged
+    since the last round is written with a single fsync, then the tickets claimed
+    meanwhile are released to the dispatchers. A ticket is never written to a
+    dispatcher before its claim is on disk. Logging is safe from any thread.
+
+    A sighting and the claims it made go to disk in the same write, or a crash would
+    leave the sighting without its ticket. The asyncio servers log them in one step
+    of the loop, the threaded one with log(), under the sighting's lock. A snapshot is
+    taken holding every one of `locks`, with no sighting half stored or logged.
+    """
+
+    def __init__(
+        self,
+        journal: Journal,
+        engine: Engine,
+        release: Callable[[list[Ticket]], None],
+        locks: Sequence[threading.Lock] = (),
+    ):
+        self.journal = journal
+        self.engine = engine
+        self.release = release  # Queues the tickets on disk for their dispatchers.
+        self.locks = locks  # Held by whoever stores and logs a sighting.
+        self.lock = threading.Lock()  # The journal's buffer, and the tickets held.
+        self.held: list[Ticket] = []  # Claimed and logged, not on disk yet.
+        self.snapshot_due = False
+
+    def sighting(self, road: int, mile: int, plate: str, timestamp: int):
+        with self.lock:
+            self.journal.sighting(road, mile, plate, timestamp)
+
+    def log(self, road: int, mile: int, plate: str, timestamp: int, tickets: list[Ticket]):
+        # A sighting with the tickets it claimed, held until they're on disk.
+        with self.lock:
+            self.journal.sighting(road, mile, plate, timestamp)
+            self.journal.claims(tickets)
+            self.held.extend(tickets)
+
+    def hold(self, tickets: list[Ticket]):
+        with self.lock:
+            self.journal.claims(tickets)
+            self.held.extend(tickets)
+
+    def delivered(self, tickets: Iterable[Ticket]):
+        with self.lock:
+            self.journal.delivered(tickets)
+
+    def take(self) -> Optional[tuple[tuple, list[Ticket]]]:
+        """
+        The arguments of the next write(), and the tickets it puts on disk.
+        """
+        if self.snapshot_due:
+            with ExitStack() as stack:
+                for lock in self.locks:
+                    stack.enter_context(lock)
+                with self.lock:
+                    self.snapshot_due = False
+                    held, self.held = self.held, []
+                    return self.journal.snapshot(self.engine), held
+        with self.lock:
+            if not self.journal.buffer:
+                return None
+            held, self.held = self.held, []
+            return (self.journal.swap(),), held
+
+    async def run(self):
+        # Along with an asyncio server, the fsync in a thread.
+        loop = asyncio.get_running_loop()
+        while 1:
+            await asyncio.sleep(SYNC_INTERVAL)
+            batch = self.take()
+            if batch is not None:
+                await loop.run_in_executor(None, self.journal.write, *batch[0])
+                self.release(batch[1])
+
+    def run_forever(self):
+        # In a thread of its own, along with a threaded server.
+        while 1:
+            time.sleep(SYNC_INTERVAL)
+            batch = self.take()
+            if batch is not None:
+                self.journal.write(*batch[0])
+                self.release(batch[1])
+
+
+def bench(sightings: int, plates: int, roads: int, seed: int):
+    """
+    Plates/s of the engine alone, logging without fsync, with a batched fsync, and
+    with an fsync per sighting, then how fast the log replays.
+    """
+    rng = random.Random(seed)
+    timestamp, workload = 0, []
+    for _ in range(sightings):
+        timestamp += rng.randrange(3)
+        road = rng.randrange(roads)
+        workload.append((road, rng.randrange(100), 60, f"P{rng.randrange(plates)}", timestamp))
+
+    print(f"{'mode':<10} {'plates/s':>10} {'syncs':>8} {'MB':>8}")
+    for mode in ("off", "nosync", "batch", "always"):
+        wal_dir = tempfile.mkdtemp(prefix="speed-wal-")
+        engine, journal = Engine(), None
+        if mode != "off":
+            journal = Journal(wal_dir)
+            journal.recover(engine)
+        count = sightings if mode != "always" else min(sightings, 2000)
+        start = last_sync = time.perf_counter()
+        for road, mile, limit, plate, timestamp in workload[:count]:
+            if journal is not None:
+                journal.sighting(road, mile, plate, timestamp)
+            tickets = engine.claim(engine.check(road, mile, limit, plate, timestamp))
+            if journal is not None:
+                journal.claims(tickets)
+                now = time.perf_counter()
+                if mode == "nosync" and journal.due():
+                    os.write(journal.segment_fd, journal.swap())
+                elif mode == "batch" and (journal.due() or now - last_sync >= SYNC_INTERVAL):
+                    journal.sync()
+                    last_sync = now
+                elif mode == "always":
+                    journal.sync()
+            engine.enqueue(tickets)
+        if journal is not None:
+            journal.close()
+        elapsed = time.perf_counter() - start
+        syncs = journal.syncs if journal is not None else 0
+        size = sum(os.path.getsize(os.path.join(wal_dir, name)) for name in os.listdir(wal_dir))
+        print(f"{mode:<10} {count / elapsed:>10.0f} {syncs:>8} {size / 1e6:>8.1f}")
+
+        if mode == "batch":
+            start = time.perf_counter()
+            stats = Journal(wal_dir).recover(Engine())
+            elapsed = time.perf_counter() - start
+            print(f"{'replay':<10} {stats['sightings'] / elapsed:>10.0f} sightings/s, {stats}")
+        shutil.rmtree(wal_dir)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Cost of the Speed Daemon's log on ingest")
+    arg_parser.add_argument("--sightings", type=int, default=200_000)
+    arg_parser.add_argument("--plates", type=int, default=5000)
+    arg_parser.add_argument("--roads", type=int, default=200)
+    arg_parser.add_argument("--seed", type=int, default=1)
+    args = arg_parser.parse_args()
+    bench(args.sightings, args.plates, args.roads, args.seed)
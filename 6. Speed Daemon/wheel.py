@@ -0,0 +1,77 @@
+"""
+Heartbeats of the asyncio Speed Daemon servers, on a hashed timer wheel.
+
+The wheel has a slot per decisecond, a heartbeat interval's unit. One loop callback
+per tick writes every heartbeat due in it, instead of a sleeping task per client.
+Ticks are scheduled from when the wheel started turning, so heartbeats don't drift,
+and it stops while nobody wants one.
+"""
+import asyncio
+from typing import Optional, Protocol
+
+HEARTBEAT_TICK = 0.1  # Seconds, heartbeat intervals are in deciseconds.
+WHEEL_SLOTS = 512  # Ticks in one turn of the heartbeat wheel.
+HEARTBEAT = b"\x41"
+
+
+class Reader(Protocol):
+    def at_eof(self) -> bool: ...
+
+
+class Writer(Protocol):
+    def write(self, data: bytes) -> None: ...
+
+    def is_closing(self) -> bool: ...
+
+
+class HeartbeatTimer(object):
+    __slots__ = ("reader", "writer", "interval", "rounds")
+
+    def __init__(self, reader: Reader, writer: Writer, interval: int):
+        self.reader = reader  # Heartbeats stop once it's at EOF.
+        self.writer = writer
+        self.interval = interval  # decisecond
+        self.rounds = 0  # Turns of the wheel left before it's due.
+
+
+class HeartbeatWheel(object):
+    def __init__(self, slots: int = WHEEL_SLOTS):
+        self.slots: list[list[HeartbeatTimer]] = [[] for _ in range(slots)]
+        self.tick = 0
+        self.started = 0.0  # Loop time of tick 0.
+        self.count = 0
+        self.handle: Optional[asyncio.TimerHandle] = None
+
+    def add(self, reader: Reader, writer: Writer, interval: int):
+        if self.handle is None:
+            loop = asyncio.get_running_loop()
+            self.tick, self.started = 0, loop.time()
+            self.handle = loop.call_at(self.started + HEARTBEAT_TICK, self.turn)
+        self.schedule(HeartbeatTimer(reader, writer, interval))
+        self.count += 1
+
+    def schedule(self, timer: HeartbeatTimer):
+        due = self.tick + timer.interval
+        timer.rounds = (timer.interval - 1) // len(self.slots)
+        self.slots[due % len(self.slots)].append(timer)
+
+    def turn(self):
+        self.tick += 1
+        slot = self.slots[self.tick % len(self.slots)]
+        due = [timer for timer in slot if not timer.rounds]
+        slot[:] = [timer for timer in slot if timer.rounds]
+        for timer in slot:
+            timer.rounds -= 1
+
+        for timer in due:
+            if timer.reader.at_eof() or timer.writer.is_closing():
+                self.count -= 1
+                continue
+            timer.writer.write(HEARTBEAT)
+            self.schedule(timer)
+
+        if self.count:
+            loop = asyncio.get_running_loop()
+            self.handle = loop.call_at(self.started + (self.tick + 1) * HEARTBEAT_TICK, self.turn)
+        else:
+            self.handle = None